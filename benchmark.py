@@ -0,0 +1,876 @@
+"""A helper utility to benchmark the slow paths of the DLI App
+
+Author: Logan Gore
+This file is responsible for timing the operations of the DLI App that scale
+with the amount of data in the database (such as exporting a report to Excel)
+and checking them against a budget. Each benchmark is a subcommand; it prints
+its measurements and exits with a nonzero status if a budget is exceeded, so
+it can be run before a release or from a cron job.
+"""
+
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import pickle
+import platform
+import random
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib2
+
+from htmlmin.main import minify
+
+from dli_app import app
+from dli_app import db
+
+from dli_app.instrumentation import QueryCounter
+
+from dli_app.mod_auth.models import User
+
+from dli_app.mod_reports.excel import EXCEL_CACHE
+
+from dli_app.mod_reports.ingest import store_data_points
+from dli_app.mod_reports.jobs import ExcelJob
+from dli_app.mod_reports.models import Chart
+from dli_app.mod_reports.models import Field
+from dli_app.mod_reports.models import FieldData
+from dli_app.mod_reports.models import FieldType
+from dli_app.mod_reports.models import Report
+
+from dli_app.mod_wiki.models import WIKI_VIEWS
+from dli_app.mod_wiki.models import WikiPage
+
+from dli_app.profiler import QueryBudgetExceeded
+from dli_app.profiler import QueryProfile
+
+
+PARSER = argparse.ArgumentParser(description='DLI App Benchmark Tool')
+PARSER.add_argument(
+    '-v', '--verbose', action='store_true',
+    help='Show extra output about which stage the script is executing'
+)
+SUBPARSERS = PARSER.add_subparsers(dest='benchmark')
+
+EXCEL_PARSER = SUBPARSERS.add_parser(
+    'excel',
+    help='Export a report to Excel and measure the peak memory used',
+)
+EXCEL_PARSER.add_argument(
+    '-r', '--report-id', type=int, required=True,
+    help='The id of the report to export'
+)
+EXCEL_PARSER.add_argument(
+    '-s', '--start', default=None,
+    help='The first ds to export (default: END minus DAYS)'
+)
+EXCEL_PARSER.add_argument(
+    '-e', '--end', default=None,
+    help='The last ds to export (default: today)'
+)
+EXCEL_PARSER.add_argument(
+    '-d', '--days', type=int, default=3 * 365,
+    help='Number of days to export when START is not given'
+)
+EXCEL_PARSER.add_argument(
+    '-g', '--generate', action='store_true',
+    help='Fill every field of the report with random data for the range first'
+)
+EXCEL_PARSER.add_argument(
+    '-m', '--max-rss-mb', type=float, default=128.0,
+    help='Fail if the export process peaks above this many megabytes'
+)
+
+SUBMIT_PARSER = SUBPARSERS.add_parser(
+    'submit',
+    help='Submit a day of report data and count the queries it takes',
+)
+SUBMIT_PARSER.add_argument(
+    '-r', '--report-id', type=int, required=True,
+    help='The id of the report whose fields to submit values for'
+)
+SUBMIT_PARSER.add_argument(
+    '-n', '--num-fields', type=int, default=60,
+    help='Submit values for (at most) this many of the report\'s fields'
+)
+SUBMIT_PARSER.add_argument(
+    '-d', '--ds', default=None,
+    help='The ds to submit values for (default: today)'
+)
+SUBMIT_PARSER.add_argument(
+    '-q', '--max-queries', type=int, default=10,
+    help='Fail if a submission takes more than this many queries'
+)
+
+WIKI_PARSER = SUBPARSERS.add_parser(
+    'wiki',
+    help='Load a wiki page from many threads with and without buffered view counts',
+)
+WIKI_PARSER.add_argument(
+    '-n', '--requests', type=int, default=2000,
+    help='Number of page views per run'
+)
+WIKI_PARSER.add_argument(
+    '-t', '--threads', type=int, default=8,
+    help='Number of concurrent readers'
+)
+
+TEMPLATES_PARSER = SUBPARSERS.add_parser(
+    'templates',
+    help='Compare page latency with per-response, load-time and no HTML minification',
+)
+TEMPLATES_PARSER.add_argument(
+    '-u', '--url', action='append', default=None,
+    help='A page to load (may be repeated; default: a few common pages)'
+)
+TEMPLATES_PARSER.add_argument(
+    '-n', '--requests', type=int, default=200,
+    help='Number of loads of each page per mode'
+)
+TEMPLATES_PARSER.add_argument(
+    '-e', '--email', default=None,
+    help='Load the pages as this user (default: the first admin)'
+)
+TEMPLATES_PARSER.add_argument(
+    '-r', '--max-size-ratio', type=float, default=1.1,
+    help='Fail if load-time minified pages are this much larger than htmlmin\'s'
+)
+
+QUERIES_PARSER = SUBPARSERS.add_parser(
+    'queries',
+    help='Load pages and check their queries against a budget, showing any N+1s',
+)
+QUERIES_PARSER.add_argument(
+    '-u', '--url', action='append', default=None,
+    help='A page to load (may be repeated; default: a few common pages)'
+)
+QUERIES_PARSER.add_argument(
+    '-e', '--email', default=None,
+    help='Load the pages as this user (default: the first admin)'
+)
+QUERIES_PARSER.add_argument(
+    '-q', '--max-queries', type=int, default=20,
+    help='Fail if a page runs more than this many queries'
+)
+QUERIES_PARSER.add_argument(
+    '-r', '--max-repeats', type=int, default=5,
+    help='Fail if a page runs the same statement more than this many times'
+)
+
+SUITE_PARSER = SUBPARSERS.add_parser(
+    'suite',
+    help='Time the main pages against the dataset and save the results to compare later',
+)
+SUITE_PARSER.add_argument(
+    '-n', '--iterations', type=int, default=20,
+    help='Number of times each page is loaded'
+)
+SUITE_PARSER.add_argument(
+    '--download-iterations', type=int, default=3,
+    help='Number of times a report is exported to Excel'
+)
+SUITE_PARSER.add_argument(
+    '-d', '--days', type=int, default=365,
+    help='Number of days (ending today) that charts and downloads cover'
+)
+SUITE_PARSER.add_argument(
+    '-e', '--email', default=None,
+    help='Load the pages as this user (default: the first admin)'
+)
+SUITE_PARSER.add_argument(
+    '-s', '--search', default='press',
+    help='The text to search the wiki for'
+)
+SUITE_PARSER.add_argument(
+    '-o', '--output', default=None,
+    help='Write the results to this JSON file'
+)
+SUITE_PARSER.add_argument(
+    '-c', '--compare', default=None,
+    help='A results file of an earlier run to compare against'
+)
+SUITE_PARSER.add_argument(
+    '-r', '--max-regression', type=float, default=0.25,
+    help='Fail if a page\'s p95 is this fraction slower than in the compared run'
+)
+
+SERVE_PARSER = SUBPARSERS.add_parser(
+    'serve',
+    help='Compare the throughput of serve.py with run.py under concurrent load',
+)
+SERVE_PARSER.add_argument(
+    '-u', '--url', action='append', default=None,
+    help='A page to load (may be repeated; default: a few pages that need no login)'
+)
+SERVE_PARSER.add_argument(
+    '-c', '--clients', type=int, default=8,
+    help='Number of client processes making requests at once'
+)
+SERVE_PARSER.add_argument(
+    '-t', '--seconds', type=float, default=10,
+    help='Number of seconds to load each server for'
+)
+SERVE_PARSER.add_argument(
+    '-w', '--workers', type=int, default=multiprocessing.cpu_count(),
+    help='Number of serve.py workers'
+)
+
+DEFAULT_URLS = [
+    '/',
+    '/reports/all/',
+    '/reports/search/?filter_choices=4&search_text=e',
+    '/wiki/',
+]
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+PUBLIC_URLS = [
+    '/',
+    '/auth/login/',
+    '/health/',
+]
+
+
+def vprint(s='', endl='\n'):
+    """Print a string if verbose mode is enabled"""
+    if ARGS.verbose:
+        sys.stderr.write('{s}{endl}'.format(s=s, endl=endl))
+
+
+def random_value(type_name):
+    """Return a random submitted value for a Field of the given type"""
+    if type_name == FieldType.CURRENCY:
+        return '{:.2f}'.format(random.uniform(0, 100000))
+    elif type_name == FieldType.DOUBLE:
+        return '{:.2f}'.format(random.uniform(0, 1000))
+    elif type_name == FieldType.INTEGER:
+        return str(random.randint(0, 10000))
+    elif type_name == FieldType.TIME:
+        return '{}:{:02d}'.format(random.randint(0, 99), random.randint(0, 59))
+    return 'note {}'.format(random.randint(0, 10000))
+
+
+def generate_report_data(report, start, end, batch_size=5000):
+    """Upsert a random value for every field of a report on every day"""
+    rows = []
+    date = start
+    while date <= end:
+        for field in report.fields:
+            rows.append(FieldData.make_row(date, field, random_value(field.type_name)))
+        if len(rows) >= batch_size:
+            FieldData.upsert(rows)
+            db.session.commit()
+            vprint('\tGenerated data through {}'.format(date))
+            rows = []
+        date += datetime.timedelta(days=1)
+    FieldData.upsert(rows)
+    db.session.commit()
+
+
+def measure_in_child(func):
+    """Run func in a forked process and return (seconds, peak RSS in MB, result)
+
+    Forking gives the measurement a fresh high-water mark that isn't polluted
+    by whatever this process has allocated before. func's return value is
+    pickled back to this process as result.
+    """
+    # The child must not reuse the parent's pooled connections
+    db.engine.dispose()
+    read_fd, write_fd = os.pipe()
+    start = time.time()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        status = 0
+        try:
+            result = func()
+            # ru_maxrss is in kilobytes on Linux
+            peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+            with os.fdopen(write_fd, 'wb') as outfile:
+                pickle.dump((peak_mb, result), outfile)
+        except Exception as e:  # pylint: disable=broad-except
+            sys.stderr.write('{}\n'.format(e))
+            status = 1
+        os._exit(status)  # pylint: disable=protected-access
+
+    os.close(write_fd)
+    with os.fdopen(read_fd, 'rb') as infile:
+        data = infile.read()
+    _, status = os.waitpid(pid, 0)
+    elapsed = time.time() - start
+    if status != 0:
+        raise RuntimeError('Benchmark process failed with status {}'.format(status))
+    peak_mb, result = pickle.loads(data)
+    return elapsed, peak_mb, result
+
+
+def benchmark_excel():
+    """Export a report to Excel and check the peak RSS against the budget"""
+    report = Report.query.get(ARGS.report_id)
+    if report is None:
+        sys.exit('No report with id {}'.format(ARGS.report_id))
+
+    end = datetime.datetime.strptime(ARGS.end, '%Y-%m-%d').date() if ARGS.end \
+        else datetime.date.today()
+    start = datetime.datetime.strptime(ARGS.start, '%Y-%m-%d').date() if ARGS.start \
+        else end - datetime.timedelta(days=ARGS.days - 1)
+    start_ds = start.strftime('%Y-%m-%d')
+    end_ds = end.strftime('%Y-%m-%d')
+
+    if ARGS.generate:
+        vprint('Generating data for {} through {}...'.format(start_ds, end_ds))
+        generate_report_data(report, start, end)
+
+    num_fields = len(report.fields)
+    db.session.remove()
+
+    vprint('Exporting {} through {}...'.format(start_ds, end_ds))
+    handle, filepath = tempfile.mkstemp(suffix='.xlsx')
+    os.close(handle)
+    try:
+        elapsed, peak_mb, _ = measure_in_child(
+            lambda: Report.query.get(ARGS.report_id).create_excel_file(
+                start_ds,
+                end_ds,
+                filepath,
+            )
+        )
+    finally:
+        os.remove(filepath)
+    cells = num_fields * ((end - start).days + 1)
+
+    print('excel: {fields} fields x {days} days in {secs:.2f}s '
+          '({rate:.0f} cells/s), peak RSS {mb:.1f} MB (budget {budget:.1f} MB)'.format(
+              fields=num_fields,
+              days=(end - start).days + 1,
+              secs=elapsed,
+              rate=cells / elapsed if elapsed else 0,
+              mb=peak_mb,
+              budget=ARGS.max_rss_mb,
+          ))
+    return peak_mb <= ARGS.max_rss_mb
+
+
+def benchmark_submit():
+    """Submit growing numbers of values and check the query count stays flat"""
+    report = Report.query.get(ARGS.report_id)
+    if report is None:
+        sys.exit('No report with id {}'.format(ARGS.report_id))
+
+    ds = ARGS.ds or datetime.date.today().strftime('%Y-%m-%d')
+    fields = sorted(report.fields, key=lambda field: field.id)[:ARGS.num_fields]
+    sizes = sorted(set([1, max(len(fields) // 2, 1), len(fields)]))
+
+    ok = True
+    counts = set()
+    for size in sizes:
+        rows = [
+            FieldData.make_row(ds, field, random_value(field.type_name))
+            for field in fields[:size]
+        ]
+        for label in ('changed', 'unchanged'):
+            start = time.time()
+            with QueryCounter() as counter:
+                written = store_data_points(rows)
+            elapsed = time.time() - start
+            if label == 'changed':
+                counts.add(counter.count)
+            ok = ok and counter.count <= ARGS.max_queries
+            print('submit: {size} values ({label}, {written} written) in {ms:.1f}ms '
+                  'with {queries} queries'.format(
+                      size=size,
+                      label=label,
+                      written=len(written),
+                      ms=elapsed * 1000,
+                      queries=counter.count,
+                  ))
+
+    if len(counts) > 1:
+        print('submit: the query count grew with the number of values!')
+        ok = False
+    return ok
+
+
+def view_wiki_page(url, num_requests, num_threads):
+    """GET a url num_requests times from num_threads threads
+
+    Returns the number of requests per second.
+    """
+    per_thread = [num_requests // num_threads] * num_threads
+    per_thread[0] += num_requests % num_threads
+    failures = []
+
+    def reader(count):
+        """Make count requests with a client of our own"""
+        client = app.test_client()
+        for _ in range(count):
+            if client.get(url).status_code != 200:
+                failures.append(url)
+        db.session.remove()
+
+    threads = [threading.Thread(target=reader, args=(count,)) for count in per_thread]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+    if failures:
+        raise RuntimeError('{} requests for {} failed'.format(len(failures), url))
+    return num_requests / elapsed if elapsed else 0
+
+
+def benchmark_wiki():
+    """Compare wiki read throughput with views written through and behind"""
+    page = WikiPage('benchmark-{}'.format(os.getpid()), '# Benchmark\n\n## Section\nSome text.')
+    db.session.add(page)
+    db.session.commit()
+    page_id = page.id
+    url = '/wiki/{}/'.format(page.name)
+
+    ok = True
+    interval = WIKI_VIEWS.interval
+    try:
+        for label, run_interval in (('write-through', 0), ('write-behind', interval)):
+            WIKI_VIEWS.interval = run_interval
+            rate = view_wiki_page(url, ARGS.requests, ARGS.threads)
+            WIKI_VIEWS.flush()
+            db.session.remove()
+            views = WikiPage.query.get(page_id).views
+            print('wiki: {requests} views from {threads} threads ({label}) at '
+                  '{rate:.0f} requests/s, {views} views recorded'.format(
+                      requests=ARGS.requests,
+                      threads=ARGS.threads,
+                      label=label,
+                      rate=rate,
+                      views=views,
+                  ))
+            ok = ok and views == ARGS.requests
+            WikiPage.query.filter_by(id=page_id).update({'views': 0})
+            db.session.commit()
+    finally:
+        WIKI_VIEWS.interval = interval
+        db.session.delete(WikiPage.query.get(page_id))
+        db.session.commit()
+    return ok
+
+
+def percentile(values, pct):
+    """Return the pct-th percentile of a list of numbers"""
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+
+def load_pages(client, urls, num_requests, per_response):
+    """GET every url num_requests times and time each request
+
+    per_response runs htmlmin over each body, as the app once did in an
+    after_request hook. Returns (latencies in seconds, CPU seconds, bytes
+    of the last load of each page).
+    """
+    latencies = []
+    sizes = {}
+    cpu_start = sum(os.times()[:2])
+    for _ in range(num_requests):
+        for url in urls:
+            start = time.time()
+            response = client.get(url)
+            body = response.get_data(as_text=True)
+            if per_response:
+                body = minify(body)
+            latencies.append(time.time() - start)
+            if response.status_code != 200:
+                raise RuntimeError('{} returned {}'.format(url, response.status_code))
+            sizes[url] = len(body.encode('utf-8'))
+    return latencies, sum(os.times()[:2]) - cpu_start, sum(sizes.values())
+
+
+def logged_in_client(email):
+    """Return a test client logged in as the given user (or the first admin)"""
+    user = User.query.filter_by(email=email).first() if email \
+        else User.query.filter_by(is_admin=True).first()
+    if user is None:
+        sys.exit('No user to load the pages as')
+
+    client = app.test_client()
+    with client.session_transaction() as session:
+        # Flask-Login 0.4 and 0.5 keep the user id under different keys
+        session['user_id'] = session['_user_id'] = '{}'.format(user.id)
+        session['_fresh'] = True
+    return client
+
+
+def benchmark_templates():
+    """Compare page latency and size across the HTML minification modes"""
+    client = logged_in_client(ARGS.email)
+    urls = ARGS.url or DEFAULT_URLS
+
+    sizes = {}
+    minify_html = app.jinja_env.minify_html
+    try:
+        for label, templates, per_response in (
+                ('none', False, False),
+                ('per-response', False, True),
+                ('load-time', True, False),
+        ):
+            app.jinja_env.minify_html = templates
+            app.jinja_env.cache.clear()
+            # Warm the template cache and the DB connections first
+            load_pages(client, urls, 1, per_response)
+            latencies, cpu, sizes[label] = load_pages(
+                client, urls, ARGS.requests, per_response,
+            )
+            print('templates: {label:>12} p50 {p50:.2f}ms, p99 {p99:.2f}ms, '
+                  '{cpu:.2f}ms CPU/request, {size} bytes'.format(
+                      label=label,
+                      p50=percentile(latencies, 50) * 1000,
+                      p99=percentile(latencies, 99) * 1000,
+                      cpu=cpu * 1000 / len(latencies),
+                      size=sizes[label],
+                  ))
+    finally:
+        app.jinja_env.minify_html = minify_html
+        app.jinja_env.cache.clear()
+    return sizes['load-time'] <= sizes['per-response'] * ARGS.max_size_ratio
+
+
+def benchmark_queries():
+    """Load pages and check their queries against the budgets"""
+    client = logged_in_client(ARGS.email)
+
+    ok = True
+    for url in ARGS.url or DEFAULT_URLS:
+        with QueryProfile(repeat_threshold=ARGS.max_repeats + 1) as profile:
+            status = client.get(url).status_code
+        db.session.remove()
+        print('queries: {url} ({status}) ran {count} queries in {ms:.1f}ms'.format(
+            url=url,
+            status=status,
+            count=profile.count,
+            ms=profile.seconds * 1000,
+        ))
+        for group in profile.repeated():
+            print('\t{count}x {sql}'.format(count=group.count, sql=group.sql))
+            for site, count in group.sites.most_common():
+                print('\t\t{count}x from {site}'.format(
+                    count=count,
+                    site=' <- '.join(site) or 'outside the app',
+                ))
+        try:
+            profile.check(max_queries=ARGS.max_queries, max_repeats=ARGS.max_repeats)
+        except QueryBudgetExceeded as e:
+            print('queries: {url} is over budget: {error}'.format(url=url, error=e))
+            ok = False
+    return ok
+
+
+def expect(response, *statuses):
+    """Return a response, or raise if its status isn't one of statuses"""
+    if response.status_code not in statuses:
+        raise RuntimeError('Expected status {expected}, got {status}'.format(
+            expected=' or '.join(str(status) for status in statuses),
+            status=response.status_code,
+        ))
+    return response
+
+
+def suite_scenarios(report, chart, dept_id, end):
+    """Return [(name, number of iterations, step)] for the suite
+
+    Each step takes (client, iteration) and makes the requests of one
+    iteration of its scenario.
+    """
+    start = end - datetime.timedelta(days=ARGS.days - 1)
+    start_ds = start.strftime('%Y-%m-%d')
+    end_ds = end.strftime('%Y-%m-%d')
+    dept_fields = [field for field in report.fields if field.department_id == dept_id]
+    report_id = report.id
+
+    def ds_for(iteration):
+        """Return a different recent ds for every iteration"""
+        return (end - datetime.timedelta(days=iteration)).strftime('%Y-%m-%d')
+
+    def view_report(client, iteration):
+        """View a day of the report"""
+        expect(client.get('/reports/view/{}/{}/'.format(report_id, ds_for(iteration))), 200)
+
+    def get_chart_data(client, iteration):  # pylint: disable=unused-argument
+        """Load the chart's data for the whole range"""
+        expect(client.get('/reports/charts/get_data/{}/?start={}&end={}'.format(
+            chart.id, start_ds, end_ds,
+        )), 200)
+
+    def download_report(client, iteration):  # pylint: disable=unused-argument
+        """Export the range of the report to Excel, as a worker would"""
+        EXCEL_CACHE.invalidate_report(report_id)
+        response = expect(client.post('/reports/download/{}/'.format(report_id), data={
+            'start_date': start_ds,
+            'end_date': end_ds,
+        }), 302)
+        job = ExcelJob.claim()
+        if job is not None:
+            job.run()
+        job_id = int(response.location.rstrip('/').split('/')[-1])
+        expect(client.get('/reports/download/job/{}/file/'.format(job_id)), 200)
+
+    def submit_report_data(client, iteration):
+        """Submit a day of the department's values on the report"""
+        data = {'ds': ds_for(iteration)}
+        for field in dept_fields:
+            data[field.name] = random_value(field.type_name)
+        expect(client.post('/reports/{}/data/{}/{}/'.format(
+            report_id, ds_for(iteration), dept_id,
+        ), data=data), 302)
+
+    def wiki_search(client, iteration):  # pylint: disable=unused-argument
+        """Search the wiki"""
+        expect(client.get('/wiki/search/?q={}'.format(ARGS.search)), 200)
+
+    return [
+        ('view_report', ARGS.iterations, view_report),
+        ('get_chart_data', ARGS.iterations, get_chart_data),
+        ('download_report', ARGS.download_iterations, download_report),
+        ('submit_report_data', ARGS.iterations, submit_report_data),
+        ('wiki_search', ARGS.iterations, wiki_search),
+    ]
+
+
+def run_scenario(iterations, step):
+    """Run a scenario's step in a logged in client and time every iteration
+
+    Returns {'cold_ms', 'p50_ms', 'p95_ms', 'max_ms', 'queries',
+    'max_queries'}; the first iteration is reported on its own as cold and
+    left out of the rest.
+    """
+    client = logged_in_client(ARGS.email)
+    latencies = []
+    queries = []
+    for iteration in range(iterations + 1):
+        start = time.time()
+        with QueryCounter() as counter:
+            step(client, iteration)
+        latencies.append((time.time() - start) * 1000)
+        queries.append(counter.count)
+        db.session.remove()
+
+    warm = latencies[1:]
+    return {
+        'cold_ms': round(latencies[0], 2),
+        'p50_ms': round(percentile(warm, 50), 2),
+        'p95_ms': round(percentile(warm, 95), 2),
+        'max_ms': round(max(warm), 2),
+        'queries': percentile(queries[1:], 50),
+        'max_queries': max(queries),
+    }
+
+
+def git_commit():
+    """Return the commit of the tree being benchmarked (or None)"""
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_results(old, new):
+    """Print how every scenario changed since an old run
+
+    Returns False if a scenario's p95 regressed by more than
+    ARGS.max_regression.
+    """
+    ok = True
+    print('suite: compared with {} ({})'.format(old.get('commit'), old.get('created')))
+    for name, result in sorted(new['scenarios'].items()):
+        before = old.get('scenarios', {}).get(name)
+        if before is None:
+            continue
+        change = (result['p95_ms'] - before['p95_ms']) / before['p95_ms'] if before['p95_ms'] else 0
+        print('suite: {name:>18} p95 {old:.1f} -> {new:.1f}ms ({change:+.0%}), '
+              'queries {old_q} -> {new_q}, peak RSS {old_mb:.1f} -> {new_mb:.1f} MB'.format(
+                  name=name,
+                  old=before['p95_ms'],
+                  new=result['p95_ms'],
+                  change=change,
+                  old_q=before['queries'],
+                  new_q=result['queries'],
+                  old_mb=before['peak_rss_mb'],
+                  new_mb=result['peak_rss_mb'],
+              ))
+        if change > ARGS.max_regression:
+            print('suite: {} regressed by more than {:.0%}!'.format(name, ARGS.max_regression))
+            ok = False
+    return ok
+
+
+def benchmark_suite():
+    """Time the main pages of the site and save or compare the results"""
+    report = max(Report.query.all(), key=lambda report: len(report.fields))
+    chart = max(Chart.query.all(), key=lambda chart: len(chart.fields))
+    dept_id = db.session.query(Field.department_id).filter(
+        Field.id.in_([field.id for field in report.fields])
+    ).group_by(Field.department_id).order_by(db.func.count(Field.id).desc()).first()[0]
+    end = datetime.date.today()
+
+    results = {
+        'created': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'database': db.engine.url.drivername,
+        'dataset': {
+            'users': User.query.count(),
+            'reports': Report.query.count(),
+            'charts': Chart.query.count(),
+            'fields': Field.query.count(),
+            'field_data': FieldData.query.count(),
+            'wiki_pages': WikiPage.query.count(),
+        },
+        'scenarios': {},
+    }
+    vprint('Dataset: {}'.format(results['dataset']))
+
+    # The test client can't read CSRF tokens out of the forms it submits
+    app.config['WTF_CSRF_ENABLED'] = False
+    for name, iterations, step in suite_scenarios(report, chart, dept_id, end):
+        vprint('Running {}...'.format(name))
+        _, peak_mb, result = measure_in_child(
+            lambda iterations=iterations, step=step: run_scenario(iterations, step)
+        )
+        result['iterations'] = iterations
+        result['peak_rss_mb'] = round(peak_mb, 1)
+        results['scenarios'][name] = result
+        print('suite: {name:>18} cold {cold_ms:.1f}ms, p50 {p50_ms:.1f}ms, '
+              'p95 {p95_ms:.1f}ms, {queries} queries, peak RSS {peak_rss_mb:.1f} MB'.format(
+                  name=name,
+                  **result
+              ))
+
+    if ARGS.output:
+        with open(ARGS.output, 'w') as outfile:
+            json.dump(results, outfile, indent=2, sort_keys=True)
+        vprint('Results written to {}'.format(ARGS.output))
+
+    if ARGS.compare:
+        with open(ARGS.compare) as infile:
+            return compare_results(json.load(infile), results)
+    return True
+
+
+def start_server(command, base_url, timeout=60):
+    """Start a server script and wait until its health check passes"""
+    with open(os.devnull, 'w') as devnull:
+        server = subprocess.Popen(
+            [sys.executable, os.path.join(ROOT_DIR, command[0])] + command[1:],
+            stdout=devnull,
+            stderr=devnull,
+        )
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError('{} exited with status {}'.format(command[0], server.returncode))
+        try:
+            urllib2.urlopen(base_url + '/health/', timeout=1).read()
+            return server
+        except (urllib2.URLError, socket.error, IOError):
+            time.sleep(0.2)
+    server.terminate()
+    server.wait()
+    raise RuntimeError('{} did not become healthy in {}s'.format(command[0], timeout))
+
+
+def load_server(base_url, urls, seconds):
+    """GET urls in turn for a number of seconds
+
+    Returns the list of latencies of successful requests and the number of
+    failed requests.
+    """
+    latencies = []
+    failures = 0
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        for url in urls:
+            start = time.time()
+            try:
+                urllib2.urlopen(base_url + url, timeout=30).read()
+                latencies.append(time.time() - start)
+            except (urllib2.URLError, socket.error, IOError):
+                failures += 1
+    return latencies, failures
+
+
+def benchmark_serve():
+    """Compare the throughput of serve.py and run.py"""
+    host = app.config['SERVER_HOST']
+    base_url = 'http://{host}:{port}'.format(
+        host='127.0.0.1' if host == '0.0.0.0' else host,
+        port=app.config['SERVER_PORT'],
+    )
+    urls = ARGS.url or PUBLIC_URLS
+    servers = (
+        ('run.py', ['run.py']),
+        ('serve.py', ['serve.py', '--workers', str(ARGS.workers), '--max-requests', '0']),
+    )
+
+    ok = True
+    # The servers open their own connections
+    db.engine.dispose()
+    for label, command in servers:
+        vprint('Starting {}...'.format(label))
+        server = start_server(command, base_url)
+        try:
+            pool = multiprocessing.Pool(ARGS.clients)
+            try:
+                clients = [
+                    pool.apply_async(load_server, (base_url, urls, ARGS.seconds))
+                    for _ in range(ARGS.clients)
+                ]
+                results = [client.get() for client in clients]
+            finally:
+                pool.close()
+                pool.join()
+        finally:
+            server.terminate()
+            server.wait()
+
+        latencies = [latency for client, _ in results for latency in client]
+        failures = sum(failed for _, failed in results)
+        print('serve: {label:>8} {rate:.0f} requests/s from {clients} clients, '
+              'p50 {p50:.1f}ms, p99 {p99:.1f}ms, {failures} failures'.format(
+                  label=label,
+                  rate=len(latencies) / ARGS.seconds,
+                  clients=ARGS.clients,
+                  p50=percentile(latencies, 50) * 1000 if latencies else 0,
+                  p99=percentile(latencies, 99) * 1000 if latencies else 0,
+                  failures=failures,
+              ))
+        ok = ok and not failures
+    return ok
+
+
+BENCHMARKS = {
+    'excel': benchmark_excel,
+    'queries': benchmark_queries,
+    'serve': benchmark_serve,
+    'submit': benchmark_submit,
+    'suite': benchmark_suite,
+    'templates': benchmark_templates,
+    'wiki': benchmark_wiki,
+}
+
+
+if __name__ == '__main__':
+    ARGS = PARSER.parse_args()
+    if ARGS.benchmark is None:
+        PARSER.error('a benchmark to run is required')
+
+    vprint('Benchmark script loaded.')
+    if not BENCHMARKS[ARGS.benchmark]():
+        sys.exit(1)
@@ -14,22 +14,31 @@ import sys
 
 from dli_app import db
 
+from dli_app.mod_auth.models import ApiToken
 from dli_app.mod_auth.models import Department
 from dli_app.mod_auth.models import Location
 from dli_app.mod_auth.models import RegisterCandidate
 from dli_app.mod_auth.models import User
 
 from dli_app.mod_admin.models import ErrorReport
+from dli_app.mod_admin.models import OutboxMessage
 
+from dli_app.mod_reports.excel import ExcelCacheEntry
+from dli_app.mod_reports.jobs import ExcelJob
 from dli_app.mod_reports.models import Chart
 from dli_app.mod_reports.models import ChartType
 from dli_app.mod_reports.models import Field
 from dli_app.mod_reports.models import FieldData
+from dli_app.mod_reports.models import FieldDataVersion
 from dli_app.mod_reports.models import FieldType
 from dli_app.mod_reports.models import Report
 from dli_app.mod_reports.models import Tag
+from dli_app.mod_reports.rollups import FieldDataRollup
+from dli_app.mod_reports.search import SearchEntry
+from dli_app.mod_reports.search import SearchGram
 
 from dli_app.mod_wiki.models import WikiPage
+from dli_app.mod_wiki.search import WikiTerm
 
 
 WIKIPAGE_HOME_CONTENT = """
@@ -16,12 +16,13 @@ from flask import render_template
 from flask import url_for
 from flask_mail import Mail
 from flask_sqlalchemy import SQLAlchemy
-from flask_login import current_user
 from flask_login import LoginManager
 from flask_wtf.csrf import CsrfProtect
 
 # Other imports
-from htmlmin.main import minify
+from dli_app.metrics import METRICS
+from dli_app.minify import MinifyExtension
+from dli_app.profiler import QUERY_PROFILER
 
 
 ENVIRON_KEYS = [
@@ -87,29 +88,23 @@ def server_error(error):
     return redirect(url_for('admin.bugsplat', error=error))
 sys.stdout.write('Done\n')
 
-# Minify sent HTML strings
+# Minify HTML templates once, as they are loaded, to decrease bandwidth
 sys.stdout.write('Loading HTML minifier...')
-@app.after_request
-def response_minify(response):
-    """Minify HTML response to decrease bandwidth"""
-    if response.content_type == u'text/html; charset=utf-8':
-        response.set_data(minify(response.get_data(as_text=True)))
-    return response
+app.jinja_env.add_extension(MinifyExtension)
+app.jinja_env.minify_html = app.config.get('MINIFY_HTML', True)
 sys.stdout.write('Done\n')
 
-# Set up the tracker for users to see where requests are coming from
-sys.stdout.write('Loading user request tracking callback...')
-@app.after_request
-def user_tracking_callback(response):
-    """Print out the name of the user that made this request"""
-    sys.stdout.write('\tFollowing request made by: ')
-    if current_user.is_authenticated:
-        sys.stdout.write('{}\n'.format(current_user.email))
-    else:
-        sys.stdout.write('Anonymous Guest\n')
-    return response
+# Record the performance (and user) of every request
+sys.stdout.write('Loading request metrics...')
+METRICS.instrument(app)
 sys.stdout.write('Done\n')
 
+# Profile the queries of every request in development
+if app.config.get('QUERY_PROFILER'):
+    sys.stdout.write('Loading query profiler...')
+    QUERY_PROFILER.instrument(app)
+    sys.stdout.write('Done\n')
+
 # Define form error handler
 sys.stdout.write('Creating form error handler...')
 sys.stdout.flush()
@@ -1,12 +1,25 @@
 """Default routing for the app not within any module
 
 Author: Logan Gore
-This file is only responsible for loading the site index page.
+This file is responsible for loading the site index page and the health
+check used by load balancers and serve.py.
 """
 
+import os
+import time
+
 from flask import Blueprint
+from flask import jsonify
 from flask import render_template
 
+from sqlalchemy.exc import SQLAlchemyError
+
+from dli_app import db
+
+
+# When the app was loaded (under serve.py, before the workers were forked)
+STARTED = time.time()
+
 
 # Create a blueprint for this module
 mod_default = Blueprint('default', __name__)
@@ -19,3 +32,26 @@ mod_default = Blueprint('default', __name__)
 def home():
     """Render the site index page"""
     return render_template('index.html')
+
+
+@mod_default.route('/health')
+@mod_default.route('/health/')
+def health():
+    """Report whether this process can serve requests
+
+    Returns 200 if the database answers and 503 if it doesn't, along with
+    the process id and uptime so it's clear which worker answered.
+    """
+    try:
+        db.session.execute('SELECT 1')
+        database = 'ok'
+    except SQLAlchemyError as e:
+        db.session.rollback()
+        database = str(e).splitlines()[0]
+
+    return jsonify(
+        status='ok' if database == 'ok' else 'unavailable',
+        database=database,
+        pid=os.getpid(),
+        uptime=round(time.time() - STARTED, 1),
+    ), 200 if database == 'ok' else 503
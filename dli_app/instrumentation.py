@@ -0,0 +1,102 @@
+"""SQL statement instrumentation shared by the app
+
+Author: Logan Gore
+This file is responsible for the one set of engine event hooks that watches
+the SQL statements the app runs. The request metrics, the query profiler and
+QueryCounter all subclass QueryWatcher; while a watcher is active it is told
+about every statement its thread runs, with the statement's duration. When
+no watcher is active on a thread, the hooks return right away.
+"""
+
+import sys
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+# The active watchers and the start of the running statement, per thread
+_local = threading.local()
+
+
+class QueryWatcher(object):
+    """Context manager that is told about the SQL statements run by this thread
+
+    Subclasses override on_query. Watchers may be nested; every active one
+    sees every statement.
+    """
+
+    def __enter__(self):
+        """Start watching statements executed by the current thread"""
+        watchers = getattr(_local, 'watchers', None)
+        if watchers is None:
+            watchers = _local.watchers = []
+        watchers.append(self)
+        return self
+
+    def __exit__(self, *_):
+        """Stop watching statements"""
+        _local.watchers.remove(self)
+
+    def on_query(self, statement, seconds, frame):
+        """Record one statement
+
+        Arguments:
+        statement - the SQL that ran (or failed)
+        seconds - how long it took
+        frame - the stack frame of the code that ran it, for call_site
+        """
+        raise NotImplementedError
+
+
+class QueryCounter(QueryWatcher):
+    """Counts the SQL statements run by this thread
+
+    Usage:
+    with QueryCounter() as counter:
+        report.collect_dept_data_for_template(ds)
+    assert counter.count <= 2
+    """
+
+    def __init__(self):
+        """Initialize a QueryCounter"""
+        self.count = 0
+
+    def on_query(self, statement, seconds, frame):
+        """Count one statement"""
+        self.count += 1
+
+
+def _before_execute(*_):
+    """Engine event hook: note when a statement started"""
+    if getattr(_local, 'watchers', None):
+        _local.start = time.time()
+
+
+def _finish(statement):
+    """Tell every active watcher about the statement that just ended"""
+    watchers = getattr(_local, 'watchers', None)
+    start = getattr(_local, 'start', None)
+    _local.start = None
+    if not watchers or start is None:
+        return
+    seconds = time.time() - start
+    frame = sys._getframe(2)  # pylint: disable=protected-access
+    for watcher in list(watchers):
+        watcher.on_query(statement, seconds, frame)
+
+
+def _after_execute(conn, cursor, statement, *_):  # pylint: disable=unused-argument
+    """Engine event hook: a statement finished"""
+    _finish(statement)
+
+
+def _handle_error(context):
+    """Engine event hook: a statement raised; it still ran and took time"""
+    _finish(context.statement)
+
+
+event.listen(Engine, 'before_cursor_execute', _before_execute)
+event.listen(Engine, 'after_cursor_execute', _after_execute)
+event.listen(Engine, 'handle_error', _handle_error)
@@ -0,0 +1,278 @@
+"""Per-request performance metrics for the app
+
+Author: Logan Gore
+This file is responsible for measuring where every request spends its time:
+the wall time, the number and duration of SQL queries, the time spent
+rendering templates and the size of the response. Measurements are kept per
+endpoint as running totals plus a window of recent values, from which the
+p50/p95/p99 shown on /admin/metrics are computed, and each request is logged
+as one key=value line to the dli_app.requests logger. Recording a request is
+a few additions and appends under a lock; nothing is sorted or formatted
+until someone looks.
+
+Measurements are kept per process. Under serve.py every worker has its own,
+so /admin/metrics shows whichever worker answered, and the scraped series are
+labelled with the worker's pid for the monitoring system to sum.
+"""
+
+import collections
+import logging
+import os
+import threading
+import time
+
+from flask import request
+
+from flask_login import current_user
+
+from jinja2 import Template
+
+from dli_app.instrumentation import QueryWatcher
+
+
+# The quantiles reported for every measure
+QUANTILES = (0.5, 0.95, 0.99)
+
+# The measures recorded for every request, in display order
+MEASURES = ('seconds', 'queries', 'sql_seconds', 'template_seconds', 'bytes')
+
+LOG = logging.getLogger('dli_app.requests')
+
+# The RequestSample of the request being handled by this thread
+_current = threading.local()
+
+
+class RequestSample(QueryWatcher):
+    """What a single request has spent so far"""
+
+    __slots__ = ('start', 'queries', 'sql_seconds', 'template_seconds')
+
+    def __init__(self):
+        """Initialize a RequestSample"""
+        self.start = time.time()
+        self.queries = 0
+        self.sql_seconds = 0.0
+        self.template_seconds = 0.0
+
+    def on_query(self, statement, seconds, frame):
+        """Add a statement of the request"""
+        self.queries += 1
+        self.sql_seconds += seconds
+
+
+class TimedTemplate(Template):
+    """Jinja template that adds its render time to the current request
+
+    Only the outermost template is rendered through render(), so included
+    and extended templates aren't counted twice.
+    """
+
+    def render(self, *args, **kwargs):
+        """Render the template and time it"""
+        start = time.time()
+        try:
+            return super(TimedTemplate, self).render(*args, **kwargs)
+        finally:
+            sample = getattr(_current, 'sample', None)
+            if sample is not None:
+                sample.template_seconds += time.time() - start
+
+
+class Summary(object):
+    """Running count and total of a measure, plus its most recent values"""
+
+    __slots__ = ('count', 'total', 'recent')
+
+    def __init__(self, window):
+        """Initialize a Summary"""
+        self.count = 0
+        self.total = 0
+        self.recent = collections.deque(maxlen=window)
+
+    def add(self, value):
+        """Record one value"""
+        self.count += 1
+        self.total += value
+        self.recent.append(value)
+
+    def quantiles(self):
+        """Return [(quantile, value)] over the recent values"""
+        values = sorted(self.recent)
+        if not values:
+            return [(quantile, 0) for quantile in QUANTILES]
+        return [
+            (quantile, values[min(len(values) - 1, int(len(values) * quantile))])
+            for quantile in QUANTILES
+        ]
+
+
+class RequestMetrics(object):
+    """Per-endpoint summaries of every measure of every request
+
+    Arguments:
+    window - number of recent requests per endpoint the quantiles cover
+
+    Call instrument() once with the app to start recording.
+    """
+
+    def __init__(self, window):
+        """Initialize a RequestMetrics"""
+        self.window = window
+        self.started = time.time()
+        self._lock = threading.Lock()
+        # {endpoint: {measure: Summary}}
+        self._endpoints = {}
+        # {(endpoint, status): count}
+        self._statuses = collections.Counter()
+
+    def instrument(self, app):
+        """Record every request the app handles"""
+        app.before_request(self._start_request)
+        app.after_request(self._finish_request)
+        app.teardown_request(self._teardown_request)
+        app.jinja_env.template_class = TimedTemplate
+
+        if app.config.get('REQUEST_LOG'):
+            handler = logging.FileHandler(app.config['REQUEST_LOG'])
+            handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+            LOG.addHandler(handler)
+            LOG.setLevel(logging.INFO)
+
+    @staticmethod
+    def _start_request():
+        """Start measuring the current request"""
+        _current.sample = RequestSample().__enter__()
+
+    @staticmethod
+    def _teardown_request(exc=None):  # pylint: disable=unused-argument
+        """Stop measuring the current request, however it ended"""
+        sample = getattr(_current, 'sample', None)
+        if sample is not None:
+            _current.sample = None
+            sample.__exit__()
+
+    def _finish_request(self, response):
+        """Record the measurements of the current request"""
+        sample = getattr(_current, 'sample', None)
+        if sample is None:
+            return response
+        self._teardown_request()
+
+        endpoint = request.endpoint or '<unmatched>'
+        values = (
+            time.time() - sample.start,
+            sample.queries,
+            sample.sql_seconds,
+            sample.template_seconds,
+            response.content_length or 0,
+        )
+        self.record(endpoint, response.status_code, values)
+
+        if LOG.isEnabledFor(logging.INFO):
+            LOG.info(
+                'method=%s path=%s endpoint=%s status=%d user=%s ms=%.1f queries=%d '
+                'sql_ms=%.1f template_ms=%.1f bytes=%d',
+                request.method,
+                request.path,
+                endpoint,
+                response.status_code,
+                current_user.get_id() or '-',
+                values[0] * 1000,
+                values[1],
+                values[2] * 1000,
+                values[3] * 1000,
+                values[4],
+            )
+        return response
+
+    def record(self, endpoint, status, values):
+        """Record one request's values, given in the order of MEASURES"""
+        with self._lock:
+            summaries = self._endpoints.get(endpoint)
+            if summaries is None:
+                summaries = self._endpoints[endpoint] = {
+                    measure: Summary(self.window) for measure in MEASURES
+                }
+            for measure, value in zip(MEASURES, values):
+                summaries[measure].add(value)
+            self._statuses[(endpoint, status)] += 1
+
+    def reset(self):
+        """Forget everything recorded so far"""
+        with self._lock:
+            self.started = time.time()
+            self._endpoints.clear()
+            self._statuses.clear()
+
+    def report(self):
+        """Return a list of dicts describing every endpoint, busiest first
+
+        Each has the endpoint's name, request count, {status: count} and,
+        for every measure, its total and {quantile: value}.
+        """
+        with self._lock:
+            rows = []
+            for endpoint, summaries in self._endpoints.items():
+                row = {
+                    'endpoint': endpoint,
+                    'requests': summaries['seconds'].count,
+                    'statuses': {
+                        status: count for (name, status), count in self._statuses.items()
+                        if name == endpoint
+                    },
+                }
+                for measure, summary in summaries.items():
+                    row[measure] = {
+                        'total': summary.total,
+                        'quantiles': dict(summary.quantiles()),
+                    }
+                rows.append(row)
+        rows.sort(key=lambda row: row['seconds']['total'], reverse=True)
+        return rows
+
+    def scrape(self):
+        """Return every summary in the Prometheus text exposition format
+
+        Every series is labelled with this process's pid, since each
+        serve.py worker only knows about the requests it handled.
+        """
+        lines = []
+        report = self.report()
+        pid = os.getpid()
+        for measure in MEASURES:
+            name = 'dli_request_{}'.format(measure)
+            lines.append('# TYPE {} summary'.format(name))
+            for row in report:
+                for quantile, value in sorted(row[measure]['quantiles'].items()):
+                    lines.append('{name}{{endpoint="{endpoint}",pid="{pid}",quantile="{quantile}"}} {value}'.format(
+                        name=name,
+                        endpoint=row['endpoint'],
+                        pid=pid,
+                        quantile=quantile,
+                        value=value,
+                    ))
+                lines.append('{name}_sum{{endpoint="{endpoint}",pid="{pid}"}} {value}'.format(
+                    name=name,
+                    endpoint=row['endpoint'],
+                    pid=pid,
+                    value=row[measure]['total'],
+                ))
+                lines.append('{name}_count{{endpoint="{endpoint}",pid="{pid}"}} {value}'.format(
+                    name=name,
+                    endpoint=row['endpoint'],
+                    pid=pid,
+                    value=row['requests'],
+                ))
+        lines.append('# TYPE dli_responses_total counter')
+        for row in report:
+            for status, count in sorted(row['statuses'].items()):
+                lines.append('dli_responses_total{{endpoint="{endpoint}",pid="{pid}",status="{status}"}} {count}'.format(
+                    endpoint=row['endpoint'],
+                    pid=pid,
+                    status=status,
+                    count=count,
+                ))
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = RequestMetrics(window=1024)
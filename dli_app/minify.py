@@ -0,0 +1,62 @@
+"""Minification of the app's HTML templates
+
+Author: Logan Gore
+This file is responsible for shrinking the HTML the app sends. Rather than
+minifying every response body after it is rendered, the whitespace of each
+template's source is collapsed once when Jinja loads it, and the compiled
+template is cached as usual, so rendering a page costs nothing extra. Runs of
+whitespace become a single space (or just their newlines, so line numbers in
+Jinja errors and the query profiler still match the file), except inside
+<pre>, <textarea> and <script> elements and inside Jinja tags, which are
+left exactly as written.
+"""
+
+import re
+
+from jinja2.ext import Extension
+
+
+# The parts of a template whose whitespace must be kept as written
+PRESERVED = re.compile(
+    r'(<(pre|textarea|script)\b.*?</\2\s*>|\{%.*?%\}|\{\{.*?\}\}|\{#.*?#\})',
+    re.DOTALL | re.IGNORECASE,
+)
+
+WHITESPACE = re.compile(r'\s+')
+
+
+def _collapse(match):
+    """Return the replacement of a run of whitespace"""
+    return '\n' * match.group(0).count('\n') or ' '
+
+
+def minify_template(source):
+    """Return the source of a template with its HTML whitespace collapsed"""
+    parts = []
+    end = 0
+    for match in PRESERVED.finditer(source):
+        parts.append(WHITESPACE.sub(_collapse, source[end:match.start()]))
+        parts.append(match.group(0))
+        end = match.end()
+    parts.append(WHITESPACE.sub(_collapse, source[end:]))
+    return ''.join(parts)
+
+
+class MinifyExtension(Extension):
+    """Jinja extension that minifies .html templates as they are loaded
+
+    Minification can be turned off with the environment's minify_html
+    attribute; templates already compiled stay cached until the environment's
+    cache is cleared.
+    """
+
+    def __init__(self, environment):
+        """Initialize a MinifyExtension"""
+        super(MinifyExtension, self).__init__(environment)
+        environment.extend(minify_html=True)
+
+    def preprocess(self, source, name, filename=None):
+        """Minify the source of an HTML template"""
+        if not self.environment.minify_html or not (name or '').endswith('.html'):
+            return source
+        return minify_template(source)
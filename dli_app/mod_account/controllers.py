@@ -66,7 +66,7 @@ def edit():
 
         # Set the form defaults
         form.name.data = current_user.name
-        form.location.default = current_user.location.id
-        form.department.default = current_user.department.id
+        form.location.default = current_user.location_id
+        form.department.default = current_user.dept_id
 
         return render_template('account/edit.html', form=form)
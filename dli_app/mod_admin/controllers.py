@@ -4,11 +4,16 @@ Author: Logan Gore
 This file is responsible for loading all site pages under /admin.
 """
 
+import datetime
+import os
+
 from flask import Blueprint
+from flask import Response
 from flask import flash
 from flask import jsonify
 from flask import redirect
 from flask import render_template
+from flask import request
 from flask import url_for
 
 from flask_login import current_user
@@ -18,7 +23,10 @@ from flask_login import login_required
 from dli_app import db
 from dli_app import flash_form_errors
 
+from dli_app.metrics import METRICS
+
 # Import forms
+from dli_app.mod_admin.forms import AddApiTokenForm
 from dli_app.mod_admin.forms import AddDepartmentForm
 from dli_app.mod_admin.forms import AddFieldForm
 from dli_app.mod_admin.forms import AddLocationForm
@@ -29,13 +37,19 @@ from dli_app.mod_admin.forms import AddUserForm
 from dli_app.mod_admin.forms import ErrorReportForm
 
 # Import models
+from dli_app.mod_admin.models import OutboxMessage
+
+from dli_app.mod_auth.models import ApiToken
 from dli_app.mod_auth.models import Department
 from dli_app.mod_auth.models import Location
 from dli_app.mod_auth.models import User
 from dli_app.mod_auth.models import RegisterCandidate
 
+from dli_app.mod_reports.models import FIELD_SERIES
+from dli_app.mod_reports.models import FIELD_TYPES
 from dli_app.mod_reports.models import Field
-from dli_app.mod_reports.models import FieldType
+
+from dli_app.mod_reports.excel import EXCEL_CACHE
 
 
 # Create a blueprint for this module
@@ -61,7 +75,11 @@ def home():
         )
         return redirect(url_for('default.home'))
 
-    return render_template('admin/home.html')
+    return render_template(
+        'admin/home.html',
+        excel_stats=EXCEL_CACHE.stats(),
+        outbox_stats=OutboxMessage.stats(),
+    )
 
 
 @mod_admin.route('/edit_locations', methods=['GET', 'POST'])
@@ -260,9 +278,7 @@ def edit_fields():
         (dept.id, dept.name) for dept in Department.query.all()
     ]
 
-    form.field_type.choices = [
-        (ftype.id, ftype.name.upper()) for ftype in FieldType.query.all()
-    ]
+    form.field_type.choices = FIELD_TYPES.choices()
 
     if form.validate_on_submit():
         db.session.add(form.field)
@@ -316,6 +332,7 @@ def delete_field(field_id):
     if field is not None:
         db.session.delete(field)
         db.session.commit()
+        FIELD_SERIES.invalidate([field_id])
 
         flash(
             "Field deleted successfully.",
@@ -552,6 +569,119 @@ def delete_candidate(candidate_id):
     return redirect(url_for('admin.edit_users'))
 
 
+@mod_admin.route('/edit_api_tokens', methods=['GET', 'POST'])
+@mod_admin.route('/edit_api_tokens/', methods=['GET', 'POST'])
+@login_required
+def edit_api_tokens():
+    """Render the API token editing page
+
+    First perform a check to ensure the user is an admin.
+    Load the "Add API Token" form. If the user has submitted a new token,
+    add it to the db and show its key once; only a hash of it is kept.
+    Otherwise, show the user the list of all tokens.
+    """
+
+    if not current_user.is_admin:
+        flash(
+            "Sorry! You don't have permission to access that page.",
+            "alert-warning",
+        )
+        return redirect(url_for('default.home'))
+
+    form = AddApiTokenForm()
+    new_api_token = None
+    if form.validate_on_submit():
+        db.session.add(form.api_token)
+        db.session.commit()
+
+        # The key goes straight into this page rather than through flash(),
+        # which would keep it in the (unencrypted) session cookie
+        new_api_token = form.api_token
+        form = AddApiTokenForm(formdata=None)
+    else:
+        flash_form_errors(form)
+
+    return render_template(
+        'admin/edit_api_tokens.html',
+        form=form,
+        new_api_token=new_api_token,
+        api_tokens=ApiToken.query.order_by(ApiToken.id).all(),
+    )
+
+
+@mod_admin.route('/edit_api_tokens/delete/<int:token_id>', methods=['POST'])
+@mod_admin.route('/edit_api_tokens/delete/<int:token_id>/', methods=['POST'])
+@login_required
+def delete_api_token(token_id):
+    """Delete (revoke) an API token
+
+    First, perform a check that the user is an admin.
+    Arguments:
+    token_id - The id of the token to be deleted, as defined in the db
+    """
+
+    if not current_user.is_admin:
+        flash(
+            "Sorry! You don't have permission to access that page.",
+            "alert-warning",
+        )
+        return redirect(url_for('default.home'))
+
+    api_token = ApiToken.query.get(token_id)
+    if api_token is not None:
+        db.session.delete(api_token)
+        db.session.commit()
+
+        flash(
+            "Token deleted successfully.",
+            "alert-success",
+        )
+
+    return redirect(url_for('admin.edit_api_tokens'))
+
+
+@mod_admin.route('/metrics', methods=['GET'])
+@mod_admin.route('/metrics/', methods=['GET'])
+@login_required
+def metrics():
+    """Show the time, queries and size of the requests to every endpoint
+
+    First, perform a check that the user is an admin.
+    """
+
+    if not current_user.is_admin:
+        flash(
+            "Sorry! You don't have permission to access that page.",
+            "alert-warning",
+        )
+        return redirect(url_for('default.home'))
+
+    return render_template(
+        'admin/metrics.html',
+        endpoints=METRICS.report(),
+        started=datetime.datetime.fromtimestamp(METRICS.started),
+        window=METRICS.window,
+        pid=os.getpid(),
+    )
+
+
+@mod_admin.route('/metrics/scrape', methods=['GET'])
+@mod_admin.route('/metrics/scrape/', methods=['GET'])
+def scrape_metrics():
+    """Return the request metrics as plain text for a monitoring system
+
+    Either a logged in admin or an 'Authorization: Bearer' header with the
+    ApiToken of an admin is required.
+    """
+
+    if not (current_user.is_authenticated and current_user.is_admin):
+        api_token = ApiToken.from_authorization(request.headers.get('Authorization'))
+        if api_token is None or not api_token.user.is_admin:
+            return Response('An admin API token is required\n', 401, mimetype='text/plain')
+
+    return Response(METRICS.scrape(), mimetype='text/plain')
+
+
 @mod_admin.route('/bugsplat', methods=['GET', 'POST'])
 @mod_admin.route('/bugsplat/', methods=['GET', 'POST'])
 @mod_admin.route('/bugsplat/<error>', methods=['GET', 'POST'])
@@ -4,6 +4,8 @@ Author: Logan Gore
 This file lists all forms to be filled out from within the admin module.
 """
 
+from flask_login import current_user
+
 from flask_wtf import Form
 
 from wtforms import HiddenField
@@ -14,6 +16,7 @@ from wtforms import validators
 
 from dli_app.mod_admin.models import ErrorReport
 
+from dli_app.mod_auth.models import ApiToken
 from dli_app.mod_auth.models import Department
 from dli_app.mod_auth.models import Location
 from dli_app.mod_auth.models import RegisterCandidate
@@ -137,6 +140,31 @@ class AddFieldForm(Form):
     )
 
 
+class AddApiTokenForm(Form):
+    """Form for creating a new API token"""
+    def __init__(self, *args, **kwargs):
+        """Initialize an AddApiTokenForm"""
+        Form.__init__(self, *args, **kwargs)
+        self.api_token = None
+
+    def validate(self):
+        """Validate the form"""
+        if not Form.validate(self):
+            return False
+
+        self.api_token = ApiToken(name=self.name.data, user=current_user.user)
+        return True
+
+    name = TextField(
+        "Token Name",
+        validators=[
+            validators.Required(
+                message='You must provide a name for the token.',
+            ),
+        ],
+    )
+
+
 class AddUserForm(Form):
     """Form for inviting a new user to the site"""
     def __init__(self, *args, **kwargs):
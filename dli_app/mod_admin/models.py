@@ -6,13 +6,23 @@ This file is responsible for defining models that belong in the admin module.
 
 import datetime
 import os
+import smtplib
+import socket
 
 from dli_app import db
 from dli_app import mail
 
+from flask_mail import BadHeaderError
 from flask_mail import Message
 
 
+# Delivery of a message is retried this many times before giving up on it
+MAX_SEND_ATTEMPTS = 8
+
+# The wait before the first retry; it doubles with every failed attempt
+RETRY_BACKOFF = datetime.timedelta(minutes=1)
+
+
 class ErrorReport(db.Model):
     """Class representing bug reports and feature requests"""
     id = db.Column(db.Integer, primary_key=True)
@@ -63,7 +73,129 @@ class ErrorReport(db.Model):
             title = 'Bug Reports and Feature Requests {}'.format(today)
             msg = Message(title, recipients=[os.environ['DLI_REPORTS_DEV_EMAIL']])
             msg.body = '\n\n'.join(er.email_format for er in error_reports)
-            mail.send(msg)
+            OutboxMessage.queue(msg)
             for er in error_reports:
                 er.sent = True
             db.session.commit()
+
+
+class OutboxMessage(db.Model):
+    """Model for an email waiting to be sent
+
+    Request handlers queue their mail here instead of talking to the SMTP
+    server, so a slow server never holds up a page. site_daemons.py calls
+    deliver_pending to send everything queued over one SMTP connection,
+    retrying failed messages with exponential backoff. To try it out
+    locally, point MAIL_SERVER/MAIL_PORT at a debugging SMTP server such as
+    `python -m smtpd -n -c DebuggingServer localhost:1025`.
+    """
+    __tablename__ = 'outbox_message'
+    id = db.Column(db.Integer, primary_key=True)
+    subject = db.Column(db.String(256))
+    sender = db.Column(db.String(128))
+    recipients = db.Column(db.Text)
+    reply_to = db.Column(db.String(128))
+    body = db.Column(db.Text)
+    html = db.Column(db.Text)
+    attempts = db.Column(db.Integer, default=0)
+    next_attempt = db.Column(db.DateTime, index=True)
+    last_error = db.Column(db.String(256))
+    created = db.Column(db.DateTime)
+    sent = db.Column(db.DateTime, index=True)
+
+    def __repr__(self):
+        """Return a descriptive representation of an OutboxMessage"""
+        return '<OutboxMessage #{id} {subject!r}>'.format(id=self.id, subject=self.subject)
+
+    @classmethod
+    def queue(cls, msg):
+        """Queue a flask_mail Message for delivery and commit"""
+        sender = msg.sender
+        if isinstance(sender, tuple):
+            sender = '{} <{}>'.format(*sender)
+        now = datetime.datetime.now()
+        db.session.add(cls(
+            subject=msg.subject,
+            sender=sender,
+            recipients='\n'.join(msg.recipients),
+            reply_to=msg.reply_to,
+            body=msg.body,
+            html=msg.html,
+            attempts=0,
+            next_attempt=now,
+            created=now,
+        ))
+        db.session.commit()
+
+    def to_message(self):
+        """Rebuild the flask_mail Message of this OutboxMessage"""
+        return Message(
+            self.subject,
+            recipients=self.recipients.split('\n'),
+            sender=self.sender,
+            reply_to=self.reply_to,
+            body=self.body,
+            html=self.html,
+        )
+
+    def record_failure(self, error):
+        """Note a failed delivery and schedule the next attempt"""
+        self.attempts += 1
+        self.last_error = str(error)[:256]
+        self.next_attempt = datetime.datetime.now() + RETRY_BACKOFF * 2 ** (self.attempts - 1)
+
+    @classmethod
+    def deliver_pending(cls, batch_size=100):
+        """Send the messages that are due over one SMTP connection
+
+        A message the server rejects is retried later on its own; if the
+        connection itself fails, every message not yet sent is retried.
+        Must be called within an app context. Returns the number of
+        messages sent.
+        """
+        now = datetime.datetime.now()
+        messages = cls.query.filter(
+            cls.sent.is_(None),
+            cls.attempts < MAX_SEND_ATTEMPTS,
+            cls.next_attempt <= now,
+        ).order_by(cls.id).limit(batch_size).all()
+
+        sent = 0
+        pending = list(messages)
+        try:
+            if pending:
+                with mail.connect() as conn:
+                    while pending:
+                        message = pending[0]
+                        try:
+                            conn.send(message.to_message())
+                            message.sent = datetime.datetime.now()
+                            sent += 1
+                        except (BadHeaderError,
+                                smtplib.SMTPDataError,
+                                smtplib.SMTPRecipientsRefused,
+                                smtplib.SMTPSenderRefused) as e:
+                            message.record_failure(e)
+                        pending.pop(0)
+        except (smtplib.SMTPException, socket.error) as e:
+            for message in pending:
+                message.record_failure(e)
+
+        db.session.commit()
+        return sent
+
+    @classmethod
+    def delete_sent(cls, before):
+        """Forget the messages sent before a datetime"""
+        cls.query.filter(cls.sent < before).delete(synchronize_session=False)
+        db.session.commit()
+
+    @classmethod
+    def stats(cls):
+        """Return a dict counting the queued, failed and sent messages"""
+        unsent = cls.query.filter(cls.sent.is_(None))
+        return {
+            'queued': unsent.filter(cls.attempts < MAX_SEND_ATTEMPTS).count(),
+            'failed': unsent.filter(cls.attempts >= MAX_SEND_ATTEMPTS).count(),
+            'sent': cls.query.filter(cls.sent.isnot(None)).count(),
+        }
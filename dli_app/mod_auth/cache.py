@@ -0,0 +1,97 @@
+"""In-process caches for the auth module
+
+Author: Logan Gore
+This file is responsible for the cache of logged in users' identities, which
+saves every request from loading its user (and their department, location and
+favorites) from the database. Nothing in here imports models; the models module
+wires the cache up with the loader it needs.
+"""
+
+import threading
+import time
+
+from dli_app.stamp import StampFile
+
+
+class IdentityCache(object):
+    """Short-TTL cache of snapshots of users, keyed by user id
+
+    Arguments:
+    loader - callable taking a user id and returning a snapshot of that user
+        (or None if there is no such user)
+    ttl - seconds a snapshot is trusted before it is loaded again
+    stamp_path - optional StampFile path bumped by every invalidate(); when
+        another process bumps it, this cache is cleared entirely
+
+    Writers call invalidate() once their transaction has committed. Other
+    processes sharing the stamp file (like the other serve.py workers) drop
+    everything on their next get(); without one they only pick up changes
+    when the ttl runs out.
+    """
+
+    def __init__(self, loader, ttl, stamp_path=None):
+        """Initialize an IdentityCache"""
+        self.loader = loader
+        self.ttl = ttl
+        self._stamp = StampFile(stamp_path)
+        self._lock = threading.Lock()
+        # {user_id: (expiry time, snapshot)}
+        self._entries = {}
+        # Bumped by every invalidate() so a load that raced with a write
+        # doesn't put a stale snapshot back into the cache
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id):
+        """Return the snapshot of a user, loading it on a miss"""
+        now = time.time()
+        with self._lock:
+            self._check_stamp()
+            entry = self._entries.get(user_id)
+            if entry is not None and entry[0] > now:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            generation = self._generation
+
+        snapshot = self.loader(user_id)
+        with self._lock:
+            if generation == self._generation:
+                # Drop whatever has expired so users who left don't linger
+                for expired in [key for key, (expiry, _) in self._entries.items() if expiry <= now]:
+                    del self._entries[expired]
+                if snapshot is not None:
+                    self._entries[user_id] = (now + self.ttl, snapshot)
+        return snapshot
+
+    def invalidate(self, user_ids=None):
+        """Drop the given users (or everyone) from the cache"""
+        with self._lock:
+            self._check_stamp()
+            self._stamp.bump()
+            self._generation += 1
+            if user_ids is None:
+                self._entries.clear()
+                return
+            for user_id in user_ids:
+                self._entries.pop(user_id, None)
+
+    def _check_stamp(self):
+        """Clear everything if another process has invalidated since we looked
+
+        Must be called with the lock held.
+        """
+        if self._stamp.changed():
+            self._generation += 1
+            self._entries.clear()
+
+    def stats(self):
+        """Return a dict of counters describing the cache"""
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'users': len(self._entries),
+                'ttl': self.ttl,
+            }
@@ -27,6 +27,8 @@ from dli_app.mod_auth.forms import ForgotForm
 from dli_app.mod_auth.forms import NewPassForm
 
 # Import models
+from dli_app.mod_admin.models import OutboxMessage
+
 from dli_app.mod_auth.models import Department
 from dli_app.mod_auth.models import Location
 from dli_app.mod_auth.models import PasswordReset
@@ -34,7 +36,6 @@ from dli_app.mod_auth.models import RegisterCandidate
 from dli_app.mod_auth.models import User
 
 from dli_app import db
-from dli_app import mail
 from dli_app import flash_form_errors
 
 
@@ -149,7 +150,7 @@ def resetpass():
         content += '\nThis link will expire in 7 days!'
         msg = Message(title, recipients=[email])
         msg.body = content
-        mail.send(msg)
+        OutboxMessage.queue(msg)
         flash("Email sent!", "alert-success")
         return redirect(url_for('default.home'))
     else:
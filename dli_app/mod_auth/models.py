@@ -5,26 +5,33 @@ This file is responsible for defining models that belong in the auth module.
 """
 
 import datetime
+import hashlib
 import os
 import random
 import string
+import tempfile
 
 from flask_login import UserMixin
 from flask_mail import Message
 
+from sqlalchemy import event
+
 from werkzeug.security import check_password_hash
 from werkzeug.security import generate_password_hash
 
+from dli_app import app
 from dli_app import db
 from dli_app import login_manager
-from dli_app import mail
 
 from dli_app.mod_admin.models import ErrorReport
+from dli_app.mod_admin.models import OutboxMessage
 
 from dli_app.mod_reports.models import Chart
 from dli_app.mod_reports.models import Field
 from dli_app.mod_reports.models import Report
 
+from dli_app.mod_auth.cache import IdentityCache
+
 
 report_users = db.Table(
     'report_users',
@@ -42,8 +49,15 @@ chart_users = db.Table(
 
 @login_manager.user_loader
 def user_loader(user_id):
-    """Unique user loader for the login manager"""
-    return User.query.get(user_id)
+    """Unique user loader for the login manager
+
+    Returns an Identity built from IDENTITY_CACHE, so most requests don't
+    query for their user at all.
+    """
+    snapshot = IDENTITY_CACHE.get(int(user_id))
+    if snapshot is None:
+        return None
+    return Identity(snapshot)
 
 
 class RegisterCandidate(db.Model):
@@ -87,7 +101,7 @@ class RegisterCandidate(db.Model):
             <a href="{url}">{url}</a>
             <p>Thank you!</p>
         """.format(url=url)
-        mail.send(msg)
+        OutboxMessage.queue(msg)
 
 
 class PasswordReset(db.Model):
@@ -122,6 +136,57 @@ class PasswordReset(db.Model):
             return None
 
 
+class ApiToken(db.Model):
+    """Model for a token other systems use to submit report data
+
+    Only a hash of the token is stored. The token itself is available as
+    .key on the instance that created it, so it can be shown exactly once.
+    """
+    __tablename__ = 'api_token'
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(64))
+    key_hash = db.Column(db.String(64), index=True, unique=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    created = db.Column(db.DateTime)
+    last_used = db.Column(db.DateTime)
+
+    def __init__(self, name, user):
+        """Initialize an ApiToken model"""
+        rand = random.SystemRandom()
+        self.key = ''.join(
+            rand.choice(string.ascii_letters + string.digits)
+            for _ in range(48)
+        )
+        self.name = name
+        self.user = user
+        self.key_hash = self.hash_key(self.key)
+        self.created = datetime.datetime.now()
+
+    def __repr__(self):
+        """Return a descriptive representation of an ApiToken"""
+        return '<ApiToken %r>' % self.name
+
+    @staticmethod
+    def hash_key(key):
+        """Return the stored form of a token"""
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    @classmethod
+    def authenticate(cls, key):
+        """Retrieve the ApiToken for a token (or None)"""
+        if not key:
+            return None
+        return cls.query.filter_by(key_hash=cls.hash_key(key)).first()
+
+    @classmethod
+    def from_authorization(cls, header):
+        """Retrieve the ApiToken of an 'Authorization: Bearer' header (or None)"""
+        header = header or ''
+        if not header.startswith('Bearer '):
+            return None
+        return cls.authenticate(header[len('Bearer '):].strip())
+
+
 class User(db.Model, UserMixin):
     """Model for users of the site"""
     __tablename__ = 'user'
@@ -148,6 +213,11 @@ class User(db.Model, UserMixin):
         ErrorReport,
         backref="user",
     )
+    api_tokens = db.relationship(
+        ApiToken,
+        backref="user",
+        cascade="all, delete-orphan",
+    )
     favorite_reports = db.relationship(
         Report,
         secondary=report_users,
@@ -248,3 +318,179 @@ class Department(db.Model):
     def __repr__(self):
         """Return a descriptive representation of a Department"""
         return '<Department %r>' % self.name
+
+
+class Identity(UserMixin):
+    """The logged in user, as current_user for a single request
+
+    Built from a snapshot held in IDENTITY_CACHE, which has everything most
+    pages need: the user's name, email, role, department, location and the
+    ids of their favorite reports and charts. The User model itself is only
+    loaded (through .user) by the pages that change or list those things.
+    """
+
+    def __init__(self, snapshot):
+        """Initialize an Identity"""
+        UserMixin.__init__(self)
+        self.id = snapshot['id']
+        self.name = snapshot['name']
+        self.email = snapshot['email']
+        self.is_admin = snapshot['is_admin']
+        self.dept_id = snapshot['dept_id']
+        self.department_name = snapshot['department_name']
+        self.location_id = snapshot['location_id']
+        self.location_name = snapshot['location_name']
+        self.favorite_report_ids = set(snapshot['favorite_report_ids'])
+        self.favorite_chart_ids = set(snapshot['favorite_chart_ids'])
+        self._user = None
+
+    def __repr__(self):
+        """Return a descriptive representation of an Identity"""
+        return '<Identity %r>' % self.email
+
+    @property
+    def user(self):
+        """The User model of this identity, loaded on first use"""
+        if self._user is None:
+            self._user = User.query.get(self.id)
+        return self._user
+
+    @property
+    def reports(self):
+        """The reports this user owns"""
+        return self.user.reports
+
+    @property
+    def charts(self):
+        """The charts this user owns"""
+        return self.user.charts
+
+    @property
+    def favorite_reports(self):
+        """The user's favorite reports"""
+        return self.user.favorite_reports
+
+    @property
+    def favorite_charts(self):
+        """The user's favorite charts"""
+        return self.user.favorite_charts
+
+    def favorite(self, report):
+        """Add a report to the user's list of favorite reports"""
+        self.user.favorite(report)
+        self.favorite_report_ids.add(report.id)
+
+    def unfavorite(self, report):
+        """Remove a report from the user's list of favorite reports"""
+        self.user.unfavorite(report)
+        self.favorite_report_ids.discard(report.id)
+
+    def favorite_chart(self, chart):
+        """Add a chart to the user's list of favorite charts"""
+        self.user.favorite_chart(chart)
+        self.favorite_chart_ids.add(chart.id)
+
+    def unfavorite_chart(self, chart):
+        """Remove a chart from the user's list of favorite charts"""
+        self.user.unfavorite_chart(chart)
+        self.favorite_chart_ids.discard(chart.id)
+
+
+def _load_identity(user_id):
+    """Load the snapshot of a user for IDENTITY_CACHE with one query
+
+    The user's department and location are joined in, and so is one row per
+    favorite report or chart.
+    """
+    favorites = db.union_all(
+        db.select([
+            db.literal('report').label('kind'),
+            report_users.c.report_id.label('item_id'),
+            report_users.c.user_id.label('user_id'),
+        ]).where(report_users.c.user_id == user_id),
+        db.select([
+            db.literal('chart'),
+            chart_users.c.chart_id,
+            chart_users.c.user_id,
+        ]).where(chart_users.c.user_id == user_id),
+    ).alias('favorites')
+
+    rows = db.session.query(
+        User.id,
+        User.name,
+        User.email,
+        User.is_admin,
+        User.dept_id,
+        Department.name,
+        User.location_id,
+        Location.name,
+        favorites.c.kind,
+        favorites.c.item_id,
+    ).outerjoin(
+        Department, Department.id == User.dept_id,
+    ).outerjoin(
+        Location, Location.id == User.location_id,
+    ).outerjoin(
+        favorites, favorites.c.user_id == User.id,
+    ).filter(User.id == user_id).all()
+    if not rows:
+        return None
+
+    first = rows[0]
+    favorite_ids = {'report': set(), 'chart': set()}
+    for row in rows:
+        if row[8] is not None:
+            favorite_ids[row[8]].add(row[9])
+    return {
+        'id': first[0],
+        'name': first[1],
+        'email': first[2],
+        'is_admin': first[3],
+        'dept_id': first[4],
+        'department_name': first[5],
+        'location_id': first[6],
+        'location_name': first[7],
+        'favorite_report_ids': frozenset(favorite_ids['report']),
+        'favorite_chart_ids': frozenset(favorite_ids['chart']),
+    }
+
+
+IDENTITY_CACHE = IdentityCache(
+    loader=_load_identity,
+    ttl=app.config.get('IDENTITY_CACHE_SECONDS', 60),
+    # Lets every serve.py worker see role and department changes at once
+    stamp_path=app.config.get(
+        'IDENTITY_CACHE_STAMP_PATH',
+        os.path.join(tempfile.gettempdir(), 'dli-reports-identity.stamp'),
+    ),
+)
+
+
+@event.listens_for(db.session, 'after_flush')
+def _collect_identity_changes(session, flush_context):  # pylint: disable=unused-argument
+    """Remember which cached identities a flush made stale"""
+    changes = session.info.setdefault('identity_changes', set())
+    for obj in list(session.dirty) + list(session.deleted):
+        if isinstance(obj, User):
+            changes.add(obj.id)
+        elif isinstance(obj, (Department, Location)):
+            # Their names are in every snapshot of their users
+            changes.add(None)
+
+
+@event.listens_for(db.session, 'after_commit')
+def _invalidate_identities(session):
+    """Drop the identities changed by a committed transaction"""
+    changes = session.info.pop('identity_changes', None)
+    if not changes:
+        return
+    if None in changes:
+        IDENTITY_CACHE.invalidate()
+    else:
+        IDENTITY_CACHE.invalidate(changes)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _forget_identity_changes(session):
+    """Forget the identity changes of a transaction that was rolled back"""
+    session.info.pop('identity_changes', None)
@@ -0,0 +1,241 @@
+"""In-process caches for the reports module
+
+Author: Logan Gore
+This file is responsible for the caches that sit between the reports module
+and the database. Nothing in here imports models; the models module wires the
+caches up with the loaders they need.
+"""
+
+import array
+import bisect
+import collections
+import datetime
+import threading
+
+from dli_app.stamp import StampFile
+
+
+class FieldSeries(object):
+    """The full history of one Field, stored as compact parallel arrays
+
+    ordinals holds date.toordinal() of every ds in ascending order and raws
+    holds the stored (ivalue/dvalue/svalue) value for the same index. Integer
+    and float storage use typed arrays; strings fall back to a plain list.
+    """
+
+    __slots__ = ('type_name', 'ordinals', 'raws')
+
+    def __init__(self, type_name, ordinals, raws):
+        """Initialize a FieldSeries"""
+        self.type_name = type_name
+        self.ordinals = ordinals
+        self.raws = raws
+
+    def __len__(self):
+        """Return the number of data points in the series"""
+        return len(self.ordinals)
+
+    def between(self, start, end):
+        """Return (ordinals, raws) for every point with start <= date <= end"""
+        lo = bisect.bisect_left(self.ordinals, start.toordinal())
+        hi = bisect.bisect_right(self.ordinals, end.toordinal())
+        return self.ordinals[lo:hi], self.raws[lo:hi]
+
+    def on(self, date):
+        """Return the raw value stored for the given date (or None)"""
+        ordinal = date.toordinal()
+        idx = bisect.bisect_left(self.ordinals, ordinal)
+        if idx < len(self.ordinals) and self.ordinals[idx] == ordinal:
+            return self.raws[idx]
+        return None
+
+
+class FieldSeriesCache(object):
+    """Read-through, LRU-bounded cache of FieldSeries keyed by field_id
+
+    Arguments:
+    loader - callable taking a list of field ids and returning an iterable of
+        (field_id, type_name, date, raw) tuples sorted by field_id then date
+    typecodes - {type_name: array typecode} for the types stored in arrays
+    max_points - total number of data points to keep across all fields
+    stamp_path - optional StampFile path bumped by every invalidate(); when
+        another process bumps it, this cache drops what that process changed
+    versioner - optional callable taking a list of field ids and returning
+        {field_id: version}, where a field's version changes whenever its
+        data does; without one, a bump by another process clears this cache
+        entirely
+
+    Writers must call invalidate() with the ids of the fields they changed
+    once their transaction has committed.
+    """
+
+    def __init__(self, loader, typecodes, max_points, stamp_path=None, versioner=None):
+        """Initialize a FieldSeriesCache"""
+        self.loader = loader
+        self.typecodes = typecodes
+        self.max_points = max_points
+        self.versioner = versioner
+        self._stamp = StampFile(stamp_path)
+        self._lock = threading.Lock()
+        self._series = collections.OrderedDict()
+        # {field_id: the field's version when its series was loaded}
+        self._versions = {}
+        self._points = 0
+        # Bumped by every invalidate() so a load that raced with a write
+        # doesn't put stale data back into the cache
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, field_id):
+        """Return the FieldSeries for a single field"""
+        return self.get_many([field_id])[field_id]
+
+    def get_many(self, field_ids):
+        """Return {field_id: FieldSeries}, loading every miss in one query"""
+        self._check_stamp()
+        found = {}
+        missing = []
+        with self._lock:
+            for field_id in field_ids:
+                series = self._series.get(field_id)
+                if series is None:
+                    missing.append(field_id)
+                else:
+                    # Mark as most recently used
+                    del self._series[field_id]
+                    self._series[field_id] = series
+                    found[field_id] = series
+            self.hits += len(found)
+            self.misses += len(missing)
+            generation = self._generation
+
+        if missing:
+            # Read before the data, so a write in between leaves the version
+            # behind and the series is dropped when that write is noticed
+            versions = self.versioner(missing) if self.versioner is not None else {}
+            loaded = self.load(missing)
+            with self._lock:
+                if generation == self._generation:
+                    for field_id, series in loaded.items():
+                        self._store(field_id, series, versions.get(field_id, 0))
+            found.update(loaded)
+        return found
+
+    def load(self, field_ids):
+        """Build FieldSeries for the given fields from the loader's rows
+
+        The cache is neither read nor filled, so this may be called inside a
+        transaction that hasn't been committed yet.
+        """
+        columns = {}
+        for field_id, type_name, date, raw in self.loader(field_ids):
+            if raw is None:
+                continue
+            if field_id not in columns:
+                typecode = self.typecodes.get(type_name)
+                raws = array.array(typecode) if typecode else []
+                columns[field_id] = FieldSeries(type_name, array.array('l'), raws)
+            series = columns[field_id]
+            series.ordinals.append(date.toordinal())
+            series.raws.append(raw)
+
+        return {
+            field_id: columns.get(field_id) or FieldSeries(None, array.array('l'), [])
+            for field_id in field_ids
+        }
+
+    def _store(self, field_id, series, version):
+        """Insert a series and evict least recently used ones over the cap
+
+        Must be called with the lock held.
+        """
+        self._drop(field_id)
+        self._series[field_id] = series
+        self._versions[field_id] = version
+        self._points += len(series)
+
+        while self._points > self.max_points and len(self._series) > 1:
+            evicted_id, evicted = self._series.popitem(last=False)
+            del self._versions[evicted_id]
+            self._points -= len(evicted)
+            self.evictions += 1
+
+    def _drop(self, field_id):
+        """Remove one field's series, if cached
+
+        Must be called with the lock held.
+        """
+        series = self._series.pop(field_id, None)
+        if series is not None:
+            del self._versions[field_id]
+            self._points -= len(series)
+
+    def _clear(self):
+        """Remove every series
+
+        Must be called with the lock held.
+        """
+        self._series.clear()
+        self._versions.clear()
+        self._points = 0
+
+    def _check_stamp(self):
+        """Drop what other processes have changed since we last looked
+
+        With a versioner, only the fields whose version moved are dropped,
+        found with one call for every cached field; without one, everything
+        is dropped.
+        """
+        with self._lock:
+            if not self._stamp.changed():
+                return
+            # A load that started before the other process's write mustn't
+            # be stored
+            self._generation += 1
+            if self.versioner is None:
+                self._clear()
+                return
+            cached = dict(self._versions)
+        if not cached:
+            return
+
+        current = self.versioner(list(cached))
+        with self._lock:
+            for field_id, version in cached.items():
+                if current.get(field_id, 0) != version and self._versions.get(field_id) == version:
+                    self._drop(field_id)
+
+    def invalidate(self, field_ids=None):
+        """Drop the given fields (or everything) from the cache
+
+        Other processes sharing the stamp file drop the fields whose version
+        changed (or everything, without a versioner).
+        """
+        self._check_stamp()
+        with self._lock:
+            self._stamp.bump()
+            self._generation += 1
+            if field_ids is None:
+                self._clear()
+                return
+            for field_id in field_ids:
+                self._drop(field_id)
+
+    def stats(self):
+        """Return a dict of counters describing the cache"""
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'fields': len(self._series),
+                'points': self._points,
+                'max_points': self.max_points,
+            }
+
+
+def ordinal_to_ds(ordinal):
+    """Convert a date ordinal back into a 'YYYY-MM-DD' ds string"""
+    return datetime.date.fromordinal(ordinal).isoformat()
@@ -4,12 +4,16 @@ Author: Logan Gore
 This file is responsible for loading all site pages under /reports.
 """
 
+import hashlib
+
 from datetime import datetime
 from datetime import timedelta
 
 from flask import Blueprint
+from flask import abort
 from flask import flash
 from flask import jsonify
+from flask import make_response
 from flask import redirect
 from flask import render_template
 from flask import request
@@ -20,15 +24,31 @@ from flask_login import current_user
 from flask_login import login_required
 
 # Import main db and form error handler for app
+from dli_app import csrf
 from dli_app import db
 from dli_app import flash_form_errors
 
 # Import models
+from dli_app.mod_auth.models import ApiToken
 from dli_app.mod_auth.models import Department
 
+from dli_app.mod_reports.models import CHART_TYPES
+from dli_app.mod_reports.models import FIELD_SERIES
 from dli_app.mod_reports.models import Chart
-from dli_app.mod_reports.models import ChartType
+from dli_app.mod_reports.models import Field
+from dli_app.mod_reports.models import FieldDataVersion
 from dli_app.mod_reports.models import Report
+from dli_app.mod_reports.models import chart_fields
+from dli_app.mod_reports.models import to_date
+from dli_app.mod_reports.models import valid_ds
+
+from dli_app.mod_reports import rollups
+from dli_app.mod_reports.excel import EXCEL_CACHE
+from dli_app.mod_reports.ingest import FieldIndex
+from dli_app.mod_reports.ingest import prepare_row
+from dli_app.mod_reports.ingest import store_data_points
+from dli_app.mod_reports.jobs import ExcelJob
+from dli_app.mod_reports.search import search_query
 
 # Import forms
 from dli_app.mod_reports.forms import ChangeDateForm
@@ -45,6 +65,21 @@ from dli_app.mod_reports.forms import SearchForm
 # Create a blueprint for this module
 mod_reports = Blueprint('reports', __name__, url_prefix='/reports')
 
+# The most charts get_charts_data will load in one request
+MAX_BATCH_CHARTS = 50
+
+# The most values api_submit_data will accept in one request
+MAX_API_VALUES = 10000
+
+# Number of results per page of a search
+SEARCH_PAGE_SIZE = 20
+
+
+def departments_with_fields():
+    """Return every Department that has Fields, with the Fields loaded"""
+    departments = Department.query.options(db.joinedload('fields')).order_by(Department.id)
+    return [department for department in departments if department.fields]
+
 
 # Set all routing for the module
 @mod_reports.route('/me', methods=['GET'])
@@ -126,12 +161,9 @@ def create_report():
     Otherwise, render the template to show the user the create report page.
     """
 
-    LocalCreateReportForm = CreateReportForm.get_instance()
-    for department in Department.query.all():
-        if len(department.fields) > 0:
-            LocalCreateReportForm.add_department(department)
-
-    form = LocalCreateReportForm()
+    departments = departments_with_fields()
+    LocalCreateReportForm = CreateReportForm.get_instance(departments)
+    form = LocalCreateReportForm(departments=departments)
     form.user_id.data = current_user.id
     if form.validate_on_submit():
         # Add the new report to the database
@@ -163,6 +195,8 @@ def submit_report_data(report_id, ds=None, dept_id=None):
         ds = datetime.now().strftime('%Y-%m-%d')
     elif ds == 'yesterday':
         ds = (datetime.now() - timedelta(days=1)).strftime('%Y-%m-%d')
+    elif not valid_ds(ds):
+        abort(404)
 
     # Check to see if the user picked a different day or department
     change_form = ChangeDateAndDepartmentForm()
@@ -180,7 +214,7 @@ def submit_report_data(report_id, ds=None, dept_id=None):
 
     # We must generate the dynamic form before loading it
     if not dept_id:
-        dept_id = current_user.department.id
+        dept_id = current_user.dept_id
 
     department = Department.query.get(dept_id)
     if not department:
@@ -190,27 +224,14 @@ def submit_report_data(report_id, ds=None, dept_id=None):
         )
         return redirect(url_for('reports.submit_report_data', report_id=report_id))
 
-    LocalSubmitReportDataForm = SubmitReportDataForm.get_instance()
-
-    for field in report.fields:
-        if field.department_id == dept_id:
-            LocalSubmitReportDataForm.add_field(field)
-
-    # *Now* the form is properly initialized
-    form = LocalSubmitReportDataForm()
+    dept_fields = [field for field in report.fields if field.department_id == dept_id]
+    LocalSubmitReportDataForm = SubmitReportDataForm.get_instance(dept_fields)
+    form = LocalSubmitReportDataForm(instance_fields=dept_fields)
     if form.validate_on_submit() and form.ds.data:
-        # Delete any old values that already existed
-        for stale_value in form.stale_values:
-            db.session.delete(stale_value)
-
-        # Also "invalidate" any existing Excel sheets that used this data
-        for data_point in form.data_points:
-            for report in data_point.field.reports:
-                report.remove_excel_files()
-
-        # Add all of the new data points
-        db.session.add_all(form.data_points)
-        db.session.commit()
+        # Write only the values that changed. This also bumps their
+        # FieldDataVersion, so cached Excel sheets of the changed months get a
+        # new key and are never served again.
+        store_data_points(form.data_points)
 
         flash(
             "Report data successfully submitted.",
@@ -224,15 +245,20 @@ def submit_report_data(report_id, ds=None, dept_id=None):
 
         # Set the change_form defaults
         change_form.date.data = datetime.strptime(ds, "%Y-%m-%d")
-        change_form.department.data = dept_id or current_user.department.id
+        change_form.department.data = dept_id or current_user.dept_id
 
+        all_series = FIELD_SERIES.get_many([field.id for field in form.instance_fields])
         for field in form.instance_fields:
             # This line allows us to dynamically load the field data
             formfield = getattr(form, field.name)
             if not formfield.data:
-                existing_value = field.data_points.filter_by(ds=ds).first()
-                if existing_value:
-                    formfield.data = existing_value.pretty_value
+                existing_value = field.get_data_for_date(
+                    ds,
+                    pretty=True,
+                    series=all_series[field.id],
+                )
+                if existing_value != "":
+                    formfield.data = existing_value
 
         chunk_size = 10
         field_list = form.instance_fields
@@ -257,6 +283,8 @@ def view_report(report_id, ds=None):
     """Show the user a specific report"""
     if ds is None:
         ds = datetime.now().strftime('%Y-%m-%d')
+    elif not valid_ds(ds):
+        abort(404)
 
     form = ChangeDateForm()
     if form.validate_on_submit():
@@ -293,12 +321,8 @@ def download_report(report_id):
 
     form = DownloadReportForm()
     if form.validate_on_submit():
-        if not report.excel_file_exists(form.start, form.end):
-            report.create_excel_file(form.start, form.end)
-        return send_file(
-            report.excel_filepath_for_ds(form.start, form.end),
-            as_attachment=True,
-        )
+        job = ExcelJob.enqueue(report, form.start, form.end)
+        return redirect(url_for('reports.download_job', job_id=job.id))
     else:
         flash_form_errors(form)
         return render_template(
@@ -308,6 +332,68 @@ def download_report(report_id):
         )
 
 
+@mod_reports.route('/download/job/<int:job_id>', methods=['GET'])
+@mod_reports.route('/download/job/<int:job_id>/', methods=['GET'])
+@login_required
+def download_job(job_id):
+    """Show the progress of an Excel download until it is ready"""
+    job = ExcelJob.query.get(job_id)
+    if job is None:
+        flash("Download not found! Please request it again.", "alert-warning")
+        return redirect(url_for('reports.my_reports'))
+
+    return render_template(
+        'reports/download_job.html',
+        job=job,
+        report=Report.query.get(job.report_id),
+    )
+
+
+@mod_reports.route('/download/job/<int:job_id>/status', methods=['GET'])
+@mod_reports.route('/download/job/<int:job_id>/status/', methods=['GET'])
+@login_required
+def download_job_status(job_id):
+    """Get the status of an Excel download as JSON"""
+    job = ExcelJob.query.get(job_id)
+    if job is None:
+        return jsonify(status=None), 404
+
+    url = None
+    if job.status == ExcelJob.DONE:
+        url = url_for('reports.download_job_file', job_id=job.id)
+    return jsonify(
+        status=job.status,
+        progress=job.progress,
+        error=job.error,
+        url=url,
+    )
+
+
+@mod_reports.route('/download/job/<int:job_id>/file', methods=['GET'])
+@mod_reports.route('/download/job/<int:job_id>/file/', methods=['GET'])
+@login_required
+def download_job_file(job_id):
+    """Download the Excel file of a finished job"""
+    job = ExcelJob.query.get(job_id)
+    report = Report.query.get(job.report_id) if job is not None else None
+    if report is None:
+        flash("Download not found! Please request it again.", "alert-warning")
+        return redirect(url_for('reports.my_reports'))
+
+    # ExcelJob.enqueue already counted this download's hit or miss
+    filepath = EXCEL_CACHE.lookup(job.key, count=False) if job.status == ExcelJob.DONE else None
+    if filepath is None:
+        # Not finished yet, or the sheet was evicted since; (re)build it
+        job = ExcelJob.enqueue(report, job.start_ds, job.end_ds)
+        return redirect(url_for('reports.download_job', job_id=job.id))
+
+    return send_file(
+        filepath,
+        as_attachment=True,
+        attachment_filename=report.generate_filename(job.start_ds, job.end_ds),
+    )
+
+
 @mod_reports.route('/delete/<int:report_id>', methods=['POST'])
 @mod_reports.route('/delete/<int:report_id>/', methods=['POST'])
 @login_required
@@ -340,6 +426,7 @@ def delete_report(report_id):
         else:
             db.session.delete(report)
             db.session.commit()
+            EXCEL_CACHE.invalidate_report(report_id)
             flash(
                 "Report deleted",
                 "alert-success",
@@ -364,12 +451,9 @@ def edit_report(report_id):
             "alert-warning",
         )
     else:
-        LocalEditReportForm = EditReportForm.get_instance()
-        for department in Department.query.all():
-            if len(department.fields) > 0:
-                LocalEditReportForm.add_department(department)
-
-        form = LocalEditReportForm()
+        departments = departments_with_fields()
+        LocalEditReportForm = EditReportForm.get_instance(departments)
+        form = LocalEditReportForm(departments=departments)
         if form.validate_on_submit():
             flash('Report: {name} has been updated'.format(name=form.report.name), 'alert-success')
             db.session.commit()
@@ -380,24 +464,130 @@ def edit_report(report_id):
             form.name.data = report.name
             form.report_id.data = report_id
             form.tags.data = ', '.join(tag.name for tag in report.tags)
-            for department in Department.query.all():
-                if len(department.fields) > 0:
-                    set_fields = [field for field in report.fields if field.department.id == department.id]
-                    getattr(form, department.name).data = [f.id for f in set_fields]
+            for department in departments:
+                set_fields = [field for field in report.fields if field.department_id == department.id]
+                getattr(form, department.name).data = [f.id for f in set_fields]
             return render_template('reports/edit.html', form=form, report=report)
 
 
+@mod_reports.route('/api/data', methods=['POST'])
+@mod_reports.route('/api/data/', methods=['POST'])
+@csrf.exempt
+def api_submit_data():
+    """Submit many report values at once from another system
+
+    The request must carry an 'Authorization: Bearer <token>' header with the
+    key of an ApiToken, and a JSON body like
+        {"data": [{"field": 12, "ds": "2016-01-31", "value": "$1,024.00"}, ...]}
+    where field is a Field id or identifier ('Department: Field') and value is
+    what would be typed into the submit form. Entries may also be given as
+    [field, ds, value] lists, and at most MAX_API_VALUES are accepted. The
+    token of an admin may write any Field; any other token only the Fields of
+    its owner's Department.
+
+    Every entry is validated before anything is written, and the valid ones
+    are stored together even if others are rejected. The number of queries
+    doesn't depend on the number of entries.
+
+    Returns {"received", "valid", "changed", "errors"}, where errors is a list
+    of {"index", "error"} for the rejected entries.
+    """
+    api_token = ApiToken.from_authorization(request.headers.get('Authorization'))
+    if api_token is None:
+        return jsonify(error='A valid API token is required'), 401
+
+    payload = request.get_json(silent=True)
+    entries = payload.get('data') if isinstance(payload, dict) else None
+    if not isinstance(entries, list):
+        return jsonify(error='Expected a JSON object with a "data" list'), 400
+    if len(entries) > MAX_API_VALUES:
+        return jsonify(
+            error='At most {} values may be sent at once'.format(MAX_API_VALUES),
+        ), 413
+
+    user = api_token.user
+    index = FieldIndex()
+    rows = []
+    errors = []
+    for idx, entry in enumerate(entries):
+        if isinstance(entry, dict):
+            entry = (entry.get('field'), entry.get('ds'), entry.get('value'))
+        if not isinstance(entry, (list, tuple)) or len(entry) != 3:
+            errors.append({'index': idx, 'error': 'Expected a field, ds and value'})
+            continue
+        field = index.find(entry[0])
+        if field is not None and not user.is_admin and field.department_id != user.dept_id:
+            errors.append({
+                'index': idx,
+                'error': 'Not allowed to submit values for {}'.format(field.identifier),
+            })
+            continue
+        row, error = prepare_row(index, *entry)
+        if error is not None:
+            errors.append({'index': idx, 'error': error})
+        elif row is not None:
+            rows.append(row)
+
+    api_token.last_used = datetime.now()
+    changed = store_data_points(rows)
+    # store_data_points doesn't commit when nothing changed
+    db.session.commit()
+
+    return jsonify(
+        received=len(entries),
+        valid=len(rows),
+        changed=len(changed),
+        errors=errors,
+    )
+
+
 @mod_reports.route('/search', methods=['GET', 'POST'])
 @mod_reports.route('/search/', methods=['GET', 'POST'])
+@mod_reports.route('/search/<int:page_num>', methods=['GET'])
+@mod_reports.route('/search/<int:page_num>/', methods=['GET'])
 @login_required
-def search():
-    """Search for reports that contains a keyword in owner,name,tag,department,location"""
-    form = SearchForm()
-    if form.validate_on_submit():
-        return render_template('reports/search_results.html', reports=form.reports)
-    else:
-        flash_form_errors(form)
-        return render_template('reports/search.html', form=form)
+def search(page_num=1):
+    """Search for reports or charts by name, owner, tag, department or field
+
+    The search boxes on the report lists POST here as the user types and get
+    back the table rows of the first page of matching reports. The search
+    page itself submits with GET, so every page of results has its own URL.
+    """
+    if request.method == 'POST':
+        form = SearchForm()
+        if form.validate_on_submit():
+            reports = search_query(Report, form.search_filters()).paginate(
+                page=1,
+                per_page=SEARCH_PAGE_SIZE,
+                error_out=False,
+            )
+            more_url = None
+            if reports.has_next:
+                args = request.form.to_dict()
+                args.pop('csrf_token', None)
+                more_url = url_for('reports.search', page_num=2, **args)
+            return render_template(
+                'reports/search_results.html',
+                reports=reports.items,
+                more_url=more_url,
+            )
+        else:
+            flash_form_errors(form)
+            return render_template('reports/search.html', form=form, results=None, args={})
+
+    form = SearchForm(request.args)
+    filters = form.search_filters()
+    model = Chart if form.kind.data == 'charts' else Report
+    results = None
+    if filters:
+        results = search_query(model, filters).paginate(
+            page=page_num,
+            per_page=SEARCH_PAGE_SIZE,
+            error_out=False,
+        )
+    args = request.args.to_dict()
+    args.pop('csrf_token', None)
+    return render_template('reports/search.html', form=form, results=results, args=args)
 
 
 @mod_reports.route('/charts', methods=['GET'])
@@ -442,21 +632,135 @@ def view_chart(chart_id):
 @mod_reports.route('/charts/get_data/<int:chart_id>/', methods=['GET'])
 @login_required
 def get_chart_data(chart_id):
-    """Retrieve more data in JSON format for a specific chart"""
+    """Retrieve more data in JSON format for a specific chart
+
+    Optional arguments:
+    granularity - 'day' (default), 'week', 'month' or 'auto' to pick the
+        finest rollup that keeps the window at a bounded number of points
+    aggregate - 'sum', 'avg', 'min', 'max' or 'last' for week/month rollups
+    """
     start = request.args.get('start')
     end = request.args.get('end')
+    granularity = request.args.get('granularity', rollups.DAY)
+    aggregate = request.args.get('aggregate')
     data = {}
 
+    valid_granularity = granularity in rollups.GRANULARITIES or granularity == rollups.AUTO
+    valid_aggregate = aggregate is None or aggregate in rollups.AGGREGATES
+    if not (valid_ds(start) and valid_ds(end)):
+        return jsonify(**data), 400
+
     chart = Chart.query.get(chart_id)
-    if chart and start and end:
-        data = chart.data_points(
-            min_date=start,
-            max_date=end,
-            ds_format=True,
+    if chart and valid_granularity and valid_aggregate:
+        data = rollups.chart_data_points(
+            chart,
+            start_ds=start,
+            end_ds=end,
+            granularity=granularity,
+            aggregate=aggregate,
         )
     return jsonify(**data)
 
 
+def charts_etag(chart_ids, start, end, granularity, aggregate):
+    """Return the ETag of the data of some charts, built from the database
+
+    It covers the labels of the charts' fields and the FieldDataVersion of
+    every month their values (or the rollup periods overlapping [start, end])
+    come from, so it is the same in every process and across restarts, and
+    computing it loads neither the charts nor their values.
+    """
+    first = to_date(start)
+    last = to_date(end)
+    if granularity == rollups.AUTO:
+        granularity = rollups.choose_granularity(first, last)
+    first = rollups.period_start(granularity, first)
+    last = rollups.period_end(granularity, rollups.period_start(granularity, last))
+
+    labels = (
+        db.session.query(chart_fields.c.chart_id, Field.id, Field.name, Department.name)
+        .join(Field, Field.id == chart_fields.c.field_id)
+        .join(Department, Department.id == Field.department_id)
+        .filter(chart_fields.c.chart_id.in_(chart_ids))
+        .order_by(chart_fields.c.chart_id, Field.id)
+        .all()
+    )
+    version = FieldDataVersion.version_for(
+        sorted(set(field_id for _, field_id, _, _ in labels)),
+        first,
+        last,
+    )
+    return hashlib.sha1(u'{ids}|{start}|{end}|{granularity}|{aggregate}|{labels}|{version}'.format(
+        ids=','.join(str(chart_id) for chart_id in chart_ids),
+        start=start,
+        end=end,
+        granularity=granularity,
+        aggregate=aggregate,
+        labels=u';'.join(u'{}:{}:{}:{}'.format(*label) for label in labels),
+        version=version,
+    ).encode('utf-8')).hexdigest()
+
+
+@mod_reports.route('/charts/get_data', methods=['GET'])
+@mod_reports.route('/charts/get_data/', methods=['GET'])
+@login_required
+def get_charts_data():
+    """Retrieve the data of several charts in JSON format with one request
+
+    Arguments:
+    ids - comma-separated ids of the charts (at most MAX_BATCH_CHARTS)
+    start - the first ds of the window
+    end - the last ds of the window
+    granularity, aggregate - as for get_chart_data
+
+    Returns {chart_id: {identifier: {ds: value}}} with numeric values. The
+    response carries an ETag from charts_etag, so a conditional GET for
+    unchanged data is answered with a 304 before any chart or value is
+    loaded.
+    """
+    start = request.args.get('start')
+    end = request.args.get('end')
+    granularity = request.args.get('granularity', rollups.DAY)
+    aggregate = request.args.get('aggregate')
+    try:
+        chart_ids = sorted(set(
+            int(chart_id) for chart_id in request.args.get('ids', '').split(',') if chart_id
+        ))
+    except ValueError:
+        chart_ids = []
+
+    valid_granularity = granularity in rollups.GRANULARITIES or granularity == rollups.AUTO
+    valid_aggregate = aggregate is None or aggregate in rollups.AGGREGATES
+    valid_ids = 0 < len(chart_ids) <= MAX_BATCH_CHARTS
+    if not (valid_ds(start) and valid_ds(end) and valid_granularity and valid_aggregate and valid_ids):
+        return jsonify(**{}), 400
+
+    etag = charts_etag(chart_ids, start, end, granularity, aggregate)
+    if etag in request.if_none_match:
+        response = make_response('', 304)
+    else:
+        charts = (
+            Chart.query
+            .filter(Chart.id.in_(chart_ids))
+            .options(db.joinedload('fields').joinedload('department'))
+            .all()
+        )
+        data = rollups.charts_data_points(
+            charts,
+            start_ds=start,
+            end_ds=end,
+            granularity=granularity,
+            aggregate=aggregate,
+        )
+        response = jsonify(**{str(chart_id): points for chart_id, points in data.items()})
+
+    response.set_etag(etag)
+    # Browsers and proxies may keep the data, but must revalidate it first
+    response.cache_control.no_cache = True
+    response.vary.add('Cookie')
+    return response
+
+
 @mod_reports.route('/charts/favorite/<int:chart_id>', methods=['POST'])
 @mod_reports.route('/charts/favorite/<int:chart_id>/', methods=['POST'])
 @login_required
@@ -510,16 +814,11 @@ def create_chart():
     Otherwise, render the template to show the user the create chart page.
     """
 
-    LocalCreateChartForm = CreateChartForm.get_instance()
-    for department in Department.query.all():
-        if len(department.fields) > 0:
-            LocalCreateChartForm.add_department(department)
-
-    form = LocalCreateChartForm()
+    departments = departments_with_fields()
+    LocalCreateChartForm = CreateChartForm.get_instance(departments)
+    form = LocalCreateChartForm(departments=departments)
     form.user_id.data = current_user.id
-    form.chart_type.choices = [
-        (ctype.id, ctype.name.upper()) for ctype in ChartType.query.all()
-    ]
+    form.chart_type.choices = CHART_TYPES.choices()
     if form.validate_on_submit():
         # Add the new chart to the database
         db.session.add(form.chart)
@@ -581,15 +880,10 @@ def edit_chart(chart_id):
             "alert-warning",
         )
     else:
-        LocalEditChartForm = EditChartForm.get_instance()
-        for department in Department.query.all():
-            if len(department.fields) > 0:
-                LocalEditChartForm.add_department(department)
-
-        form = LocalEditChartForm()
-        form.chart_type.choices = [
-            (ctype.id, ctype.name.upper()) for ctype in ChartType.query.all()
-        ]
+        departments = departments_with_fields()
+        LocalEditChartForm = EditChartForm.get_instance(departments)
+        form = LocalEditChartForm(departments=departments)
+        form.chart_type.choices = CHART_TYPES.choices()
         if form.validate_on_submit():
             flash('Chart: {name} has been updated'.format(name=form.chart.name), 'alert-success')
             db.session.commit()
@@ -602,8 +896,7 @@ def edit_chart(chart_id):
             form.chart_type.data = chart.ctype.id
             form.with_table.data = chart.with_table
             form.tags.data = ', '.join(tag.name for tag in chart.tags)
-            for department in Department.query.all():
-                if len(department.fields) > 0:
-                    set_fields = [field for field in chart.fields if field.department.id == department.id]
-                    getattr(form, department.name).data = [f.id for f in set_fields]
+            for department in departments:
+                set_fields = [field for field in chart.fields if field.department_id == department.id]
+                getattr(form, department.name).data = [f.id for f in set_fields]
             return render_template('reports/edit_chart.html', form=form, chart=chart)
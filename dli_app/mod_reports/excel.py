@@ -0,0 +1,329 @@
+"""Cache of generated Excel sheets for the reports module
+
+Author: Logan Gore
+This file is responsible for keeping generated Report workbooks on disk so a
+repeated download doesn't rebuild them. A sheet is keyed by the report, the
+names of its fields and their departments, the date range and the
+FieldDataVersion of that range, so any change to the data, to the report or to
+a name printed on the sheet produces a new key and old sheets are simply never
+served again. An index table records every sheet with
+its size and last access time, which drives LRU eviction by total bytes and by
+age.
+"""
+
+import bisect
+import collections
+import datetime
+import hashlib
+import os
+import tempfile
+import threading
+import traceback
+
+from dli_app import app
+from dli_app import db
+
+from dli_app.mod_auth.models import Department
+
+from dli_app.mod_reports.models import DS_FORMAT
+from dli_app.mod_reports.models import Field
+from dli_app.mod_reports.models import FieldDataVersion
+from dli_app.mod_reports.models import IN_BATCH
+from dli_app.mod_reports.models import report_fields
+
+
+EXCEL_FILE_DIR = os.path.join(
+    os.path.abspath(os.path.dirname(__file__)),
+    "excel-files",
+)
+
+
+class ExcelCacheEntry(db.Model):
+    """Model for the index entry of a cached Excel sheet"""
+    __tablename__ = "excel_cache_entry"
+    id = db.Column(db.Integer, primary_key=True)
+    key = db.Column(db.String(64), unique=True)
+    report_id = db.Column(db.Integer, index=True)
+    start_ds = db.Column(db.String(10))
+    end_ds = db.Column(db.String(10))
+    filename = db.Column(db.String(128))
+    size = db.Column(db.BigInteger)
+    created = db.Column(db.DateTime)
+    last_access = db.Column(db.DateTime, index=True)
+
+    def __repr__(self):
+        """Return a descriptive representation of an ExcelCacheEntry"""
+        return '<ExcelCacheEntry {filename}>'.format(filename=self.filename)
+
+
+class ExcelCache(object):
+    """Size- and age-bounded cache of generated Excel sheets
+
+    Arguments:
+    directory - where the sheets are written
+    max_bytes - total size of all sheets to keep before evicting the least
+        recently downloaded ones
+    max_age - a timedelta; sheets not downloaded for this long are evicted
+
+    Sheets are written to a temporary file in the same directory and renamed
+    into place, so a concurrent download never sees a partial file. Sheets
+    made stale by new data are removed by a background thread; see
+    invalidate_data.
+    """
+
+    def __init__(self, directory, max_bytes, max_age):
+        """Initialize an ExcelCache"""
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._pending = set()
+        self._pending_cond = threading.Condition()
+        self._invalidator = None
+
+    def key_for(self, report, start_ds, end_ds):
+        """Return the cache key of a Report's sheet for the given range"""
+        labels = (
+            db.session.query(Field.id, Field.name, Department.name)
+            .join(report_fields, report_fields.c.field_id == Field.id)
+            .join(Department, Department.id == Field.department_id)
+            .filter(report_fields.c.report_id == report.id)
+            .order_by(Field.id)
+            .all()
+        )
+        version = FieldDataVersion.version_for(
+            [field_id for field_id, _, _ in labels],
+            start_ds,
+            end_ds,
+        )
+        identity = u'{report_id}:{name}:{fields}:{start}:{end}:{version}'.format(
+            report_id=report.id,
+            name=report.name,
+            fields=u';'.join(u'{}:{}:{}'.format(*label) for label in labels),
+            start=start_ds,
+            end=end_ds,
+            version=version,
+        )
+        return hashlib.sha1(identity.encode('utf-8')).hexdigest()
+
+    def lookup(self, key, count=True):
+        """Return the path of the sheet cached under a key (or None)
+
+        Pass count=False for a second lookup of the same download, so it
+        isn't counted as a hit or miss twice.
+        """
+        entry = ExcelCacheEntry.query.filter_by(key=key).first()
+        if entry is not None:
+            filepath = os.path.join(self.directory, entry.filename)
+            if os.path.exists(filepath):
+                entry.last_access = datetime.datetime.now()
+                db.session.commit()
+                if count:
+                    with self._lock:
+                        self.hits += 1
+                return filepath
+            # Someone removed the file from under the index
+            db.session.delete(entry)
+            db.session.commit()
+
+        if count:
+            with self._lock:
+                self.misses += 1
+        return None
+
+    def path_for(self, report, start_ds, end_ds, progress=None):
+        """Return the path of a Report's sheet, generating it on a miss"""
+        key = self.key_for(report, start_ds, end_ds)
+        return self.lookup(key) or self.generate(report, start_ds, end_ds, key, progress)
+
+    def generate(self, report, start_ds, end_ds, key, progress=None):
+        """Write a Report's sheet atomically and record it under a key
+
+        progress is passed through to Report.create_excel_file.
+        """
+        filename = 'report-{report_id}-{start}-to-{end}-{key}.xlsx'.format(
+            report_id=report.id,
+            start=start_ds,
+            end=end_ds,
+            key=key[:12],
+        )
+        filepath = os.path.join(self.directory, filename)
+
+        handle, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.xlsx.tmp')
+        os.close(handle)
+        try:
+            report.create_excel_file(start_ds, end_ds, tmp_path, progress)
+            os.rename(tmp_path, filepath)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+
+        now = datetime.datetime.now()
+        # Another process may have generated the same key in the meantime
+        entry = ExcelCacheEntry.query.filter_by(key=key).first()
+        if entry is None:
+            entry = ExcelCacheEntry(key=key, created=now)
+            db.session.add(entry)
+        entry.report_id = report.id
+        entry.start_ds = start_ds
+        entry.end_ds = end_ds
+        entry.filename = filename
+        entry.size = os.path.getsize(filepath)
+        entry.last_access = now
+        db.session.commit()
+
+        self.evict()
+        return filepath
+
+    def evict(self):
+        """Remove sheets that are too old, then the LRU ones over max_bytes"""
+        expired = ExcelCacheEntry.query.filter(
+            ExcelCacheEntry.last_access < datetime.datetime.now() - self.max_age,
+        ).all()
+        self._remove(expired)
+
+        total = db.session.query(db.func.sum(ExcelCacheEntry.size)).scalar() or 0
+        if total <= self.max_bytes:
+            return
+        victims = []
+        for entry in ExcelCacheEntry.query.order_by(ExcelCacheEntry.last_access):
+            if total <= self.max_bytes:
+                break
+            victims.append(entry)
+            total -= entry.size
+        self._remove(victims)
+
+    def invalidate_data(self, changes):
+        """Queue the removal of the sheets made stale by changed values
+
+        changes is an iterable of (field_id, ds) pairs. This returns right
+        away; a background thread calls remove_covering with every change
+        queued since it last ran, so a burst of submissions is handled once.
+        """
+        changes = set(
+            (field_id, ds.strftime(DS_FORMAT) if hasattr(ds, 'strftime') else ds)
+            for field_id, ds in changes
+        )
+        if not changes:
+            return
+        with self._pending_cond:
+            self._pending.update(changes)
+            if self._invalidator is None or not self._invalidator.is_alive():
+                self._invalidator = threading.Thread(target=self._invalidate_forever)
+                self._invalidator.daemon = True
+                self._invalidator.start()
+            self._pending_cond.notify()
+
+    def flush_invalidations(self):
+        """Run any queued invalidations in the calling thread
+
+        Short-lived processes (like import_data.py) call this before exiting,
+        since the background thread dies with them.
+        """
+        with self._pending_cond:
+            changes, self._pending = self._pending, set()
+        if changes:
+            self.remove_covering(changes)
+
+    def _invalidate_forever(self):
+        """Run remove_covering on queued changes as they come in"""
+        while True:
+            with self._pending_cond:
+                while not self._pending:
+                    self._pending_cond.wait()
+                changes, self._pending = self._pending, set()
+            try:
+                self.remove_covering(changes)
+            except Exception:  # pylint: disable=broad-except
+                traceback.print_exc()
+            finally:
+                db.session.remove()
+
+    def remove_covering(self, changes):
+        """Remove the sheets whose [start, end] covers a changed value
+
+        Only sheets of the Reports that contain a changed Field are touched,
+        and only if a changed ds falls within their range. The affected
+        Reports are found with one query and their sheets with one more
+        (per IN_BATCH of each), and the ranges are checked here, so a
+        backfill of years of dates doesn't build a query too large for the
+        database.
+        """
+        dates_by_field = collections.defaultdict(set)
+        for field_id, ds in changes:
+            dates_by_field[field_id].add(ds)
+        if not dates_by_field:
+            return
+
+        dates_by_report = collections.defaultdict(set)
+        field_ids = sorted(dates_by_field)
+        for n in range(0, len(field_ids), IN_BATCH):
+            for field_id, report_id in db.session.query(
+                    report_fields.c.field_id,
+                    report_fields.c.report_id,
+            ).filter(report_fields.c.field_id.in_(field_ids[n:n + IN_BATCH])):
+                dates_by_report[report_id].update(dates_by_field[field_id])
+        if not dates_by_report:
+            return
+
+        sorted_dates = {
+            report_id: sorted(dates) for report_id, dates in dates_by_report.items()
+        }
+        report_ids = sorted(sorted_dates)
+        stale = []
+        for n in range(0, len(report_ids), IN_BATCH):
+            for entry in ExcelCacheEntry.query.filter(
+                    ExcelCacheEntry.report_id.in_(report_ids[n:n + IN_BATCH]),
+            ):
+                dates = sorted_dates[entry.report_id]
+                # The first changed ds on or after the sheet's start
+                idx = bisect.bisect_left(dates, entry.start_ds)
+                if idx < len(dates) and dates[idx] <= entry.end_ds:
+                    stale.append(entry)
+        self._remove(stale)
+
+    def invalidate_report(self, report_id):
+        """Remove every cached sheet of a Report"""
+        self._remove(ExcelCacheEntry.query.filter_by(report_id=report_id).all())
+
+    def _remove(self, entries):
+        """Delete the given entries and their files"""
+        if not entries:
+            return
+        for entry in entries:
+            try:
+                os.remove(os.path.join(self.directory, entry.filename))
+            except OSError:
+                # Already removed by another process
+                pass
+            db.session.delete(entry)
+        db.session.commit()
+        with self._lock:
+            self.evictions += len(entries)
+
+    def stats(self):
+        """Return a dict of counters describing the cache"""
+        files, size = db.session.query(
+            db.func.count(ExcelCacheEntry.id),
+            db.func.sum(ExcelCacheEntry.size),
+        ).one()
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'files': files,
+                'bytes': size or 0,
+                'max_bytes': self.max_bytes,
+                'max_age_days': self.max_age.days,
+            }
+
+
+EXCEL_CACHE = ExcelCache(
+    directory=EXCEL_FILE_DIR,
+    max_bytes=app.config.get('EXCEL_CACHE_MAX_BYTES', 512 * 1024 * 1024),
+    max_age=datetime.timedelta(days=app.config.get('EXCEL_CACHE_MAX_AGE_DAYS', 7)),
+)
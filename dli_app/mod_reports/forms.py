@@ -4,6 +4,8 @@ Author: Logan Gore
 This file lists all forms to be filled out from within the reports module.
 """
 
+import threading
+
 from datetime import datetime
 
 from flask_wtf import Form
@@ -28,10 +30,9 @@ from dli_app.mod_auth.models import User
 
 from dli_app.mod_reports.models import Chart
 from dli_app.mod_reports.models import ChartType
-from dli_app.mod_reports.models import ChartTypeConstants
 from dli_app.mod_reports.models import Field
 from dli_app.mod_reports.models import FieldData
-from dli_app.mod_reports.models import FieldTypeConstants
+from dli_app.mod_reports.models import FieldType
 from dli_app.mod_reports.models import Report
 from dli_app.mod_reports.models import Tag
 
@@ -119,11 +120,146 @@ class ListField(FormField):
             self.data = []
 
 
+def _currency_formfield(name):
+    """Create the form field used to submit a currency value"""
+    return TextField(
+        name,
+        validators=[
+            validators.Optional(),
+            SplitNumValidator(
+                split='.',
+                filter_chars="$,",
+                max_parts=2,
+                parts_message=(
+                    "Currency must be in the format "
+                    "'dollars.cents'"
+                ),
+            ),
+        ],
+        filters=[lambda x: x or None],
+    )
+
+
+def _double_formfield(name):
+    """Create the form field used to submit a double value"""
+    return DecimalField(
+        name,
+        validators=[validators.Optional()],
+        filters=[lambda x: x or None],
+    )
+
+
+def _integer_formfield(name):
+    """Create the form field used to submit an integer value"""
+    return IntegerField(
+        name,
+        validators=[validators.Optional()],
+        filters=[lambda x: x or None],
+    )
+
+
+def _string_formfield(name):
+    """Create the form field used to submit a string value"""
+    return TextField(
+        name,
+        validators=[validators.Optional()],
+        filters=[lambda x: x or None],
+    )
+
+
+def _time_formfield(name):
+    """Create the form field used to submit a time value"""
+    return TextField(
+        name,
+        validators=[
+            validators.Optional(),
+            SplitNumValidator(
+                split=':',
+                filter_chars="ms",
+                max_parts=2,
+                parts_message=(
+                    "Time must be in the format 'min:sec'"
+                ),
+            ),
+        ],
+        filters=[lambda x: x or None],
+    )
+
+
+_FORMFIELD_FACTORIES = {
+    FieldType.CURRENCY: _currency_formfield,
+    FieldType.DOUBLE: _double_formfield,
+    FieldType.INTEGER: _integer_formfield,
+    FieldType.STRING: _string_formfield,
+    FieldType.TIME: _time_formfield,
+}
+
+
+# Dynamic form classes, built once per (base form, schema). A class is never
+# modified after it is cached, so concurrent requests can share it safely.
+_FORM_CLASSES = {}
+_FORM_CLASSES_LOCK = threading.Lock()
+MAX_CACHED_FORM_CLASSES = 256
+
+
+def _cached_form_class(base, schema, formfields):
+    """Return the subclass of base with the given dynamic form fields
+
+    Arguments:
+    base - the form class to extend
+    schema - a hashable description of everything formfields depends on
+    formfields - callable returning [(attribute name, unbound form field)]
+    """
+    key = (base, schema)
+    with _FORM_CLASSES_LOCK:
+        form_class = _FORM_CLASSES.get(key)
+        if form_class is None:
+            if len(_FORM_CLASSES) >= MAX_CACHED_FORM_CLASSES:
+                # Renamed fields leave old schemas behind; start over
+                _FORM_CLASSES.clear()
+
+            class LocalForm(base):
+                """Local copy of a form with fields only known at runtime"""
+                pass
+
+            for name, formfield in formfields():
+                setattr(LocalForm, name, formfield)
+            LocalForm.__name__ = 'Local' + base.__name__
+            _FORM_CLASSES[key] = form_class = LocalForm
+    return form_class
+
+
+def _department_form_class(base, departments):
+    """Return the subclass of base with a field picker for each department"""
+    schema = tuple(
+        (department.name, tuple((field.id, field.name) for field in department.fields))
+        for department in departments
+    )
+    return _cached_form_class(
+        base,
+        schema,
+        lambda: [
+            (name, SelectMultipleField(
+                name,
+                choices=list(choices),
+                coerce=int,
+                option_widget=widgets.CheckboxInput(),
+                widget=widgets.ListWidget(prefix_label=False),
+            ))
+            for name, choices in schema
+        ],
+    )
+
+
 class CreateReportForm(Form):
     """A form for creating a new report"""
 
     def __init__(self, *args, **kwargs):
-        """Initialize the create report form"""
+        """Initialize the create report form
+
+        Pass departments=[...] with the departments given to get_instance.
+        """
+        self.departments = kwargs.pop('departments', [])
         Form.__init__(self, *args, **kwargs)
         self.report = None
 
@@ -141,82 +277,53 @@ class CreateReportForm(Form):
         ],
     )
 
-    @classmethod
-    def get_instance(cls):
-        """Return a new class instance of a LocalCreateReportForm"""
-        return cls.generate_local_create_report_form()
-
-    @classmethod
-    def generate_local_create_report_form(cls):
-        """Dynamically generate a class for the SubmitReportDataForm"""
-        class LocalCreateReportForm(CreateReportForm):
-            """Local copy of a CreateReportForm
-
-            This class represents a dynamic CreateReportForm since we don't
-            know what fields are available until runtime. Form more info,
-            see LocalSubmitReportDataForm below.
-            """
-
-            departments = []
-            def __init__(self, *args, **kwargs):
-                """Initialize the local form"""
-                CreateReportForm.__init__(self, *args, **kwargs)
-                self.departments = [
-                    dept for dept in LocalCreateReportForm.departments
-                ]
-                LocalCreateReportForm.departments = []
-
-            def validate(self):
-                """Validate the form"""
-                res = True
-                if not Form.validate(self):
-                    res = False
+    def validate(self):
+        """Validate the form"""
+        res = True
+        if not Form.validate(self):
+            res = False
 
-                report_fields = Field.query.filter(Field.id.in_([int(f) for f in self.fields.data if f])).all()
+        report_fields = Field.query.filter(Field.id.in_([int(f) for f in self.fields.data if f])).all()
 
-                tags = [
-                    Tag.get_or_create(tag.strip()) for tag in self.tags.data
-                    if tag.strip()
-                ]
+        tags = [
+            Tag.get_or_create(tag.strip()) for tag in self.tags.data
+            if tag.strip()
+        ]
 
-                user = User.query.get(self.user_id.data)
-                if not user:
-                    self.user_id.errors.append("User not found!")
-                    res = False
+        user = User.query.get(self.user_id.data)
+        if not user:
+            self.user_id.errors.append("User not found!")
+            res = False
 
-                self.report = Report(
-                    user=user,
-                    name=self.name.data,
-                    fields=report_fields,
-                    tags=tags,
-                )
+        self.report = Report(
+            user=user,
+            name=self.name.data,
+            fields=report_fields,
+            tags=tags,
+        )
 
-                return res
-
-            @classmethod
-            def add_department(cls, department):
-                """Add the given department to this form dynamically"""
-                cls.departments.append(department)
-                formfield = SelectMultipleField(
-                    department.name,
-                    choices=[
-                        (field.id, field.name) for field in department.fields
-                    ],
-                    coerce=int,
-                    option_widget=widgets.CheckboxInput(),
-                    widget=widgets.ListWidget(prefix_label=False),
-                )
+        return res
 
-                setattr(cls, department.name, formfield)
+    @classmethod
+    def get_instance(cls, departments):
+        """Return the LocalCreateReportForm class for the given departments
 
-        return LocalCreateReportForm
+        We don't know what fields are available until runtime, so the class
+        gets a field picker for each department. Classes are cached by the
+        departments' names and fields; see _cached_form_class.
+        """
+        return _department_form_class(cls, departments)
 
 
 class CreateChartForm(Form):
     """A form for creating new charts"""
 
     def __init__(self, *args, **kwargs):
-        """Initialize the create chart form"""
+        """Initialize the create chart form
+
+        Pass departments=[...] with the departments given to get_instance.
+        """
+        self.departments = kwargs.pop('departments', [])
         Form.__init__(self, *args, **kwargs)
         self.chart = None
 
@@ -241,96 +348,65 @@ class CreateChartForm(Form):
 
     with_table = BooleanField('Include table?')
 
-    @classmethod
-    def get_instance(cls):
-        """Return a new class instance of a LocalCreateChartForm"""
-        return cls.generate_local_create_chart_form()
+    def validate(self):
+        """Validate the form"""
+        res = True
+        if not Form.validate(self):
+            res = False
 
-    @classmethod
-    def generate_local_create_chart_form(cls):
-        """Dynamically generate a class for the LocalCreateChartForm"""
-        class LocalCreateChartForm(CreateChartForm):
-            """Local copy of a CreateChartForm
-
-            This class represents a dynamic CreateChartForm since we don't
-            know what fields are available until runtime. Form more info,
-            see LocalSubmitReportDataForm.
-            """
-
-            departments = []
-            def __init__(self, *args, **kwargs):
-                """Initialize the local form"""
-                CreateChartForm.__init__(self, *args, **kwargs)
-                self.departments = [
-                    dept for dept in LocalCreateChartForm.departments
-                ]
-                LocalCreateChartForm.departments = []
-
-            def validate(self):
-                """Validate the form"""
-                res = True
-                if not Form.validate(self):
-                    res = False
+        chart_fields = Field.query.filter(Field.id.in_([int(f) for f in self.fields.data if f])).all()
+        tags = [
+            Tag.get_or_create(tag.strip()) for tag in self.tags.data
+            if tag.strip()
+        ]
 
-                chart_fields = Field.query.filter(Field.id.in_([int(f) for f in self.fields.data if f])).all()
-                tags = [
-                    Tag.get_or_create(tag.strip()) for tag in self.tags.data
-                    if tag.strip()
-                ]
+        user = User.query.get(self.user_id.data)
+        if not user:
+            self.user_id.errors.append("User not found!")
+            res = False
 
-                user = User.query.get(self.user_id.data)
-                if not user:
-                    self.user_id.errors.append("User not found!")
-                    res = False
+        ctype = ChartType.query.get(self.chart_type.data)
+        if not ctype:
+            self.chart_type.errors.append("Chart Type not found!")
+            res = False
 
-                ctype = ChartType.query.get(self.chart_type.data)
-                if not ctype:
-                    self.chart_type.errors.append("Chart Type not found!")
-                    res = False
+        if not len(chart_fields):
+            self.with_table.errors.append("You've created an empty chart!")
+            res = False
 
-                if not len(chart_fields):
-                    self.with_table.errors.append("You've created an empty chart!")
-                    res = False
+        if not self.with_table.data and ctype and ctype.name == ChartType.TABLE_ONLY:
+            # It's a fair assumption that the user actually wanted a table
+            self.with_table.data = True
 
-                if not self.with_table.data and ctype == ChartTypeConstants.TABLE_ONLY:
-                    # It's a fair assumption that the user actually wanted a table
-                    self.with_table.data = True
-
-                self.chart = Chart(
-                    name=self.name.data,
-                    with_table=self.with_table.data,
-                    user=user,
-                    ctype=ctype,
-                    fields=chart_fields,
-                    tags=tags,
-                )
+        self.chart = Chart(
+            name=self.name.data,
+            with_table=self.with_table.data,
+            user=user,
+            ctype=ctype,
+            fields=chart_fields,
+            tags=tags,
+        )
 
-                return res
-
-            @classmethod
-            def add_department(cls, department):
-                """Add the given department to this form dynamically"""
-                cls.departments.append(department)
-                formfield = SelectMultipleField(
-                    department.name,
-                    choices=[
-                        (field.id, field.name) for field in department.fields
-                    ],
-                    coerce=int,
-                    option_widget=widgets.CheckboxInput(),
-                    widget=widgets.ListWidget(prefix_label=False),
-                )
+        return res
 
-                setattr(cls, department.name, formfield)
+    @classmethod
+    def get_instance(cls, departments):
+        """Return the LocalCreateChartForm class for the given departments
 
-        return LocalCreateChartForm
+        See CreateReportForm.get_instance.
+        """
+        return _department_form_class(cls, departments)
 
 
 class EditChartForm(Form):
     """A form for editing new charts"""
 
     def __init__(self, *args, **kwargs):
-        """Initialize the edit chart form"""
+        """Initialize the edit chart form
+
+        Pass departments=[...] with the departments given to get_instance.
+        """
+        self.departments = kwargs.pop('departments', [])
         Form.__init__(self, *args, **kwargs)
         self.chart = None
 
@@ -355,76 +431,41 @@ class EditChartForm(Form):
 
     with_table = BooleanField('Include table?')
 
-    @classmethod
-    def get_instance(cls):
-        """Return a new class instance of a LocalEditChartForm"""
-        return cls.generate_local_edit_chart_form()
+    def validate(self):
+        """Validate the form"""
 
-    @classmethod
-    def generate_local_edit_chart_form(cls):
-        """Dynamically generate a class for the LocalEditChartForm"""
-        class LocalEditChartForm(EditChartForm):
-            """Local copy of a EditChartForm
-
-            This class represents a dynamic EditChartForm since we don't
-            know what fields are available until runtime. Form more info,
-            see LocalSubmitReportDataForm.
-            """
-
-            departments = []
-            def __init__(self, *args, **kwargs):
-                """Initialize the local form"""
-                EditChartForm.__init__(self, *args, **kwargs)
-                self.departments = [
-                    dept for dept in LocalEditChartForm.departments
-                ]
-                LocalEditChartForm.departments = []
-
-            def validate(self):
-                """Validate the form"""
-
-                if not Form.validate(self):
-                    return False
-
-                self.chart = Chart.query.get(self.chart_id.data)
-
-                chart_fields = Field.query.filter(Field.id.in_([int(f) for f in self.fields.data if f])).all()
-                tags = [
-                    Tag.get_or_create(tag.strip()) for tag in self.tags.data
-                    if tag.strip()
-                ]
-
-                res = True
-                ctype = ChartType.query.get(self.chart_type.data)
-                if not ctype:
-                    self.chart_type.errors.append("Chart Type not found!")
-                    res = False
+        if not Form.validate(self):
+            return False
 
-                self.chart.name = self.name.data
-                self.chart.with_table = self.with_table.data
-                self.chart.ctype = ctype
-                self.chart.fields = chart_fields
-                self.chart.tags = tags
-
-                return res
-
-            @classmethod
-            def add_department(cls, department):
-                """Add the given department to this form dynamically"""
-                cls.departments.append(department)
-                formfield = SelectMultipleField(
-                    department.name,
-                    choices=[
-                        (field.id, field.name) for field in department.fields
-                    ],
-                    coerce=int,
-                    option_widget=widgets.CheckboxInput(),
-                    widget=widgets.ListWidget(prefix_label=False),
-                )
+        self.chart = Chart.query.get(self.chart_id.data)
 
-                setattr(cls, department.name, formfield)
+        chart_fields = Field.query.filter(Field.id.in_([int(f) for f in self.fields.data if f])).all()
+        tags = [
+            Tag.get_or_create(tag.strip()) for tag in self.tags.data
+            if tag.strip()
+        ]
 
-        return LocalEditChartForm
+        res = True
+        ctype = ChartType.query.get(self.chart_type.data)
+        if not ctype:
+            self.chart_type.errors.append("Chart Type not found!")
+            res = False
+
+        self.chart.name = self.name.data
+        self.chart.with_table = self.with_table.data
+        self.chart.ctype = ctype
+        self.chart.fields = chart_fields
+        self.chart.tags = tags
+
+        return res
+
+    @classmethod
+    def get_instance(cls, departments):
+        """Return the LocalEditChartForm class for the given departments
+
+        See CreateReportForm.get_instance.
+        """
+        return _department_form_class(cls, departments)
 
 
 class SubmitReportDataForm(Form):
@@ -433,126 +474,64 @@ class SubmitReportDataForm(Form):
     ds = HiddenField()
 
     def __init__(self, *args, **kwargs):
-        """Initialize the submit report data form"""
+        """Initialize the submit report data form
+
+        Pass instance_fields=[...] with the Fields given to get_instance.
+        """
+        self.instance_fields = kwargs.pop('instance_fields', [])
         Form.__init__(self, *args, **kwargs)
         self.data_points = []
-        self.stale_values = []
+        self.submitted_fields = []
 
-    @classmethod
-    def get_instance(cls):
-        """Return a new class instance of a LocalSubmitReportDataForm"""
-        return cls.generate_local_submit_report_data_form()
+    def validate(self):
+        """Validate the form"""
+        res = True
+        if not Form.validate(self):
+            res = False
 
-    @classmethod
-    def generate_local_submit_report_data_form(cls):
-        """Dynamically generate a class for the SubmitReportDataForm"""
-        class LocalSubmitReportDataForm(SubmitReportDataForm):
-            """Local copy of a SubmitReportDataForm
-
-            Class that represents a specific SubmitReportDataForm
-            This is needed because a SubmitReportDataForm only needs fields
-            for the user's specific department. It is a massive waste of
-            resources to generate each and every field when we know the user
-            will only submit the ones related to his or her department. This
-            allows us to dynamically load the fields needed for submission
-            DURING run-time.
-            """
-
-            fields = []
-            def __init__(self, *args, **kwargs):
-                """Initialize the local form"""
-                SubmitReportDataForm.__init__(self, *args, **kwargs)
-                self.instance_fields = [
-                    field for field in LocalSubmitReportDataForm.fields
-                ]
-                LocalSubmitReportDataForm.fields = []
-
-            def validate(self):
-                """Validate the form"""
-                res = True
-                if not Form.validate(self):
+        for field in self.instance_fields:
+            formfield = getattr(self, field.name)
+            if formfield.data is not None and not formfield.errors:
+                # Build the new data point. Any old value for this
+                # field and ds is overwritten by FieldData.upsert
+                try:
+                    data_point = FieldData.make_row(
+                        ds=self.ds.data,
+                        field=field,
+                        value=formfield.data,
+                    )
+                except ValueError:
+                    formfield.errors.append('{} is not a valid {} value'.format(
+                        formfield.data,
+                        field.type_name,
+                    ))
                     res = False
+                    continue
+                self.data_points.append(data_point)
+                self.submitted_fields.append(field)
 
-                for field in self.instance_fields:
-                    formfield = getattr(self, field.name)
-                    if formfield.data is not None:
-                        # Check for any old values that should now be deleted
-                        stale_value = field.data_points.filter_by(
-                            ds=self.ds.data,
-                        ).first()
-                        if stale_value is not None:
-                            self.stale_values.append(stale_value)
-
-                        # Create the new data point
-                        data_point = FieldData(
-                            ds=self.ds.data,
-                            field=field,
-                            value=formfield.data,
-                        )
-                        self.data_points.append(data_point)
-
-                return res
-
-            @classmethod
-            def add_field(cls, field):
-                """Add the given field to this form dynamically"""
-                cls.fields.append(field)
-                formfield = None
-                FieldTypeConstants.reload()
-                if field.ftype == FieldTypeConstants.CURRENCY:
-                    formfield = TextField(
-                        field.name,
-                        validators=[
-                            validators.Optional(),
-                            SplitNumValidator(
-                                split='.',
-                                filter_chars="$,",
-                                max_parts=2,
-                                parts_message=(
-                                    "Currency must be in the format "
-                                    "'dollars.cents'"
-                                ),
-                            ),
-                        ],
-                        filters=[lambda x: x or None],
-                    )
-                elif field.ftype == FieldTypeConstants.DOUBLE:
-                    formfield = DecimalField(
-                        field.name,
-                        validators=[validators.Optional()],
-                        filters=[lambda x: x or None],
-                    )
-                elif field.ftype == FieldTypeConstants.INTEGER:
-                    formfield = IntegerField(
-                        field.name,
-                        validators=[validators.Optional()],
-                        filters=[lambda x: x or None],
-                    )
-                elif field.ftype == FieldTypeConstants.STRING:
-                    formfield = TextField(
-                        field.name,
-                        validators=[validators.Optional()],
-                        filters=[lambda x: x or None],
-                    )
-                elif field.ftype == FieldTypeConstants.TIME:
-                    formfield = TextField(
-                        field.name,
-                        validators=[
-                            validators.Optional(),
-                            SplitNumValidator(
-                                split=':',
-                                filter_chars="ms",
-                                max_parts=2,
-                                parts_message=(
-                                    "Time must be in the format 'min:sec'"
-                                ),
-                            ),
-                        ],
-                        filters=[lambda x: x or None],
-                    )
-                setattr(cls, field.name, formfield)
+        return res
 
-        return LocalSubmitReportDataForm
+    @classmethod
+    def get_instance(cls, fields):
+        """Return the LocalSubmitReportDataForm class for the given Fields
+
+        A SubmitReportDataForm only needs form fields for the user's specific
+        department. It is a massive waste of resources to generate each and
+        every field when we know the user will only submit the ones related to
+        his or her department, so the class is built DURING run-time from the
+        Fields' names and types (and cached by them).
+        """
+        schema = tuple((field.name, field.type_name) for field in fields)
+        return _cached_form_class(
+            cls,
+            schema,
+            lambda: [
+                (name, _FORMFIELD_FACTORIES[type_name](name))
+                for name, type_name in schema
+                if type_name in _FORMFIELD_FACTORIES
+            ],
+        )
 
 
 class ChangeDateForm(Form):
@@ -619,7 +598,11 @@ class EditReportForm(Form):
     """A form for creating a new report"""
 
     def __init__(self, *args, **kwargs):
-        """Initialize the edit report form"""
+        """Initialize the edit report form
+
+        Pass departments=[...] with the departments given to get_instance.
+        """
+        self.departments = kwargs.pop('departments', [])
         Form.__init__(self, *args, **kwargs)
         self.report = None
 
@@ -637,117 +620,132 @@ class EditReportForm(Form):
     fields = ListField()
     tags = ListField()
 
-    @classmethod
-    def get_instance(cls):
-        """Return a new class instance of a LocalEditReportForm"""
-        return cls.generate_local_edit_report_form()
+    def validate(self):
+        """Validate the form"""
+        if not Form.validate(self):
+            return False
 
-    @classmethod
-    def generate_local_edit_report_form(cls):
-        """Dynamically generate a class for the EditReportDataForm"""
-        class LocalEditReportForm(EditReportForm):
-            """Local copy of a EditReportForm
-
-            This class represents a dynamic EditReportForm since we don't
-            know what fields are available until runtime. For more info,
-            see LocalSubmitReportDataForm.
-            """
-
-            departments = []
-            def __init__(self, *args, **kwargs):
-                """Initialize the local form"""
-                EditReportForm.__init__(self, *args, **kwargs)
-                self.departments = [
-                    dept for dept in LocalEditReportForm.departments
-                ]
-                LocalEditReportForm.departments = []
-
-            def validate(self):
-                """Validate the form"""
-                if not Form.validate(self):
-                    return False
-
-                self.report = Report.query.get(self.report_id.data)
-
-                report_fields = Field.query.filter(Field.id.in_([int(f) for f in self.fields.data if f])).all()
-                tags = [
-                    Tag.get_or_create(tag.strip()) for tag in self.tags.data
-                    if tag.strip()
-                ]
-
-                self.report.name = self.name.data
-                self.report.fields = report_fields
-                self.report.tags = tags
-
-                return True
-
-            @classmethod
-            def add_department(cls, department):
-                """Add the given department to this form dynamically"""
-                cls.departments.append(department)
-                formfield = SelectMultipleField(
-                    department.name,
-                    choices=[
-                        (field.id, field.name) for field in department.fields
-                    ],
-                    coerce=int,
-                    option_widget=widgets.CheckboxInput(),
-                    widget=widgets.ListWidget(prefix_label=False),
-                )
+        self.report = Report.query.get(self.report_id.data)
+
+        report_fields = Field.query.filter(Field.id.in_([int(f) for f in self.fields.data if f])).all()
+        tags = [
+            Tag.get_or_create(tag.strip()) for tag in self.tags.data
+            if tag.strip()
+        ]
 
-                setattr(cls, department.name, formfield)
+        self.report.name = self.name.data
+        self.report.fields = report_fields
+        self.report.tags = tags
+
+        return True
+
+    @classmethod
+    def get_instance(cls, departments):
+        """Return the LocalEditReportForm class for the given departments
 
-        return LocalEditReportForm
+        See CreateReportForm.get_instance.
+        """
+        return _department_form_class(cls, departments)
 
 
 class SearchForm(Form):
-    """Form to search for a report"""
+    """Form to search for reports or charts
+
+    search_text is matched against the filter picked in filter_choices, and
+    any of the other text fields that are filled in narrow the results
+    further; see search_filters.
+    """
     REPORTNAME_CHOICE = 0
     OWNER_CHOICE = 1
     EMAIL_CHOICE = 2
     TAG_CHOICE = 3
+    ANY_CHOICE = 4
+    DEPARTMENT_CHOICE = 5
+    FIELD_CHOICE = 6
+
+    # {filter_choices value: search.FILTERS name}
+    CHOICE_FILTERS = {
+        REPORTNAME_CHOICE: 'name',
+        OWNER_CHOICE: 'owner',
+        EMAIL_CHOICE: 'owner',
+        TAG_CHOICE: 'tag',
+        ANY_CHOICE: 'text',
+        DEPARTMENT_CHOICE: 'department',
+        FIELD_CHOICE: 'field',
+    }
 
     def __init__(self, *args, **kwargs):
         """Initialize the SearchForm object"""
         Form.__init__(self, *args, **kwargs)
-        self.reports = []
 
     def validate(self):
         """Validate the form"""
         if not Form.validate(self):
             return False
 
-        choice = self.filter_choices.data
-        search_text = "%{}%".format(self.search_text.data)
-        if choice == self.OWNER_CHOICE:
-            self.reports = Report.query.join(User, Report.user).filter(User.name.ilike(search_text)).all()
-        elif choice == self.EMAIL_CHOICE:
-            self.reports = Report.query.join(User, Report.user).filter(User.email.ilike(search_text)).all()
-        elif choice == self.REPORTNAME_CHOICE:
-            self.reports = Report.query.filter(Report.name.ilike(search_text)).all()
-        elif choice == self.TAG_CHOICE:
-            self.reports = Report.query.join(Tag, Report.tags).filter(Tag.name.ilike(search_text)).all()
-        else:
+        if self.filter_choices.data not in self.CHOICE_FILTERS:
             self.filter_choices.errors.append('Not a valid choice!')
             return False
 
         return True
 
+    def search_filters(self):
+        """Return the {filter: text} to pass to search.search_query"""
+        filters = {}
+        text = (self.search_text.data or '').strip()
+        if text and self.filter_choices.data in self.CHOICE_FILTERS:
+            filters[self.CHOICE_FILTERS[self.filter_choices.data]] = text
+        for name in ('name', 'owner', 'tag', 'department', 'field'):
+            text = (getattr(self, name).data or '').strip()
+            if text:
+                filters[name] = text
+        return filters
+
+    kind = SelectField(
+        "Search for",
+        choices=[('reports', 'Reports'), ('charts', 'Charts')],
+        default='reports',
+    )
+
     filter_choices = SelectField(
         "Filter by",
         choices=[
+            (ANY_CHOICE, 'Anything'),
             (REPORTNAME_CHOICE, 'Report Name'),
             (OWNER_CHOICE, 'Owner Name'),
             (EMAIL_CHOICE, 'Owner Email'),
-            (TAG_CHOICE, 'Tag')
+            (TAG_CHOICE, 'Tag'),
+            (DEPARTMENT_CHOICE, 'Department'),
+            (FIELD_CHOICE, 'Field'),
         ],
         coerce=int,
+        default=ANY_CHOICE,
     )
 
     search_text = TextField(
         "Search",
     )
 
+    name = TextField(
+        "Name",
+    )
+
+    owner = TextField(
+        "Owner name or email",
+    )
+
+    tag = TextField(
+        "Tag",
+    )
+
+    department = TextField(
+        "Department",
+    )
+
+    field = TextField(
+        "Field",
+    )
+
 
 class DownloadReportForm(Form):
     """Form to download report data"""
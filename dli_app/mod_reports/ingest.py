@@ -0,0 +1,201 @@
+"""Storing submitted report data for the reports module
+
+Author: Logan Gore
+This file is responsible for the one path every submitted FieldData value
+takes into the database, whichever page, API or tool it came from. Values are
+diffed against what is already stored, and only the changed ones are written
+with a single bulk upsert before the caches and rollups built from them are
+brought up to date. The number of round trips doesn't grow with the number of
+values submitted.
+"""
+
+import collections
+import datetime
+import decimal
+import numbers
+
+from dli_app import db
+
+from dli_app.mod_reports.excel import EXCEL_CACHE
+from dli_app.mod_reports.models import DS_FORMAT
+from dli_app.mod_reports.models import FIELD_SERIES
+from dli_app.mod_reports.models import Field
+from dli_app.mod_reports.models import FieldData
+from dli_app.mod_reports.models import FieldType
+from dli_app.mod_reports.models import IN_BATCH
+from dli_app.mod_reports.models import to_date
+from dli_app.mod_reports.rollups import FieldDataRollup
+
+
+class FieldIndex(object):
+    """Every Field, looked up by id or by identifier ('Department: Field')
+
+    All Fields are loaded with one query up front, so any number of records
+    can be resolved without touching the DB again.
+    """
+
+    def __init__(self):
+        """Initialize a FieldIndex"""
+        fields = Field.query.options(db.joinedload('department')).all()
+        self.by_id = {field.id: field for field in fields}
+        self.by_identifier = {field.identifier: field for field in fields}
+
+    def find(self, ref):
+        """Return the Field for an id or identifier (or None)"""
+        if isinstance(ref, numbers.Integral) and not isinstance(ref, bool):
+            return self.by_id.get(ref)
+        if not hasattr(ref, 'strip'):
+            return None
+        ref = ref.strip()
+        if ref.isdigit():
+            return self.by_id.get(int(ref))
+        return self.by_identifier.get(ref)
+
+
+def _normalize_value(type_name, value):
+    """Turn a value read from a file or JSON into what the form would send
+
+    Returns None for an empty value.
+    """
+    if value is None:
+        return None
+    if isinstance(value, numbers.Number) and not isinstance(value, bool):
+        if type_name == FieldType.CURRENCY:
+            return '{:.2f}'.format(value)
+        elif type_name == FieldType.TIME:
+            # A bare number of seconds
+            return '{:d}'.format(int(value))
+        elif type_name == FieldType.STRING:
+            return '{}'.format(value)
+        elif type_name == FieldType.INTEGER:
+            if value != int(value):
+                # The form rejects '5.7' too, rather than storing 5
+                raise ValueError('not a whole number')
+            return int(value)
+        return value
+    if isinstance(value, datetime.time):
+        if value.second:
+            # A real h:mm:ss duration; write it as 'min:sec'
+            seconds = value.hour * 3600 + value.minute * 60 + value.second
+            value = '{}:{:02d}'.format(seconds // 60, seconds % 60)
+        else:
+            # Spreadsheets turn a typed '5:30' into a time cell of 5:30:00
+            value = '{}:{:02d}'.format(value.hour, value.minute)
+    value = value.strip()
+    return value or None
+
+
+def prepare_row(index, ref, ds, value):
+    """Validate one (field, ds, value) record and build its row
+
+    Arguments:
+    index - a FieldIndex
+    ref - the id or identifier of a Field
+    ds - a 'YYYY-MM-DD' string or a date
+    value - the value as it would be typed into the submit form (numbers
+        are accepted too)
+
+    Values are parsed with the same rules as FieldData.__init__. Returns
+    (row, None) for a valid record, (None, error message) for an invalid
+    one, and (None, None) for a record with an empty value.
+    """
+    field = index.find(ref)
+    if field is None:
+        return None, 'Unknown field {!r}'.format(ref)
+
+    try:
+        date = to_date(ds)
+    except (TypeError, ValueError):
+        date = None
+    if date is None:
+        return None, 'Invalid ds {!r}, expected YYYY-MM-DD'.format(ds)
+
+    try:
+        value = _normalize_value(field.type_name, value)
+        if value is None:
+            return None, None
+        return FieldData.make_row(date, field, value), None
+    except (AttributeError, TypeError, ValueError, decimal.InvalidOperation):
+        return None, 'Invalid {type} value {value!r} for {field}'.format(
+            type=field.type_name,
+            value=value,
+            field=field.identifier,
+        )
+
+
+def _row_key(field_id, ds):
+    """Return the (field_id, 'YYYY-MM-DD') key of a value"""
+    if hasattr(ds, 'strftime'):
+        ds = ds.strftime(DS_FORMAT)
+    return field_id, ds
+
+
+def changed_rows(rows):
+    """Return the rows whose value differs from the one already stored
+
+    Arguments:
+    rows - a list of dicts as built by FieldData.make_row; if the same field
+        and ds appear more than once, the last row wins
+
+    The stored values are prefetched with one query per IN_BATCH fields,
+    each limited to the range of dates submitted for those fields, so the
+    number of bound parameters stays small however many values come in.
+    """
+    latest = collections.OrderedDict()
+    for row in rows:
+        latest[_row_key(row['field_id'], row['ds'])] = row
+    if not latest:
+        return []
+
+    dates_by_field = collections.defaultdict(list)
+    for field_id, ds in latest:
+        dates_by_field[field_id].append(ds)
+    field_ids = sorted(dates_by_field)
+
+    existing = {}
+    for n in range(0, len(field_ids), IN_BATCH):
+        batch = field_ids[n:n + IN_BATCH]
+        dates = [ds for field_id in batch for ds in dates_by_field[field_id]]
+        for field_id, ds, ivalue, dvalue, svalue in db.session.query(
+                FieldData.field_id,
+                FieldData.ds,
+                FieldData.ivalue,
+                FieldData.dvalue,
+                FieldData.svalue,
+        ).filter(
+            FieldData.field_id.in_(batch),
+            FieldData.ds >= min(dates),
+            FieldData.ds <= max(dates),
+        ):
+            key = _row_key(field_id, ds)
+            if key in latest:
+                existing[key] = (ivalue, dvalue, svalue)
+    return [
+        row for key, row in latest.items()
+        if existing.get(key) != (row['ivalue'], row['dvalue'], row['svalue'])
+    ]
+
+
+def store_data_points(rows):
+    """Write submitted values and update everything derived from them
+
+    Unchanged values are skipped. The changed ones are upserted (which also
+    bumps their FieldDataVersion) and the weekly and monthly rollups
+    covering them are refreshed, all in one transaction, so the rollups
+    can't be left behind the data. Once that commits, FIELD_SERIES is
+    invalidated for their fields and the cached Excel sheets covering them
+    are queued for removal.
+
+    Returns the list of rows that actually changed.
+    """
+    rows = changed_rows(rows)
+    if not rows:
+        return rows
+
+    FieldData.upsert(rows)
+    FieldDataRollup.refresh((row['field_id'], row['ds']) for row in rows)
+    db.session.commit()
+
+    FIELD_SERIES.invalidate(set(row['field_id'] for row in rows))
+    EXCEL_CACHE.invalidate_data((row['field_id'], row['ds']) for row in rows)
+    return rows
@@ -0,0 +1,192 @@
+"""Background Excel generation jobs for the reports module
+
+Author: Logan Gore
+This file is responsible for moving Excel generation out of the request
+thread. The download page enqueues an ExcelJob and polls its status while a
+pool of worker processes (see excel_worker.py) claims queued jobs from the
+excel_job table and writes the sheets into EXCEL_CACHE. Jobs are keyed by the
+Excel cache key, so identical requests made while a sheet is being built all
+collapse into the same job.
+"""
+
+import datetime
+import sys
+import time
+import traceback
+
+from sqlalchemy.exc import IntegrityError
+
+from dli_app import db
+
+from dli_app.mod_reports.excel import EXCEL_CACHE
+from dli_app.mod_reports.models import Report
+
+
+# A running job that hasn't reported progress for this long is assumed to
+# belong to a dead worker and is put back on the queue
+STALE_AFTER = datetime.timedelta(minutes=10)
+
+# Finished jobs are forgotten after this long; their sheets stay in the cache
+KEEP_FINISHED_FOR = datetime.timedelta(days=1)
+
+# How often each worker looks for stale and old finished jobs
+HOUSEKEEPING_INTERVAL = datetime.timedelta(minutes=1)
+
+
+class ExcelJob(db.Model):
+    """Model for a request to generate a Report's Excel sheet"""
+    __tablename__ = "excel_job"
+
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    id = db.Column(db.Integer, primary_key=True)
+    key = db.Column(db.String(64), unique=True)
+    report_id = db.Column(db.Integer)
+    start_ds = db.Column(db.String(10))
+    end_ds = db.Column(db.String(10))
+    status = db.Column(db.String(8), index=True)
+    progress = db.Column(db.Integer, default=0)
+    error = db.Column(db.String(256))
+    created = db.Column(db.DateTime)
+    updated = db.Column(db.DateTime)
+
+    def __repr__(self):
+        """Return a descriptive representation of an ExcelJob"""
+        return '<ExcelJob {id} {status}>'.format(id=self.id, status=self.status)
+
+    @property
+    def finished(self):
+        """Whether or not the job will make any more progress"""
+        return self.status in (self.DONE, self.FAILED)
+
+    @classmethod
+    def enqueue(cls, report, start_ds, end_ds):
+        """Return a job for a Report's sheet, creating one only if needed
+
+        If a job for the same sheet is already queued or running, that job is
+        returned. If the sheet is already cached, the job is returned as done
+        without involving a worker at all.
+        """
+        key = EXCEL_CACHE.key_for(report, start_ds, end_ds)
+        job = cls.query.filter_by(key=key).first()
+        if job is not None and job.status in (cls.QUEUED, cls.RUNNING):
+            return job
+
+        cached = EXCEL_CACHE.lookup(key) is not None
+        now = datetime.datetime.now()
+        if job is None:
+            job = cls(
+                key=key,
+                report_id=report.id,
+                start_ds=start_ds,
+                end_ds=end_ds,
+                created=now,
+            )
+            db.session.add(job)
+        job.status = cls.DONE if cached else cls.QUEUED
+        job.progress = 100 if cached else 0
+        job.error = None
+        job.updated = now
+
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # Someone else enqueued the same sheet at the same moment
+            db.session.rollback()
+            job = cls.query.filter_by(key=key).one()
+        return job
+
+    @classmethod
+    def housekeep(cls):
+        """Requeue the jobs of dead workers and forget old finished jobs"""
+        now = datetime.datetime.now()
+        db.session.execute(
+            cls.__table__.update()
+            .where(cls.status == cls.RUNNING)
+            .where(cls.updated < now - STALE_AFTER)
+            .values(status=cls.QUEUED, progress=0)
+        )
+        db.session.execute(
+            cls.__table__.delete()
+            .where(cls.status.in_([cls.DONE, cls.FAILED]))
+            .where(cls.updated < now - KEEP_FINISHED_FOR)
+        )
+        db.session.commit()
+
+    @classmethod
+    def claim(cls):
+        """Take the oldest queued job for this worker (or return None)"""
+        now = datetime.datetime.now()
+        for job in cls.query.filter_by(status=cls.QUEUED).order_by(cls.id).limit(10):
+            # Only one worker can win the queued -> running transition
+            claimed = db.session.execute(
+                cls.__table__.update()
+                .where(cls.id == job.id)
+                .where(cls.status == cls.QUEUED)
+                .values(status=cls.RUNNING, updated=now)
+            ).rowcount
+            db.session.commit()
+            if claimed:
+                return cls.query.get(job.id)
+        return None
+
+    def run(self):
+        """Generate the sheet for this job and record the outcome"""
+        job_id = self.id
+        report = Report.query.get(self.report_id)
+        try:
+            if report is None:
+                raise ValueError("Report no longer exists")
+            EXCEL_CACHE.generate(
+                report,
+                self.start_ds,
+                self.end_ds,
+                self.key,
+                progress=lambda done, total: set_progress(job_id, done, total),
+            )
+            self.status = self.DONE
+            self.progress = 100
+        except Exception as e:  # pylint: disable=broad-except
+            traceback.print_exc()
+            db.session.rollback()
+            self.status = self.FAILED
+            self.error = str(e)[:256]
+        self.updated = datetime.datetime.now()
+        db.session.commit()
+
+
+def set_progress(job_id, done, total):
+    """Record the progress of a running job
+
+    This runs on its own connection so it never disturbs the worker's
+    session while a sheet is being streamed.
+    """
+    db.engine.execute(
+        ExcelJob.__table__.update()
+        .where(ExcelJob.id == job_id)
+        .values(
+            progress=100 * done // total if total else 0,
+            updated=datetime.datetime.now(),
+        )
+    )
+
+
+def work(poll_interval):
+    """Claim and run ExcelJobs forever"""
+    next_housekeeping = time.time()
+    while True:
+        if time.time() >= next_housekeeping:
+            ExcelJob.housekeep()
+            next_housekeeping = time.time() + HOUSEKEEPING_INTERVAL.total_seconds()
+        job = ExcelJob.claim()
+        if job is None:
+            # End the transaction so the next poll sees new jobs
+            db.session.remove()
+            time.sleep(poll_interval)
+            continue
+        sys.stdout.write('Running {}\n'.format(job))
+        sys.stdout.flush()
+        job.run()
@@ -6,14 +6,33 @@ This file is responsible for defining models that belong in the reports module.
 
 import collections
 import datetime
-import glob
 import os
+import tempfile
+import threading
+import time
 
 import xlsxwriter
 
+from sqlalchemy import and_
+from sqlalchemy import event
+from sqlalchemy import text
+from sqlalchemy import type_coerce
+from sqlalchemy.types import TypeDecorator
+
+from dli_app import app
 from dli_app import db
 
-EXCEL_FILE_DIR = "excel-files"
+from dli_app.instrumentation import QueryCounter
+
+from dli_app.mod_reports.cache import FieldSeriesCache
+from dli_app.mod_reports.cache import ordinal_to_ds
+
+from dli_app.stamp import StampFile
+
+DS_FORMAT = '%Y-%m-%d'
+
+# The most ids put in one IN list (SQLite allows 999 parameters per query)
+IN_BATCH = 500
 
 report_fields = db.Table(
     'report_fields',
@@ -43,6 +62,107 @@ chart_tags = db.Table(
 )
 
 
+class DateStamp(TypeDecorator):
+    """A native DATE column that keeps the app's 'YYYY-MM-DD' string API
+
+    Values may be bound as ds strings or date objects, and are always loaded
+    back as ds strings, so comparisons like FieldData.ds >= '2015-10-01' keep
+    working while the database stores (and indexes) a real DATE.
+    """
+
+    impl = db.Date
+
+    def process_bind_param(self, value, dialect):
+        """Convert a ds string (or datetime) into a date for the DB"""
+        return to_date(value)
+
+    def process_result_value(self, value, dialect):
+        """Convert a date from the DB back into a ds string"""
+        if value is None:
+            return None
+        return value.strftime(DS_FORMAT)
+
+
+def to_date(ds):
+    """Convert a ds string, datetime or date into a date (or None)"""
+    if ds is None or ds == '':
+        return None
+    if isinstance(ds, datetime.datetime):
+        return ds.date()
+    if isinstance(ds, datetime.date):
+        return ds
+    return datetime.datetime.strptime(ds, DS_FORMAT).date()
+
+
+def valid_ds(ds):
+    """Return whether a ds string (say, from a URL) can be converted to a date"""
+    try:
+        return to_date(ds) is not None
+    except (TypeError, ValueError):
+        return False
+
+
+def upsert_rows(table, keys, values, rows, increments=()):
+    """Insert or overwrite many rows of a table with one statement
+
+    Arguments:
+    table - the Table to write to
+    keys - names of the columns of a unique constraint on the table
+    values - names of the columns to overwrite when a key already exists
+    rows - a list of dicts with an entry for every key and value column
+    increments - names of the columns to add to (rather than overwrite)
+        when a key already exists; rows need an entry for these too
+
+    The statement runs in the current session's transaction; the caller is
+    responsible for committing.
+    """
+    if not rows:
+        return
+
+    dialect = db.session.get_bind().dialect.name
+    columns = tuple(keys) + tuple(values) + tuple(increments)
+    insert = "INSERT INTO {table} ({cols}) VALUES ({params})".format(
+        table=table.name,
+        cols=', '.join(columns),
+        params=', '.join(':' + col for col in columns),
+    )
+    if dialect == 'mysql':
+        statement = insert + " ON DUPLICATE KEY UPDATE " + ', '.join(
+            ['{col} = VALUES({col})'.format(col=col) for col in values] +
+            ['{col} = {col} + VALUES({col})'.format(col=col) for col in increments]
+        )
+    elif dialect in ('sqlite', 'postgresql'):
+        statement = insert + " ON CONFLICT ({keys}) DO UPDATE SET {sets}".format(
+            keys=', '.join(keys),
+            sets=', '.join(
+                ['{col} = excluded.{col}'.format(col=col) for col in values] +
+                ['{col} = {table}.{col} + excluded.{col}'.format(col=col, table=table.name)
+                 for col in increments]
+            ),
+        )
+    else:
+        # No native upsert: clear the conflicting keys, then insert
+        conflicts = db.or_(*[
+            and_(*[table.c[key] == row[key] for key in keys])
+            for row in rows
+        ])
+        if increments:
+            existing = {
+                tuple(old[key] for key in keys): old
+                for old in db.session.execute(table.select().where(conflicts))
+            }
+            rows = [dict(row) for row in rows]
+            for row in rows:
+                old = existing.get(tuple(row[key] for key in keys))
+                if old is not None:
+                    for col in increments:
+                        row[col] += old[col] or 0
+        db.session.execute(table.delete().where(conflicts))
+        statement = insert
+
+    db.session.execute(text(statement), rows)
+
+
 def generate_date_list(start, end, step=None):
     """Generate a ds list along an interval"""
     if not step:
@@ -94,12 +214,102 @@ class Tag(db.Model):
         return tag
 
 
+class TypeRegistry(object):
+    """Process-wide, id-keyed snapshot of a type table (FieldType/ChartType)
+
+    Type rows almost never change, but every value lookup needs to know the
+    type of its Field. The registry loads the whole table once per process
+    into plain dicts of {id: name} and {name: id} so type dispatch becomes a
+    dictionary lookup with no DB access. The snapshot is never mutated in
+    place; invalidate() simply drops it and the next lookup reloads it.
+
+    Arguments:
+    model - the type model
+    stamp_path - optional StampFile path bumped when a write to the table
+        commits; other processes (like the other serve.py workers) drop their
+        snapshot within check_interval seconds of that
+    check_interval - the most seconds between looks at the stamp, which keeps
+        lookups free of file access
+    """
+
+    def __init__(self, model, stamp_path=None, check_interval=1.0):
+        """Initialize a TypeRegistry for the given type model"""
+        self.model = model
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._stamp = StampFile(stamp_path)
+        self._next_check = 0
+        self._written = False
+
+    def _load(self):
+        """Return the current (by_id, by_name) snapshot, loading it if needed"""
+        now = time.time()
+        if now >= self._next_check:
+            with self._lock:
+                if now >= self._next_check:
+                    self._next_check = now + self.check_interval
+                    if self._stamp.changed():
+                        self._snapshot = None
+        snapshot = self._snapshot
+        if snapshot is None:
+            with self._lock:
+                snapshot = self._snapshot
+                if snapshot is None:
+                    rows = db.session.query(self.model.id, self.model.name).all()
+                    snapshot = (
+                        {type_id: name for type_id, name in rows},
+                        {name: type_id for type_id, name in rows},
+                    )
+                    self._snapshot = snapshot
+        return snapshot
+
+    def name_of(self, type_id):
+        """Return the name of the type with the given id (or None)"""
+        return self._load()[0].get(type_id)
+
+    def id_of(self, name):
+        """Return the id of the type with the given name (or None)"""
+        return self._load()[1].get(name)
+
+    def choices(self):
+        """Return (id, NAME) pairs suitable for a SelectField"""
+        return sorted(
+            (type_id, name.upper()) for type_id, name in self._load()[0].items()
+        )
+
+    def invalidate(self, *_):
+        """Drop the snapshot so the next lookup reloads it from the DB
+
+        Other processes are told once the write commits; see publish().
+        """
+        self._snapshot = None
+        self._written = True
+
+    def publish(self, *_):
+        """Session event hook: tell other processes about a committed write"""
+        if not self._written:
+            return
+        with self._lock:
+            self._written = False
+            # This process may have reloaded before the commit, too
+            self._snapshot = None
+            self._stamp.bump()
+
+
 class FieldType(db.Model):
     """Model for the type of a Field"""
     __tablename__ = "field_type"
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(32), index=True)
 
+    # Names of the types the app knows how to store and display
+    CURRENCY = 'currency'
+    DOUBLE = 'double'
+    INTEGER = 'integer'
+    STRING = 'string'
+    TIME = 'time'
+
     def __init__(self, name):
         """Initialize a FieldType model"""
         self.name = name
@@ -116,8 +326,13 @@ class FieldType(db.Model):
 class FieldData(db.Model):
     """Model for the actual data stored in a Field"""
     __tablename__ = "field_data"
+    __table_args__ = (
+        # A Field has at most one value per day; this also serves as the
+        # (field_id, ds) index for every per-field date lookup
+        db.UniqueConstraint('field_id', 'ds', name='uq_field_data_field_id_ds'),
+    )
     id = db.Column(db.Integer, primary_key=True)
-    ds = db.Column(db.String(16), index=True)
+    ds = db.Column(DateStamp, index=True)
     field_id = db.Column(db.Integer, db.ForeignKey("field.id"))
     ivalue = db.Column(db.BigInteger)
     dvalue = db.Column(db.Float)
@@ -125,89 +340,238 @@ class FieldData(db.Model):
 
     def __init__(self, ds, field, value):
         """Initialize a FieldData model"""
-        FieldTypeConstants.reload()
         self.ds = ds
         self.field = field
 
         # Type checking should have already been done from the form
-        if self.field.ftype == FieldTypeConstants.CURRENCY:
-            parts = value.replace(',', '').replace('$', '').split('.')
-            # Convert the value into cents to avoid any floating-point issues
-            self.ivalue = int(parts[0]) * 100
-            if len(parts) == 2:
-                self.ivalue += int(parts[1])
-        elif self.field.ftype == FieldTypeConstants.DOUBLE:
-            self.dvalue = value
-        elif self.field.ftype == FieldTypeConstants.INTEGER:
-            self.ivalue = value
-        elif self.field.ftype == FieldTypeConstants.STRING:
-            self.svalue = value
-        elif self.field.ftype == FieldTypeConstants.TIME:
-            # Convert the value into seconds for convenience
-            if ':' in value:
-                parts = value.split(':')
-            elif '.' in value:
-                # Some people use '.' to denote minutes/seconds
-                parts = value.split('.')
-            else:
-                # If no : or ., assume the value listed is seconds
-                parts = ['0', value]
-
-            # If the user listed something like ':00', make sure we can still parse
-            parts = [x or '0' for x in parts]
-            self.ivalue = int(parts[0]) * 60
-            if len(parts) == 2:
-                self.ivalue += int(parts[1])
+        for column, column_value in parse_value(field.type_name, value).items():
+            setattr(self, column, column_value)
+
+    @classmethod
+    def make_row(cls, ds, field, value):
+        """Build a plain row dict (suitable for FieldData.upsert) for a value"""
+        row = parse_value(field.type_name, value)
+        row['field_id'] = field.id
+        row['ds'] = to_date(ds)
+        return row
+
+    @classmethod
+    def upsert(cls, rows):
+        """Insert or overwrite many FieldData rows with one statement
+
+        Arguments:
+        rows - a list of dicts with field_id, ds, ivalue, dvalue and svalue
+        keys (see FieldData.make_row)
+
+        The (field_id, ds) unique constraint lets the DB resolve conflicts
+        itself, so no stale values need to be looked up and deleted first.
+        The statement runs in the current session's transaction; the caller
+        is responsible for committing.
+        """
+        upsert_rows(
+            cls.__table__,
+            keys=('field_id', 'ds'),
+            values=('ivalue', 'dvalue', 'svalue'),
+            rows=rows,
+        )
+        FieldDataVersion.bump((row['field_id'], row['ds']) for row in rows)
 
     def __repr__(self):
         """Return a descriptive representation of a FieldData"""
         return '<FieldData of %r>' % self.field.name
 
+    @property
+    def raw_value(self):
+        """Property to retrieve the column this FieldData's value is stored in"""
+        column = STORAGE_COLUMNS.get(self.field.type_name)
+        return getattr(self, column) if column else None
+
     @property
     def value(self):
         """Property to easily retrieve the FieldData's value"""
-        FieldTypeConstants.reload()
-        ftype = self.field.ftype
-        if ftype == FieldTypeConstants.CURRENCY:
-            return float(self.ivalue) / 100
-        elif ftype == FieldTypeConstants.DOUBLE:
-            return self.dvalue
-        elif ftype == FieldTypeConstants.INTEGER:
-            return self.ivalue
-        elif ftype == FieldTypeConstants.STRING:
-            return self.svalue
-        elif ftype == FieldTypeConstants.TIME:
-            return self.ivalue
-        else:
-            raise NotImplementedError("ERROR: Type %s not supported!" % ftype)
+        return format_value(self.field.type_name, self.raw_value)
 
     @property
     def pretty_value(self):
         """Property to easily retrieve a human-readable FieldData model"""
-        FieldTypeConstants.reload()
-        ftype = self.field.ftype
-        if ftype == FieldTypeConstants.CURRENCY:
-            dollars = self.ivalue / 100
-            cents = self.ivalue % 100
-            return "${dollars}.{cents:02d}".format(
-                dollars=dollars,
-                cents=cents,
-            )
-        elif ftype == FieldTypeConstants.DOUBLE:
-            return self.dvalue
-        elif ftype == FieldTypeConstants.INTEGER:
-            return self.ivalue
-        elif ftype == FieldTypeConstants.STRING:
-            return self.svalue
-        elif ftype == FieldTypeConstants.TIME:
-            mins = self.ivalue / 60
-            secs = self.ivalue % 60
-            return "{mins}:{secs:02d}".format(
-                mins=mins,
-                secs=secs,
-            )
-        else:
-            raise NotImplementedError("ERROR: Type %s not supported!" % ftype)
+        return format_pretty_value(self.field.type_name, self.raw_value)
+
+
+def parse_value(type_name, value):
+    """Convert a submitted value into FieldData column values
+
+    Returns a dict with ivalue, dvalue and svalue keys, only one of which is
+    set, according to the storage rules of the given FieldType name.
+    """
+    row = {'ivalue': None, 'dvalue': None, 'svalue': None}
+    parser = _VALUE_PARSERS.get(type_name)
+    if parser is not None:
+        row[STORAGE_COLUMNS[type_name]] = parser(value)
+    return row
+
+
+def format_value(type_name, raw):
+    """Convert a stored (raw) value into the value of a FieldType name"""
+    getter = _VALUE_GETTERS.get(type_name)
+    if getter is None:
+        raise NotImplementedError("ERROR: Type %s not supported!" % type_name)
+    return getter(raw)
+
+
+def format_pretty_value(type_name, raw):
+    """Convert a stored (raw) value into a human-readable string"""
+    getter = _PRETTY_VALUE_GETTERS.get(type_name)
+    if getter is None:
+        raise NotImplementedError("ERROR: Type %s not supported!" % type_name)
+    return getter(raw)
+
+
+def _parse_currency(value):
+    """Parse a currency string into an integer number of cents"""
+    value = value.replace(',', '').replace('$', '').strip()
+    sign = 1
+    if value.startswith('-'):
+        sign = -1
+        value = value[1:]
+    dollars, _, cents = value.partition('.')
+    if not (dollars + cents).isdigit() or len(cents) > 2:
+        raise ValueError('Invalid currency value: {!r}'.format(value))
+    # Convert the value into cents to avoid any floating-point issues.
+    # '1.5' is a dollar fifty, not a dollar and five cents.
+    return sign * (int(dollars or '0') * 100 + int(cents.ljust(2, '0')))
+
+
+def _parse_time(value):
+    """Parse a 'min:sec' string into an integer number of seconds"""
+    # Convert the value into seconds for convenience
+    if ':' in value:
+        parts = value.split(':')
+    elif '.' in value:
+        # Some people use '.' to denote minutes/seconds
+        parts = value.split('.')
+    else:
+        # If no : or ., assume the value listed is seconds
+        parts = ['0', value]
+
+    # If the user listed something like ':00', make sure we can still parse
+    parts = [x or '0' for x in parts]
+    seconds = int(parts[0]) * 60
+    if len(parts) == 2:
+        seconds += int(parts[1])
+    return seconds
+
+
+def _pretty_currency(cents):
+    """Format a value stored in cents as dollars"""
+    return "{sign}${dollars}.{cents:02d}".format(
+        sign='-' if cents < 0 else '',
+        dollars=abs(cents) // 100,
+        cents=abs(cents) % 100,
+    )
+
+
+def _pretty_time(seconds):
+    """Format a value stored in seconds as 'min:sec'"""
+    return "{mins}:{secs:02d}".format(
+        mins=seconds // 60,
+        secs=seconds % 60,
+    )
+
+
+def _identity(raw):
+    """Return a stored value unchanged"""
+    return raw
+
+
+# The FieldData column each FieldType name is stored in
+STORAGE_COLUMNS = {
+    FieldType.CURRENCY: 'ivalue',
+    FieldType.DOUBLE: 'dvalue',
+    FieldType.INTEGER: 'ivalue',
+    FieldType.STRING: 'svalue',
+    FieldType.TIME: 'ivalue',
+}
+
+_VALUE_PARSERS = {
+    FieldType.CURRENCY: _parse_currency,
+    FieldType.DOUBLE: float,
+    FieldType.INTEGER: int,
+    FieldType.STRING: _identity,
+    FieldType.TIME: _parse_time,
+}
+
+_VALUE_GETTERS = {
+    FieldType.CURRENCY: lambda cents: float(cents) / 100,
+    FieldType.DOUBLE: _identity,
+    FieldType.INTEGER: _identity,
+    FieldType.STRING: _identity,
+    FieldType.TIME: _identity,
+}
+
+_PRETTY_VALUE_GETTERS = {
+    FieldType.CURRENCY: _pretty_currency,
+    FieldType.DOUBLE: _identity,
+    FieldType.INTEGER: _identity,
+    FieldType.STRING: _identity,
+    FieldType.TIME: _pretty_time,
+}
+
+
+class FieldDataVersion(db.Model):
+    """Model for a counter of changes to a Field's data within one month
+
+    Every FieldData.upsert bumps the counter of each month it touches, so
+    anything derived from a range of data (like a cached Excel sheet) can
+    tell whether that range changed without reading the data itself.
+    """
+    __tablename__ = "field_data_version"
+    __table_args__ = (
+        db.UniqueConstraint(
+            'field_id', 'period_start',
+            name='uq_field_data_version_field_id_period_start',
+        ),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    field_id = db.Column(db.Integer, db.ForeignKey("field.id"))
+    period_start = db.Column(DateStamp)
+    version = db.Column(db.Integer, default=0)
+
+    def __repr__(self):
+        """Return a descriptive representation of a FieldDataVersion"""
+        return '<FieldDataVersion {start} of field {field_id}: {version}>'.format(
+            start=self.period_start,
+            field_id=self.field_id,
+            version=self.version,
+        )
+
+    @classmethod
+    def bump(cls, changes):
+        """Increment the version of every month touched by (field_id, ds) pairs"""
+        months = set(
+            (field_id, to_date(ds).replace(day=1))
+            for field_id, ds in changes
+        )
+        upsert_rows(
+            cls.__table__,
+            keys=('field_id', 'period_start'),
+            values=(),
+            increments=('version',),
+            rows=[
+                {'field_id': field_id, 'period_start': start, 'version': 1}
+                for field_id, start in sorted(months)
+            ],
+        )
+
+    @classmethod
+    def version_for(cls, field_ids, start_ds, end_ds):
+        """Return a number that changes whenever the given data range does"""
+        if not field_ids:
+            return 0
+        return db.session.query(db.func.sum(cls.version)).filter(
+            cls.field_id.in_(field_ids),
+            cls.period_start >= to_date(start_ds).replace(day=1),
+            cls.period_start <= to_date(end_ds),
+        ).scalar() or 0
 
 
 class Field(db.Model):
@@ -223,6 +587,10 @@ class Field(db.Model):
         backref='field',
         lazy='dynamic',
     )
+    data_versions = db.relationship(
+        FieldDataVersion,
+        cascade='all, delete-orphan',
+    )
 
     def __init__(self, name, ftype, department):
         """Initialize a Field model"""
@@ -234,21 +602,51 @@ class Field(db.Model):
         """Return a descriptive representation of a Field"""
         return '<Field %r>' % self.name
 
-    def get_data_for_date(self, ds, pretty=False):
-        """Retrieve the FieldData instance for the given date stamp"""
-        data_point = self.data_points.filter_by(ds=ds).first()
-        if pretty:
-            if data_point is not None:
-                data_point = data_point.pretty_value
-            else:
-                data_point = ""
-        return data_point
+    def get_data_for_date(self, ds, pretty=False, series=None):
+        """Retrieve the FieldData instance for the given date stamp
+
+        If pretty is set, return the human-readable value instead (or "" if
+        there is none), read from FIELD_SERIES rather than the DB. A series
+        already fetched with FIELD_SERIES.get_many may be passed in.
+        """
+        if not pretty:
+            return self.data_points.filter_by(ds=ds).first()
+
+        if series is None:
+            series = FIELD_SERIES.get(self.id)
+        raw = series.on(to_date(ds))
+        if raw is None:
+            return ""
+        return format_pretty_value(self.type_name, raw)
+
+    def values_between(self, start_ds, end_ds, series=None):
+        """Return a list of (ds, value) between two date stamps (inclusive)
+
+        Values are read from FIELD_SERIES. A series already fetched with
+        FIELD_SERIES.get_many may be passed in.
+        """
+        if series is None:
+            series = FIELD_SERIES.get(self.id)
+        ordinals, raws = series.between(to_date(start_ds), to_date(end_ds))
+        type_name = self.type_name
+        return [
+            (ordinal_to_ds(ordinal), format_value(type_name, raw))
+            for ordinal, raw in zip(ordinals, raws)
+        ]
 
     @property
     def identifier(self):
         """Property to uniquely identify this Field"""
         return '{}: {}'.format(self.department.name, self.name)
 
+    @property
+    def type_name(self):
+        """Property to get the name of this Field's type without a DB lookup"""
+        if self.ftype_id is None and self.ftype is not None:
+            # The Field hasn't been flushed yet, so fall back to the relation
+            return self.ftype.name
+        return FIELD_TYPES.name_of(self.ftype_id)
+
 
 class Report(db.Model):
     """Model for a DLI Report"""
@@ -298,38 +696,57 @@ class Report(db.Model):
         that is easy to template for render_template functions in Jinja2
         """
 
-        dept_data = collections.defaultdict(list)
-        for field in self.fields:
-            dept_data[field.department.name].append(
-                {
-                    'name': field.name,
-                    'value': field.get_data_for_date(ds, pretty=True),
-                }
-            )
-        return dept_data
+        return self.bulk_load_dept_data(ds)[0]
 
-    def excel_filepath_for_ds(self, start_ds, end_ds):
-        """Return the absolute filepath for the Excel sheet on the given ds"""
-        return os.path.join(
-            os.path.abspath(os.path.dirname(__file__)),
-            EXCEL_FILE_DIR,
-            self.generate_filename(start_ds, end_ds),
-        )
+    def bulk_load_dept_data(self, ds):
+        """Load this Report's department data for a given day in bulk
+
+        The Report's Fields are loaded in one query with their Departments
+        eagerly loaded, and every value comes from FIELD_SERIES, which loads
+        all of its misses in (at most) one more query. Field types come from
+        FIELD_TYPES and don't touch the DB once the registry is warm.
+
+        Returns a tuple of (dept_data, query_count) where query_count is the
+        number of SQL statements that were issued.
+        """
 
-    def excel_file_exists(self, start_ds, end_ds):
-        """Determine whether or not an Excel file for this ds exists"""
-        return os.path.exists(self.excel_filepath_for_ds(start_ds, end_ds))
+        with QueryCounter() as counter:
+            fields = (
+                Field.query
+                .join(report_fields, report_fields.c.field_id == Field.id)
+                .filter(report_fields.c.report_id == self.id)
+                .options(db.joinedload('department'))
+                .order_by(Field.id)
+                .all()
+            )
+            all_series = FIELD_SERIES.get_many([field.id for field in fields])
+
+            dept_data = collections.defaultdict(list)
+            for field in fields:
+                dept_data[field.department.name].append(
+                    {
+                        'name': field.name,
+                        'value': field.get_data_for_date(
+                            ds,
+                            pretty=True,
+                            series=all_series[field.id],
+                        ),
+                    }
+                )
+        return dept_data, counter.count
 
-    def create_excel_file(self, start_ds, end_ds):
+    def create_excel_file(self, start_ds, end_ds, filepath, progress=None):
         """Generate an Excel sheet with this Report's data
 
         Arguments:
         start_ds - Date stamp for the start day of Report data to generate
         end_ds - Date stamp for the end day of Report data to generate
+        filepath - where to write the sheet (see EXCEL_CACHE for downloads)
+        progress - optional callable, see stream_dept_fields
         """
 
         excel_helper = ExcelSheetHelper(
-            filepath=self.excel_filepath_for_ds(start_ds, end_ds),
+            filepath=filepath,
             report=self,
             date_list=generate_date_list(
                 datetime.datetime.strptime(start_ds, '%Y-%m-%d'),
@@ -337,19 +754,75 @@ class Report(db.Model):
                 step=1,
             ),
         )
-        excel_helper.write_all(self.collect_dept_fields(start_ds, end_ds))
+        excel_helper.write_stream(self.stream_dept_fields(start_ds, end_ds, progress=progress))
         excel_helper.finalize()
 
-    def remove_excel_files(self):
-        """Delete the Excel files for this Report"""
-        basepath = os.path.join(
-            os.path.abspath(os.path.dirname(__file__)),
-            EXCEL_FILE_DIR,
+    def stream_dept_fields(self, start_ds, end_ds, batch_size=1000, progress=None):
+        """Yield (dept_name, field, {ds: value}) for every Field of this Report
+
+        Fields come grouped by Department and ordered by name within each
+        one. FieldData is pulled one Department at a time from a server-side
+        cursor, so only a single Field's values are held in memory at once no
+        matter how long the date range is.
+
+        Arguments:
+        start_ds - the beginning ds for data to collect
+        end_ds - the ending ds for data to collect
+        batch_size - the number of rows to fetch from the cursor at a time
+        progress - optional callable taking (fields_done, fields_total); it is
+            called between departments, when no cursor is open, so it may
+            safely write to the DB
+        """
+        fields = (
+            Field.query
+            .join(report_fields, report_fields.c.field_id == Field.id)
+            .filter(report_fields.c.report_id == self.id)
+            .options(db.joinedload('department'))
+            .order_by(Field.name, Field.id)
+            .all()
         )
-        globpath = os.path.join(basepath, self.name + '*.xlsx')
 
-        for filename in glob.glob(globpath):
-            os.remove(os.path.join(basepath, filename))
+        dept_fields = collections.defaultdict(list)
+        # Resolve the types now: no other query may run while a cursor streams
+        type_names = {}
+        for field in fields:
+            dept_fields[field.department.name].append(field)
+            type_names[field.id] = field.type_name
+
+        fields_done = 0
+        for dept_name in sorted(dept_fields):
+            if progress is not None:
+                progress(fields_done, len(fields))
+            rows = iter(
+                db.session.query(
+                    FieldData.field_id,
+                    FieldData.ds,
+                    FieldData.ivalue,
+                    FieldData.dvalue,
+                    FieldData.svalue,
+                )
+                .join(Field, Field.id == FieldData.field_id)
+                .filter(FieldData.field_id.in_([field.id for field in dept_fields[dept_name]]))
+                .filter(FieldData.ds >= start_ds)
+                .filter(FieldData.ds <= end_ds)
+                # Same order as the fields above, so one pass matches them up
+                .order_by(Field.name, Field.id, FieldData.ds)
+                .execution_options(stream_results=True)
+                .yield_per(batch_size)
+            )
+
+            row = next(rows, None)
+            for field in dept_fields[dept_name]:
+                type_name = type_names[field.id]
+                column = STORAGE_COLUMNS.get(type_name)
+                values = {}
+                while row is not None and row.field_id == field.id:
+                    raw = getattr(row, column) if column else None
+                    if raw is not None:
+                        values[row.ds] = format_value(type_name, raw)
+                    row = next(rows, None)
+                yield dept_name, field, values
+            fields_done += len(dept_fields[dept_name])
 
     def collect_dept_fields(self, start_ds, end_ds):
         """Collect all of the department data for this Report
@@ -362,11 +835,11 @@ class Report(db.Model):
         end_ds - the ending ds for data to collect
         """
         dept_data = {}
+        all_series = FIELD_SERIES.get_many([field.id for field in self.fields])
         for field in self.fields:
-            field_data = {
-                pt.ds: pt.value
-                for pt in field.data_points.filter(FieldData.ds >= start_ds).filter(FieldData.ds <= end_ds)
-            }
+            field_data = dict(
+                field.values_between(start_ds, end_ds, series=all_series[field.id])
+            )
             if not dept_data.get(field.department.name):
                 dept_data[field.department.name] = {}
             dept_data[field.department.name][field] = field_data
@@ -379,6 +852,12 @@ class ChartType(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(32), index=True)
 
+    # Names of the chart types the app knows how to draw
+    LINE = 'line'
+    BAR = 'bar'
+    PIE = 'pie'
+    TABLE_ONLY = 'table only'
+
     def __init__(self, name):
         """Initialize a ChartType model"""
         self.name = name
@@ -425,11 +904,18 @@ class Chart(db.Model):
         """Return a descriptive representation of a Chart"""
         return '<Chart %r>' % self.name
 
+    @property
+    def type_name(self):
+        """Property to get the name of this Chart's type without a DB lookup"""
+        if self.ctype_id is None and self.ctype is not None:
+            # The Chart hasn't been flushed yet, so fall back to the relation
+            return self.ctype.name
+        return CHART_TYPES.name_of(self.ctype_id)
+
     @property
     def is_pie_chart(self):
         """Return whether or not this chart is a Pie Chart"""
-        ChartTypeConstants.reload()
-        return self.ctype == ChartTypeConstants.PIE
+        return self.type_name == ChartType.PIE
 
     def data_points(self, min_date, max_date=None, ds_format=False):
         """Retrieve the data points needed for this chart"""
@@ -442,10 +928,11 @@ class Chart(db.Model):
             if max_date:
                 max_ds = max_date.strftime('%Y-%m-%d')
 
+        all_series = FIELD_SERIES.get_many([field.id for field in self.fields])
         return {
             field.identifier: {
-                str(fdata.ds): str(fdata.value)
-                for fdata in field.data_points.filter(FieldData.ds >= min_ds).filter(FieldData.ds <= max_ds)
+                ds: str(value)
+                for ds, value in field.values_between(min_ds, max_ds, series=all_series[field.id])
             }
             for field in self.fields
         }
@@ -458,12 +945,12 @@ class Chart(db.Model):
     def generated_js(self):
         """Property that represents this chart generated as C3 JavaScript"""
         min_date = datetime.datetime.now()
-        ChartTypeConstants.reload()
-        if self.ctype != ChartTypeConstants.PIE:
+        chart_type = self.type_name
+        if chart_type != ChartType.PIE:
             min_date = min_date - datetime.timedelta(days=14)
 
         generate = 'true'
-        if self.ctype == ChartTypeConstants.TABLE_ONLY:
+        if chart_type == ChartType.TABLE_ONLY:
             generate = 'false'
 
         return """
@@ -474,7 +961,7 @@ class Chart(db.Model):
         """.format(
             time_series=get_time_series_sequence(min_date),
             data_points=self.data_points(min_date),
-            chart_type=self.ctype.name,
+            chart_type=chart_type,
             should_generate=generate,
         )
 
@@ -487,12 +974,21 @@ class ExcelSheetHelper():
     row and column information.
     """
 
-    def __init__(self, filepath, report, date_list):
-        """Initialize an ExcelSheetHelper by creating an XLSX Workbook"""
+    def __init__(self, filepath, report, date_list, constant_memory=True):
+        """Initialize an ExcelSheetHelper by creating an XLSX Workbook
+
+        In constant_memory mode xlsxwriter flushes every row to disk as soon
+        as a later row is started, so rows must be written strictly in order
+        (which every write_* method here does).
+        """
         self.report = report
         self.date_list = date_list
+        self.ds_list = [date.strftime(DS_FORMAT) for date in date_list]
 
-        self.workbook = xlsxwriter.Workbook(filepath)
+        self.workbook = xlsxwriter.Workbook(
+            filepath,
+            {'constant_memory': constant_memory},
+        )
         self.worksheet = self.workbook.add_worksheet()
         # Set default width of columns A and B a bit wider
         self.worksheet.set_column('A:B', 20)
@@ -528,6 +1024,13 @@ class ExcelSheetHelper():
         self.time_format = self.workbook.add_format(
             {'num_format': 'h:mm'}
         )
+        self.formats = {
+            FieldType.CURRENCY: self.currency_format,
+            FieldType.DOUBLE: self.double_format,
+            FieldType.INTEGER: self.integer_format,
+            FieldType.STRING: self.string_format,
+            FieldType.TIME: self.time_format,
+        }
 
         self.initialize_worksheet()
 
@@ -582,6 +1085,19 @@ class ExcelSheetHelper():
             for field in sorted(dept_fields[dept].keys(), key=lambda x: x.name):
                 self.write_field(field, dept_fields[dept][field])
 
+    def write_stream(self, field_rows):
+        """Write all of the data for a Report as it is produced
+
+        field_rows is an iterable of (dept_name, field, {ds : value}) tuples
+        grouped by department, as yielded by Report.stream_dept_fields.
+        """
+        current_dept = None
+        for dept_name, field, values in field_rows:
+            if dept_name != current_dept:
+                self.write_dept_title(dept_name)
+                current_dept = dept_name
+            self.write_field(field, values)
+
     def write_dept_title(self, dept_name):
         """Write a Department title within a Report"""
         self.row += 1
@@ -603,15 +1119,16 @@ class ExcelSheetHelper():
         )
         self.col += 1
 
-        for date in self.date_list:
+        cell_format = self.get_format(field)
+        for ds in self.ds_list:
             # Write the data for each ds
-            field_data = values.get(date.strftime('%Y-%m-%d'))
+            field_data = values.get(ds)
             if field_data:
                 self.worksheet.write(
                     self.row,
                     self.col,
                     field_data,
-                    self.get_format(field),
+                    cell_format,
                 )
             self.col += 1
 
@@ -620,17 +1137,7 @@ class ExcelSheetHelper():
 
     def get_format(self, field):
         """Get the format required for the specific field"""
-        FieldTypeConstants.reload()
-        if field.ftype == FieldTypeConstants.CURRENCY:
-            return self.currency_format
-        elif field.ftype == FieldTypeConstants.DOUBLE:
-            return self.double_format
-        elif field.ftype == FieldTypeConstants.INTEGER:
-            return self.integer_format
-        elif field.ftype == FieldTypeConstants.STRING:
-            return self.string_format
-        elif field.ftype == FieldTypeConstants.TIME:
-            return self.time_format
+        return self.formats.get(field.type_name)
 
     def finalize(self):
         """Complete the workbook by closing it"""
@@ -639,8 +1146,90 @@ class ExcelSheetHelper():
             self.finalized = True
 
 
+FIELD_TYPES = TypeRegistry(
+    FieldType,
+    stamp_path=app.config.get(
+        'FIELD_TYPES_STAMP_PATH',
+        os.path.join(tempfile.gettempdir(), 'dli-reports-field-types.stamp'),
+    ),
+)
+CHART_TYPES = TypeRegistry(
+    ChartType,
+    stamp_path=app.config.get(
+        'CHART_TYPES_STAMP_PATH',
+        os.path.join(tempfile.gettempdir(), 'dli-reports-chart-types.stamp'),
+    ),
+)
+
+# Any write to a type table invalidates this process's snapshot of it, and
+# every other process's once it commits (create_db.py seeds them while the
+# site may be running)
+for _event_name in ('after_insert', 'after_update', 'after_delete'):
+    event.listen(FieldType, _event_name, FIELD_TYPES.invalidate)
+    event.listen(ChartType, _event_name, CHART_TYPES.invalidate)
+event.listen(db.session, 'after_commit', FIELD_TYPES.publish)
+event.listen(db.session, 'after_commit', CHART_TYPES.publish)
+
+
+def _load_field_series(field_ids):
+    """Load the (field_id, type_name, date, raw) rows FIELD_SERIES is built from"""
+    columns = {'ivalue': 0, 'dvalue': 1, 'svalue': 2}
+    rows = (
+        db.session.query(
+            FieldData.field_id,
+            Field.ftype_id,
+            type_coerce(FieldData.ds, db.Date),
+            FieldData.ivalue,
+            FieldData.dvalue,
+            FieldData.svalue,
+        )
+        .join(Field, Field.id == FieldData.field_id)
+        .filter(FieldData.field_id.in_(field_ids))
+        .order_by(FieldData.field_id, FieldData.ds)
+    )
+    for field_id, ftype_id, date, ivalue, dvalue, svalue in rows:
+        type_name = FIELD_TYPES.name_of(ftype_id)
+        column = columns.get(STORAGE_COLUMNS.get(type_name))
+        if column is not None:
+            yield field_id, type_name, date, (ivalue, dvalue, svalue)[column]
+
+
+def _field_data_versions(field_ids):
+    """Return {field_id: sum of its FieldDataVersion} for FIELD_SERIES"""
+    versions = {}
+    for n in range(0, len(field_ids), IN_BATCH):
+        versions.update(
+            db.session.query(FieldDataVersion.field_id, db.func.sum(FieldDataVersion.version))
+            .filter(FieldDataVersion.field_id.in_(field_ids[n:n + IN_BATCH]))
+            .group_by(FieldDataVersion.field_id)
+        )
+    return versions
+
+
+FIELD_SERIES = FieldSeriesCache(
+    loader=_load_field_series,
+    versioner=_field_data_versions,
+    typecodes={
+        FieldType.CURRENCY: 'l',
+        FieldType.DOUBLE: 'd',
+        FieldType.INTEGER: 'l',
+        FieldType.TIME: 'l',
+    },
+    max_points=app.config.get('FIELD_SERIES_CACHE_MAX_POINTS', 2000000),
+    # Lets the site, excel_worker.py and command-line tools see each other's writes
+    stamp_path=app.config.get(
+        'FIELD_SERIES_STAMP_PATH',
+        os.path.join(tempfile.gettempdir(), 'dli-reports-field-series.stamp'),
+    ),
+)
+
+
 class FieldTypeConstants():
-    """Constant FieldTypes used for easy type-checking in other modules"""
+    """Constant FieldType models used when seeding the database
+
+    Application code should use FIELD_TYPES (see TypeRegistry) instead, which
+    does not hit the DB on every lookup.
+    """
     try:
         CURRENCY = FieldType.query.filter_by(name="currency").first()
         DOUBLE = FieldType.query.filter_by(name="double").first()
@@ -673,7 +1262,11 @@ class FieldTypeConstants():
 
 
 class ChartTypeConstants():
-    """Constant ChartTypes used for easy type-checking in other modules"""
+    """Constant ChartType models used when seeding the database
+
+    Application code should use CHART_TYPES (see TypeRegistry) instead, which
+    does not hit the DB on every lookup.
+    """
     try:
         LINE = ChartType.query.filter_by(name="line").first()
         BAR = ChartType.query.filter_by(name="bar").first()
@@ -0,0 +1,285 @@
+"""Rollups of FieldData for the reports module
+
+Author: Logan Gore
+This file is responsible for the weekly and monthly rollups of FieldData that
+let long-range charts ship a bounded number of points. Rollups aggregate the
+raw (stored) values of a Field, so they are formatted exactly like FieldData.
+They are kept up to date incrementally: whenever a value is submitted, only
+the week and month containing its ds are recomputed.
+"""
+
+import collections
+import datetime
+
+from dli_app import db
+
+from dli_app.mod_reports.models import DateStamp
+from dli_app.mod_reports.models import FIELD_SERIES
+from dli_app.mod_reports.models import Field
+from dli_app.mod_reports.models import FieldType
+from dli_app.mod_reports.models import format_value
+from dli_app.mod_reports.models import to_date
+from dli_app.mod_reports.models import upsert_rows
+
+
+DAY = 'day'
+WEEK = 'week'
+MONTH = 'month'
+AUTO = 'auto'
+
+GRANULARITIES = (DAY, WEEK, MONTH)
+ROLLUP_GRANULARITIES = (WEEK, MONTH)
+
+# Roughly how many days a single point of each granularity covers
+PERIOD_DAYS = {
+    DAY: 1,
+    WEEK: 7,
+    MONTH: 30,
+}
+
+# The most points per field a chart should get when granularity is 'auto'
+MAX_CHART_POINTS = 120
+
+AGGREGATES = ('sum', 'avg', 'min', 'max', 'last')
+
+# The aggregate charted for each FieldType when none is requested.
+# String fields have no numeric rollups at all.
+DEFAULT_AGGREGATES = {
+    FieldType.CURRENCY: 'sum',
+    FieldType.DOUBLE: 'avg',
+    FieldType.INTEGER: 'sum',
+    FieldType.TIME: 'avg',
+}
+
+
+def period_start(granularity, date):
+    """Return the first day of the period of the given granularity"""
+    if granularity == WEEK:
+        return date - datetime.timedelta(days=date.weekday())
+    elif granularity == MONTH:
+        return date.replace(day=1)
+    return date
+
+
+def period_end(granularity, start):
+    """Return the last day of the period starting on the given day"""
+    if granularity == WEEK:
+        return start + datetime.timedelta(days=6)
+    elif granularity == MONTH:
+        next_month = (start.replace(day=28) + datetime.timedelta(days=4)).replace(day=1)
+        return next_month - datetime.timedelta(days=1)
+    return start
+
+
+def choose_granularity(start, end, max_points=MAX_CHART_POINTS):
+    """Pick the finest granularity that keeps [start, end] under max_points"""
+    days = (end - start).days + 1
+    for granularity in GRANULARITIES:
+        if days <= max_points * PERIOD_DAYS[granularity]:
+            return granularity
+    return MONTH
+
+
+class FieldDataRollup(db.Model):
+    """Model for the aggregated data of a Field over a week or a month"""
+    __tablename__ = "field_data_rollup"
+    __table_args__ = (
+        db.UniqueConstraint(
+            'field_id', 'granularity', 'period_start',
+            name='uq_field_data_rollup_field_id_granularity_period_start',
+        ),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    field_id = db.Column(db.Integer, db.ForeignKey("field.id"))
+    field = db.relationship(
+        Field,
+        backref=db.backref('rollups', cascade='all, delete-orphan'),
+    )
+    granularity = db.Column(db.String(8))
+    period_start = db.Column(DateStamp)
+    count = db.Column(db.Integer)
+    total = db.Column(db.Float)
+    minimum = db.Column(db.Float)
+    maximum = db.Column(db.Float)
+    last = db.Column(db.Float)
+
+    def __repr__(self):
+        """Return a descriptive representation of a FieldDataRollup"""
+        return '<FieldDataRollup {granularity} {start} of field {field_id}>'.format(
+            granularity=self.granularity,
+            start=self.period_start,
+            field_id=self.field_id,
+        )
+
+    def aggregate(self, name):
+        """Return the raw value of the given aggregate (see AGGREGATES)"""
+        if name == 'sum':
+            return self.total
+        elif name == 'avg':
+            return self.total / self.count
+        elif name == 'min':
+            return self.minimum
+        elif name == 'max':
+            return self.maximum
+        elif name == 'last':
+            return self.last
+        raise NotImplementedError("ERROR: Aggregate %s not supported!" % name)
+
+    @classmethod
+    def refresh(cls, changes):
+        """Recompute the rollups covering the given (field_id, ds) pairs
+
+        The values are read straight from the DB in the current transaction
+        (bypassing FIELD_SERIES), so the new FieldData need not be committed
+        yet. The rollups are written in the current transaction too; the
+        caller must commit.
+        """
+        dates_by_field = collections.defaultdict(set)
+        for field_id, ds in changes:
+            dates_by_field[field_id].add(to_date(ds))
+        if not dates_by_field:
+            return
+
+        all_series = FIELD_SERIES.load(list(dates_by_field))
+        rows = []
+        for field_id, dates in dates_by_field.items():
+            for granularity in ROLLUP_GRANULARITIES:
+                starts = set(period_start(granularity, date) for date in dates)
+                rows.extend(_rollup_rows(field_id, all_series[field_id], granularity, starts))
+        cls.upsert(rows)
+
+    @classmethod
+    def rebuild(cls, field_ids):
+        """Throw away and recompute every rollup of the given fields"""
+        cls.query.filter(cls.field_id.in_(field_ids)).delete(synchronize_session=False)
+        all_series = FIELD_SERIES.get_many(field_ids)
+        rows = []
+        for field_id in field_ids:
+            for granularity in ROLLUP_GRANULARITIES:
+                rows.extend(_rollup_rows(field_id, all_series[field_id], granularity))
+        cls.upsert(rows)
+
+    @classmethod
+    def upsert(cls, rows):
+        """Insert or overwrite many rollup rows with one statement"""
+        upsert_rows(
+            cls.__table__,
+            keys=('field_id', 'granularity', 'period_start'),
+            values=('count', 'total', 'minimum', 'maximum', 'last'),
+            rows=rows,
+        )
+
+
+def _rollup_rows(field_id, series, granularity, starts=None):
+    """Aggregate a FieldSeries into rollup row dicts
+
+    If starts is given, only the periods beginning on those days are built.
+    Otherwise every period the series has data for is built.
+    """
+    if series.type_name not in DEFAULT_AGGREGATES:
+        return []
+
+    if starts is None:
+        starts = set(
+            period_start(granularity, datetime.date.fromordinal(ordinal))
+            for ordinal in series.ordinals
+        )
+
+    rows = []
+    for start in sorted(starts):
+        _, raws = series.between(start, period_end(granularity, start))
+        if not len(raws):
+            continue
+        rows.append({
+            'field_id': field_id,
+            'granularity': granularity,
+            'period_start': start,
+            'count': len(raws),
+            'total': float(sum(raws)),
+            'minimum': float(min(raws)),
+            'maximum': float(max(raws)),
+            'last': float(raws[-1]),
+        })
+    return rows
+
+
+def chart_data_points(chart, start_ds, end_ds, granularity=DAY, aggregate=None):
+    """Retrieve the data points of a chart at the given granularity
+
+    Arguments:
+    chart - the Chart to get data for
+    start_ds - the first ds of the window
+    end_ds - the last ds of the window
+    granularity - one of GRANULARITIES, or AUTO to pick the finest one that
+        keeps the window under MAX_CHART_POINTS points per field
+    aggregate - one of AGGREGATES; defaults to DEFAULT_AGGREGATES per type
+
+    Returns the same {identifier: {ds: value}} dict as Chart.data_points,
+    where each ds is the first day of its week or month.
+    """
+    data = charts_data_points([chart], start_ds, end_ds, granularity, aggregate)[chart.id]
+    return {
+        identifier: {ds: str(value) for ds, value in values.items()}
+        for identifier, values in data.items()
+    }
+
+
+def charts_data_points(charts, start_ds, end_ds, granularity=DAY, aggregate=None):
+    """Retrieve the data points of several charts at once
+
+    Takes the same arguments as chart_data_points, but every value needed by
+    all of the charts is loaded together: the daily values come from one
+    FIELD_SERIES.get_many and the rollups from one query.
+
+    Returns {chart_id: {identifier: {ds: value}}} with values left as
+    numbers (strings only for string Fields).
+    """
+    start = to_date(start_ds)
+    end = to_date(end_ds)
+    if granularity == AUTO:
+        granularity = choose_granularity(start, end)
+
+    fields = {field.id: field for chart in charts for field in chart.fields}
+    if granularity == DAY:
+        values = _daily_values(fields, start_ds, end_ds)
+    else:
+        values = _rollup_values(fields, start, end, granularity, aggregate)
+
+    return {
+        chart.id: {field.identifier: values[field.id] for field in chart.fields}
+        for chart in charts
+    }
+
+
+def _daily_values(fields, start_ds, end_ds):
+    """Return {field_id: {ds: value}} of the daily values of some Fields"""
+    all_series = FIELD_SERIES.get_many(list(fields))
+    return {
+        field_id: dict(field.values_between(start_ds, end_ds, series=all_series[field_id]))
+        for field_id, field in fields.items()
+    }
+
+
+def _rollup_values(fields, start, end, granularity, aggregate):
+    """Return {field_id: {period_start: value}} of the rollups of some Fields"""
+    values = {field_id: {} for field_id in fields}
+    if not fields:
+        return values
+
+    rollups = FieldDataRollup.query.filter(
+        FieldDataRollup.field_id.in_(list(fields)),
+        FieldDataRollup.granularity == granularity,
+        FieldDataRollup.period_start >= period_start(granularity, start),
+        FieldDataRollup.period_start <= end,
+    ).order_by(FieldDataRollup.period_start)
+
+    for rollup in rollups:
+        type_name = fields[rollup.field_id].type_name
+        name = aggregate or DEFAULT_AGGREGATES.get(type_name)
+        if name is None:
+            continue
+        values[rollup.field_id][rollup.period_start] = format_value(
+            type_name,
+            rollup.aggregate(name),
+        )
+    return values
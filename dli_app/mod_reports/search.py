@@ -0,0 +1,249 @@
+"""Search of reports and charts for the reports module
+
+Author: Logan Gore
+This file is responsible for the n-gram index behind report and chart search.
+The name of every Report, Chart, Tag, Field, Department and User (and every
+User's email) is stored lowercased in search_entry, along with all of its 1-,
+2- and 3-character substrings in search_gram. A substring search looks up
+the grams of the text searched for (the text itself if it is short, or its
+trigrams) through the index and only checks the matching names with LIKE,
+so no search scans a whole table. The index is kept up to date by mapper
+events whenever one of those objects is added, renamed or deleted.
+"""
+
+from sqlalchemy import event
+from sqlalchemy import inspect
+from sqlalchemy.dialects import mysql
+
+from dli_app import db
+
+from dli_app.mod_auth.models import Department
+from dli_app.mod_auth.models import User
+
+from dli_app.mod_reports.models import Chart
+from dli_app.mod_reports.models import Field
+from dli_app.mod_reports.models import Report
+from dli_app.mod_reports.models import Tag
+from dli_app.mod_reports.models import chart_fields
+from dli_app.mod_reports.models import chart_tags
+from dli_app.mod_reports.models import report_fields
+from dli_app.mod_reports.models import report_tags
+
+
+# {kind: (model, indexed attribute)}
+INDEXED = {
+    'report': (Report, 'name'),
+    'chart': (Chart, 'name'),
+    'tag': (Tag, 'name'),
+    'field': (Field, 'name'),
+    'department': (Department, 'name'),
+    'user': (User, 'name'),
+    'email': (User, 'email'),
+}
+
+# The filters a search may combine; 'text' matches any of the others
+FILTERS = ('text', 'name', 'owner', 'tag', 'department', 'field')
+
+# The longest grams stored; longer searches are looked up by their trigrams
+MAX_GRAM = 3
+
+
+class SearchEntry(db.Model):
+    """Model for the lowercased name of one searchable object"""
+    __tablename__ = 'search_entry'
+    __table_args__ = (
+        db.UniqueConstraint('kind', 'item_id', name='uq_search_entry_kind_item_id'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(16))
+    item_id = db.Column(db.Integer)
+    text = db.Column(db.String(128))
+
+    def __repr__(self):
+        """Return a descriptive representation of a SearchEntry"""
+        return '<SearchEntry {kind} {item_id} {text!r}>'.format(
+            kind=self.kind,
+            item_id=self.item_id,
+            text=self.text,
+        )
+
+
+class SearchGram(db.Model):
+    """Model for a substring of a SearchEntry's text"""
+    __tablename__ = 'search_gram'
+    __table_args__ = (
+        # Also the index used to find the entries containing a gram
+        db.UniqueConstraint('gram', 'entry_id', name='uq_search_gram_gram_entry_id'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    # Compared byte for byte on MySQL, whose default collations would make
+    # grams that differ only in their accents collide in the unique constraint
+    gram = db.Column(
+        db.String(MAX_GRAM).with_variant(mysql.VARCHAR(MAX_GRAM, binary=True), 'mysql')
+    )
+    entry_id = db.Column(db.Integer, db.ForeignKey('search_entry.id'), index=True)
+
+
+def grams_of(substrings):
+    """Return the grams stored for some substrings
+
+    Trailing whitespace is dropped, since MySQL compares 'x' and 'x ' as
+    equal; a name containing 'x ' contains 'x' anyway.
+    """
+    return set(gram for gram in (substring.rstrip() for substring in substrings) if gram)
+
+
+def ngrams(text):
+    """Return every substring of text of up to MAX_GRAM characters"""
+    return grams_of(
+        text[start:start + size]
+        for size in range(1, MAX_GRAM + 1)
+        for start in range(len(text) - size + 1)
+    )
+
+
+def search_grams(text):
+    """Return the grams an entry must contain to contain text"""
+    if len(text) <= MAX_GRAM:
+        return grams_of([text])
+    return grams_of(text[start:start + MAX_GRAM] for start in range(len(text) - MAX_GRAM + 1))
+
+
+def remove_entry(connection, kind, item_id):
+    """Remove an object's entry and grams from the index"""
+    entries = SearchEntry.__table__
+    grams = SearchGram.__table__
+    entry_ids = db.select([entries.c.id]).where(
+        db.and_(entries.c.kind == kind, entries.c.item_id == item_id)
+    )
+    connection.execute(grams.delete().where(grams.c.entry_id.in_(entry_ids)))
+    connection.execute(entries.delete().where(
+        db.and_(entries.c.kind == kind, entries.c.item_id == item_id)
+    ))
+
+
+def write_entry(connection, kind, item_id, text):
+    """Replace an object's entry and grams in the index"""
+    remove_entry(connection, kind, item_id)
+    text = (text or '').lower()[:128]
+    if not text:
+        return
+    entry_id = connection.execute(
+        SearchEntry.__table__.insert(),
+        kind=kind,
+        item_id=item_id,
+        text=text,
+    ).inserted_primary_key[0]
+    connection.execute(SearchGram.__table__.insert(), [
+        {'gram': gram, 'entry_id': entry_id} for gram in ngrams(text)
+    ])
+
+
+def rebuild_index():
+    """Index every searchable object from scratch within the current session"""
+    connection = db.session.connection()
+    connection.execute(SearchGram.__table__.delete())
+    connection.execute(SearchEntry.__table__.delete())
+    for kind, (model, attr) in INDEXED.items():
+        for item_id, text in db.session.query(model.id, getattr(model, attr)):
+            write_entry(connection, kind, item_id, text)
+
+
+def _listen(model, kinds):
+    """Keep the index entries of a model up to date"""
+    def after_write(mapper, connection, target):  # pylint: disable=unused-argument
+        """Index a new object, or the attributes of an object that changed"""
+        state = inspect(target)
+        for kind, attr in kinds:
+            if state.attrs[attr].history.has_changes():
+                write_entry(connection, kind, target.id, getattr(target, attr))
+
+    def before_delete(mapper, connection, target):  # pylint: disable=unused-argument
+        """Remove a deleted object from the index"""
+        for kind, _ in kinds:
+            remove_entry(connection, kind, target.id)
+
+    event.listen(model, 'after_insert', after_write)
+    event.listen(model, 'after_update', after_write)
+    event.listen(model, 'before_delete', before_delete)
+
+
+for _model in set(model for model, _ in INDEXED.values()):
+    _listen(_model, [
+        (kind, attr) for kind, (model, attr) in sorted(INDEXED.items()) if model is _model
+    ])
+
+
+def matching_ids(kind, text):
+    """Return a subquery of the ids of the objects whose name contains text"""
+    text = text.lower()
+    grams = search_grams(text)
+    pattern = '%{}%'.format(
+        text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    )
+    return (
+        db.session.query(SearchEntry.item_id)
+        .join(SearchGram, SearchGram.entry_id == SearchEntry.id)
+        .filter(
+            SearchEntry.kind == kind,
+            SearchGram.gram.in_(grams),
+            SearchEntry.text.like(pattern, escape='\\'),
+        )
+        .group_by(SearchEntry.id, SearchEntry.item_id)
+        .having(db.func.count(db.distinct(SearchGram.gram)) == len(grams))
+    )
+
+
+def _conditions(model, text):
+    """Return {filter: condition} for every filter of a model but 'text'"""
+    if model is Report:
+        kind, owner_id, tags, fields, item_id = (
+            'report', Report.user_id, report_tags, report_fields, 'report_id',
+        )
+    else:
+        kind, owner_id, tags, fields, item_id = (
+            'chart', Chart.owner_id, chart_tags, chart_fields, 'chart_id',
+        )
+
+    return {
+        'name': model.id.in_(matching_ids(kind, text)),
+        'owner': db.or_(
+            owner_id.in_(matching_ids('user', text)),
+            owner_id.in_(matching_ids('email', text)),
+        ),
+        'tag': model.id.in_(
+            db.select([tags.c[item_id]]).where(tags.c.tag_id.in_(matching_ids('tag', text)))
+        ),
+        'field': model.id.in_(
+            db.select([fields.c[item_id]]).where(
+                fields.c.field_id.in_(matching_ids('field', text))
+            )
+        ),
+        'department': model.id.in_(
+            db.select([fields.c[item_id]])
+            .select_from(fields.join(Field.__table__, Field.id == fields.c.field_id))
+            .where(Field.department_id.in_(matching_ids('department', text)))
+        ),
+    }
+
+
+def search_query(model, filters):
+    """Return a query of the Reports or Charts matching every filter
+
+    Arguments:
+    model - Report or Chart
+    filters - {filter: text} for any of FILTERS; each text is matched as a
+        case-insensitive substring, and 'text' matches the name, owner,
+        tags, departments or fields
+
+    All filters are combined into one query, ordered by id so it can be
+    paginated.
+    """
+    query = model.query
+    for name, text in filters.items():
+        conditions = _conditions(model, text)
+        if name == 'text':
+            query = query.filter(db.or_(*conditions.values()))
+        else:
+            query = query.filter(conditions[name])
+    return query.order_by(model.id)
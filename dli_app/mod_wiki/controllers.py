@@ -6,46 +6,34 @@ This file is responsible for loading all site pages under /wiki.
 
 import datetime
 
-from markdown import Markdown
-
-from markdown.extensions import extra
-from markdown.extensions import nl2br
-from markdown.extensions import toc
-from markdown.extensions import wikilinks
-
 from flask import Blueprint
 from flask import flash
 from flask import redirect
 from flask import render_template
+from flask import request
 from flask import url_for
 
 from flask_mail import Message
 
+from dli_app.mod_admin.models import OutboxMessage
+
 from dli_app.mod_auth.models import User
 
 from flask_login import current_user
 from flask_login import login_required
 
 from dli_app import db
-from dli_app import mail
 from dli_app import flash_form_errors
 
+from dli_app.mod_wiki.models import WIKI_VIEWS
 from dli_app.mod_wiki.models import WikiPage
+from dli_app.mod_wiki.search import search_pages
 
 from dli_app.mod_wiki.forms import EditWikiPageForm
 from dli_app.mod_wiki.forms import SearchForm
 from dli_app.mod_wiki.forms import AskQuestionForm
 
 
-EXTENSIONS = [
-    extra.ExtraExtension(),
-    nl2br.Nl2BrExtension(),
-    toc.TocExtension(),
-    wikilinks.WikiLinkExtension(base_url='/wiki/'),
-]
-
-MD = Markdown(extensions=EXTENSIONS)
-
 # Create a blueprint for this module
 mod_wiki = Blueprint('wiki', __name__, url_prefix='/wiki')
 
@@ -60,7 +48,9 @@ def home():
     page = WikiPage.query.filter_by(name='home').first()
     html = ''
     if page is not None:
-        html = MD.convert(page.content)
+        if page.render():
+            db.session.commit()
+        html = page.html
 
     form = SearchForm()
     return render_template('wiki/home.html', form=form, html=html, page=page, pages=pages)
@@ -73,10 +63,11 @@ def view_page(page_name):
     page = WikiPage.query.filter_by(name=page_name).first()
     if page is None:
         return render_template('wiki/404.html'), 404
-    page.views += 1
-    db.session.commit()
-    html = MD.convert(page.content)
-    return render_template('wiki/view.html', page=page, html=html, toc=MD.toc)
+    WIKI_VIEWS.record(page.id)
+    # Pages are rendered when edited; this only renders pages saved before that
+    if page.render():
+        db.session.commit()
+    return render_template('wiki/view.html', page=page, html=page.html, toc=page.toc)
 
 
 @mod_wiki.route('/edit', methods=['GET', 'POST'])
@@ -95,6 +86,7 @@ def edit_page(page_name=''):
         if page is not None:
             page.name = form.page.name
             page.content = form.page.content
+            page.render()
             page.modtime = datetime.datetime.now().strftime('%m/%d/%Y %I:%M %p')
             page.editor = current_user.name
             flash(
@@ -140,18 +132,28 @@ def delete_page(page_id):
 
     return redirect(url_for('wiki.home'))
 
-@mod_wiki.route('/search', methods=['POST', 'POST'])
-@mod_wiki.route('/search/', methods=['POST'])
+@mod_wiki.route('/search', methods=['GET', 'POST'])
+@mod_wiki.route('/search/', methods=['GET', 'POST'])
+@mod_wiki.route('/search/<int:page_num>', methods=['GET'])
+@mod_wiki.route('/search/<int:page_num>/', methods=['GET'])
 @login_required
-def search():
-    """Search for a specific wiki with keyword"""
+def search(page_num=1):
+    """Search the wiki for pages containing some words
+
+    The form POSTs here and is redirected to a GET with the words in the
+    query string, so every page of results has its own URL.
+    """
     form = SearchForm()
     if form.validate_on_submit():
-        # Show the user the list of results (form.results maybe?)
-        return render_template('wiki/search.html', form=form, results=form.results)
+        return redirect(url_for('wiki.search', q=form.search_box.data))
+    elif request.method == 'GET' and request.args.get('q'):
+        query = request.args['q']
+        form.search_box.data = query
+        results = search_pages(query, page=page_num)
+        return render_template('wiki/search.html', form=form, query=query, results=results)
     else:
         flash_form_errors(form)
-        return render_template('wiki/home.html', form=form)
+        return redirect(url_for('wiki.home'))
 
 @mod_wiki.route('/question', methods=['GET', 'POST'])
 @mod_wiki.route('/question/', methods=['GET', 'POST'])
@@ -171,7 +173,7 @@ def question():
             ),
             content=content,
         )
-        mail.send(msg)
+        OutboxMessage.queue(msg)
         flash("Email Sent!", "alert-success")
         return redirect(url_for('wiki.home'))
     else:
@@ -56,16 +56,11 @@ class SearchForm(Form):
     def __init__(self, *args, **kwargs):
         """Initialize the SearchForm form"""
         Form.__init__(self, *args, **kwargs)
-        self.results = []
 
     def validate(self):
         """Validate the form"""
         if not Form.validate(self):
             return False
-
-        query = '%{}%'.format(self.search_box.data)
-        self.results = WikiPage.query.filter(WikiPage.name.like(query) | WikiPage.content.like(query)).all()
-
         return True
 
     search_box = TextField(
@@ -4,12 +4,51 @@ Author: Logan Gore
 This file is responsible for defining models that belong in the wiki module.
 """
 
+import atexit
+import collections
 import datetime
+import hashlib
+import threading
+import time
+import traceback
 
+from markdown import Markdown
+
+from markdown.extensions import extra
+from markdown.extensions import nl2br
+from markdown.extensions import toc
+from markdown.extensions import wikilinks
+
+from dli_app import app
 from dli_app import db
 
 from flask_login import current_user
 
+
+# Markdown instances keep state between conversions, so each thread gets its own
+_MARKDOWN = threading.local()
+
+
+def render_markdown(content):
+    """Convert wiki Markdown into (html, table of contents html)"""
+    md = getattr(_MARKDOWN, 'md', None)
+    if md is None:
+        md = _MARKDOWN.md = Markdown(extensions=[
+            extra.ExtraExtension(),
+            nl2br.Nl2BrExtension(),
+            toc.TocExtension(),
+            wikilinks.WikiLinkExtension(base_url='/wiki/'),
+        ])
+    md.reset()
+    html = md.convert(content or '')
+    return html, md.toc
+
+
+def content_hash(content):
+    """Return the hash that identifies the rendering of some content"""
+    return hashlib.sha1((content or '').encode('utf-8')).hexdigest()
+
+
 class WikiPage(db.Model):
     """Model for a page on the wiki"""
     __tablename__ = 'wiki_page'
@@ -19,6 +58,11 @@ class WikiPage(db.Model):
     modtime = db.Column(db.String(32))
     editor = db.Column(db.String(64))
     views = db.Column(db.Integer, index=True)
+    html = db.Column(db.Text)
+    toc = db.Column(db.Text)
+    rendered_hash = db.Column(db.String(40))
+    # Number of words in the search index for this page (see search.py)
+    num_terms = db.Column(db.Integer, default=0)
 
     def __init__(self, name, content):
         """Initiialize a WikiPage model"""
@@ -30,11 +74,25 @@ class WikiPage(db.Model):
         else:
             self.editor = 'DLI'
         self.views = 0
+        self.render()
 
     def __repr__(self):
         """Return a descriptive representation of a WikiPage"""
         return '<WikiPage %r>' % self.name
 
+    def render(self):
+        """Render the page's content into html and toc if it has changed
+
+        Returns whether anything was rendered, in which case the caller
+        should commit.
+        """
+        digest = content_hash(self.content)
+        if digest == self.rendered_hash:
+            return False
+        self.html, self.toc = render_markdown(self.content)
+        self.rendered_hash = digest
+        return True
+
     def with_toc(self):
         """Return the page contents with a Table of Contents header"""
         full_text = """
@@ -43,3 +101,71 @@ class WikiPage(db.Model):
         {content}
         """.format(content=self.content)
         return full_text
+
+
+class ViewCounter(object):
+    """Buffer of WikiPage views written behind to wiki_page.views
+
+    Arguments:
+    interval - seconds between writes; with 0 every view is written at once
+
+    Viewing a page only bumps an in-memory counter. A background thread
+    adds the buffered counts to the table with one batched UPDATE every
+    interval seconds, on its own connection, so page views never hold a
+    write transaction. Each process buffers its own views; whatever is left
+    is written when the process exits.
+    """
+
+    def __init__(self, interval):
+        """Initialize a ViewCounter"""
+        self.interval = interval
+        self._counts = collections.Counter()
+        self._lock = threading.Lock()
+        self._flusher = None
+
+    def record(self, page_id):
+        """Count one view of a WikiPage"""
+        with self._lock:
+            self._counts[page_id] += 1
+            if self.interval > 0 and (self._flusher is None or not self._flusher.is_alive()):
+                self._flusher = threading.Thread(target=self._flush_forever)
+                self._flusher.daemon = True
+                self._flusher.start()
+        if self.interval <= 0:
+            self.flush()
+
+    def flush(self):
+        """Write every buffered view to the database"""
+        with self._lock:
+            counts, self._counts = self._counts, collections.Counter()
+        if not counts:
+            return
+        table = WikiPage.__table__
+        try:
+            db.engine.execute(
+                table.update()
+                .where(table.c.id == db.bindparam('page_id'))
+                .values(views=table.c.views + db.bindparam('increment')),
+                [
+                    {'page_id': page_id, 'increment': increment}
+                    for page_id, increment in counts.items()
+                ],
+            )
+        except Exception:
+            # Keep the views for the next attempt
+            with self._lock:
+                self._counts.update(counts)
+            raise
+
+    def _flush_forever(self):
+        """Call flush every interval seconds"""
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception:  # pylint: disable=broad-except
+                traceback.print_exc()
+
+
+WIKI_VIEWS = ViewCounter(interval=app.config.get('WIKI_VIEWS_FLUSH_SECONDS', 10))
+atexit.register(WIKI_VIEWS.flush)
@@ -0,0 +1,241 @@
+"""Full-text search of the wiki
+
+Author: Logan Gore
+This file is responsible for the inverted index behind the wiki search. Every
+word of a page's name and content is stored in the wiki_term table with the
+number of times it appears, so a search only reads the rows of the words
+searched for instead of scanning every page body. The index is kept up to date
+by mapper events whenever a WikiPage is added, edited or deleted, and results
+are ranked with BM25 and returned a page at a time with highlighted snippets.
+"""
+
+import collections
+import math
+import re
+
+from markupsafe import Markup
+from markupsafe import escape
+
+from sqlalchemy import event
+from sqlalchemy import inspect
+from sqlalchemy.dialects import mysql
+
+from dli_app import db
+
+from dli_app.mod_wiki.models import WikiPage
+
+
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+# The longest word indexed
+MAX_TERM = 64
+
+# A word in the page name counts as this many words of content
+NAME_WEIGHT = 3
+
+# BM25 term frequency saturation and length normalization
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# Only this many distinct words of a search are used
+MAX_SEARCH_TERMS = 16
+
+# Number of words shown on each side of the first match in a snippet
+SNIPPET_CONTEXT = 12
+
+
+def tokenize(text):
+    """Return the lowercased words of some text"""
+    return [word.lower()[:MAX_TERM] for word in WORD_RE.findall(text or '')]
+
+
+class WikiTerm(db.Model):
+    """Model for the number of times a word appears in a WikiPage"""
+    __tablename__ = 'wiki_term'
+    __table_args__ = (
+        # Also the index used to find the pages containing a word
+        db.UniqueConstraint('term', 'page_id', name='uq_wiki_term_term_page_id'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    # Compared byte for byte on MySQL, whose default collations would make
+    # words that differ only in their accents collide in the unique constraint
+    term = db.Column(
+        db.String(MAX_TERM).with_variant(mysql.VARCHAR(MAX_TERM, binary=True), 'mysql')
+    )
+    page_id = db.Column(db.Integer, db.ForeignKey('wiki_page.id'), index=True)
+    count = db.Column(db.Integer)
+
+    def __repr__(self):
+        """Return a descriptive representation of a WikiTerm"""
+        return '<WikiTerm {term!r} x{count} in page {page_id}>'.format(
+            term=self.term,
+            count=self.count,
+            page_id=self.page_id,
+        )
+
+
+def term_counts(page):
+    """Return a Counter of the indexed words of a WikiPage"""
+    counts = collections.Counter(tokenize(page.content))
+    for word in tokenize(page.name):
+        counts[word] += NAME_WEIGHT
+    return counts
+
+
+def write_terms(connection, page_id, counts):
+    """Replace the indexed words of a page"""
+    table = WikiTerm.__table__
+    connection.execute(table.delete().where(table.c.page_id == page_id))
+    if counts:
+        connection.execute(table.insert(), [
+            {'term': term, 'page_id': page_id, 'count': count}
+            for term, count in counts.items()
+        ])
+
+
+def reindex(page):
+    """Rebuild the index of a WikiPage within the current session"""
+    counts = term_counts(page)
+    page.num_terms = sum(counts.values())
+    write_terms(db.session.connection(), page.id, counts)
+
+
+@event.listens_for(WikiPage, 'before_insert')
+@event.listens_for(WikiPage, 'before_update')
+def _count_terms(mapper, connection, page):  # pylint: disable=unused-argument
+    """Count the words of a new or edited page before it is written"""
+    state = inspect(page)
+    if state.key is None or state.attrs.content.history.has_changes() \
+            or state.attrs.name.history.has_changes():
+        page._term_counts = term_counts(page)  # pylint: disable=protected-access
+        page.num_terms = sum(page._term_counts.values())  # pylint: disable=protected-access
+
+
+@event.listens_for(WikiPage, 'after_insert')
+@event.listens_for(WikiPage, 'after_update')
+def _write_terms(mapper, connection, page):  # pylint: disable=unused-argument
+    """Write the words counted by _count_terms once the page has an id"""
+    counts = page.__dict__.pop('_term_counts', None)
+    if counts is not None:
+        write_terms(connection, page.id, counts)
+
+
+@event.listens_for(WikiPage, 'before_delete')
+def _remove_terms(mapper, connection, page):  # pylint: disable=unused-argument
+    """Remove a page's words before the page itself"""
+    write_terms(connection, page.id, None)
+
+
+def snippet(content, terms):
+    """Return escaped text around the first match with every match marked"""
+    words = list(WORD_RE.finditer(content or ''))
+    first = next((idx for idx, word in enumerate(words) if word.group().lower() in terms), 0)
+    window = words[max(first - SNIPPET_CONTEXT, 0):first + SNIPPET_CONTEXT + 1]
+    if not window:
+        return Markup('')
+
+    start = window[0].start() if first > SNIPPET_CONTEXT else 0
+    end = window[-1].end()
+    parts = [Markup('&hellip;')] if start > 0 else []
+    pos = start
+    for word in window:
+        if word.group().lower() in terms:
+            parts.append(escape(content[pos:word.start()]))
+            parts.append(Markup('<mark>{}</mark>').format(word.group()))
+            pos = word.end()
+    parts.append(escape(content[pos:end]))
+    if end < len(content.rstrip()):
+        parts.append(Markup('&hellip;'))
+    return Markup('').join(parts)
+
+
+SearchResult = collections.namedtuple('SearchResult', ['page', 'score', 'snippet'])
+
+
+class SearchResults(object):
+    """One page of ranked SearchResults
+
+    Has the same paging attributes as a flask_sqlalchemy Pagination, so the
+    templates can page through it the same way.
+    """
+
+    def __init__(self, items, page, per_page, total):
+        """Initialize a SearchResults"""
+        self.items = items
+        self.page = page
+        self.per_page = per_page
+        self.total = total
+
+    @property
+    def pages(self):
+        """The number of pages of results"""
+        return max(int(math.ceil(self.total / float(self.per_page))), 1)
+
+    @property
+    def has_prev(self):
+        """Whether there is a page of results before this one"""
+        return self.page > 1
+
+    @property
+    def prev_num(self):
+        """The number of the previous page of results"""
+        return self.page - 1
+
+    @property
+    def has_next(self):
+        """Whether there is a page of results after this one"""
+        return self.page < self.pages
+
+    @property
+    def next_num(self):
+        """The number of the next page of results"""
+        return self.page + 1
+
+
+def search_pages(text, page=1, per_page=10):
+    """Return the given page of WikiPages matching some text, best first
+
+    Pages are scored with BM25 over the indexed words of their name and
+    content; a page matches if it contains any of the words searched for.
+    Only the index rows of those words are read, plus the pages shown.
+    """
+    terms = sorted(set(tokenize(text)))[:MAX_SEARCH_TERMS]
+    page = max(page, 1)
+    if not terms:
+        return SearchResults([], page, per_page, 0)
+
+    num_pages, total_terms = db.session.query(
+        db.func.count(WikiPage.id),
+        db.func.sum(WikiPage.num_terms),
+    ).one()
+    avg_length = float(total_terms or 0) / num_pages if num_pages else 0
+    avg_length = avg_length or 1.0
+
+    postings = db.session.query(
+        WikiTerm.page_id,
+        WikiTerm.term,
+        WikiTerm.count,
+        WikiPage.num_terms,
+    ).join(WikiPage, WikiPage.id == WikiTerm.page_id).filter(WikiTerm.term.in_(terms)).all()
+
+    doc_freq = collections.Counter(term for _, term, _, _ in postings)
+    scores = collections.defaultdict(float)
+    for page_id, term, count, length in postings:
+        idf = math.log(1 + (num_pages - doc_freq[term] + 0.5) / (doc_freq[term] + 0.5))
+        norm = 1 - BM25_B + BM25_B * (length or 0) / avg_length
+        scores[page_id] += idf * count * (BM25_K1 + 1) / (count + BM25_K1 * norm)
+
+    ranked = sorted(scores, key=lambda page_id: (-scores[page_id], page_id))
+    shown = ranked[(page - 1) * per_page:page * per_page]
+    pages = {}
+    if shown:
+        pages = {
+            wiki_page.id: wiki_page
+            for wiki_page in WikiPage.query.filter(WikiPage.id.in_(shown))
+        }
+    items = [
+        SearchResult(pages[page_id], scores[page_id], snippet(pages[page_id].content, set(terms)))
+        for page_id in shown
+        if page_id in pages
+    ]
+    return SearchResults(items, page, per_page, len(ranked))
@@ -0,0 +1,280 @@
+"""SQL query profiler for development and CI
+
+Author: Logan Gore
+This file is responsible for finding the pages that run too many queries,
+which in this app almost always means a lazy relationship load inside a loop
+(an N+1). While a QueryProfile is active every statement run by its thread is
+recorded with its time and the lines of app code (and templates) that ran it,
+and statements are grouped by their SQL with literals and IN lists
+normalized, so the same lazy load repeated for every row of a page shows up
+as one group with a large count.
+
+Profiling is opt-in: with QUERY_PROFILER set in the config every request is
+profiled, a summary of its queries is added to the bottom of HTML pages (or
+returned instead of the page as JSON with ?_queries=json) and requests over
+their query budget are logged, or fail outright with QUERY_BUDGET_STRICT.
+Scripts and tests can use QueryProfile directly; see check().
+"""
+
+import collections
+import logging
+import os
+import re
+import threading
+
+from flask import jsonify
+from flask import render_template
+from flask import request
+
+from dli_app.instrumentation import QueryWatcher
+
+
+LOG = logging.getLogger('dli_app.profiler')
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(APP_DIR)
+# This file's path without its extension, so .py and .pyc both match
+PROFILER_PATH = os.path.splitext(os.path.abspath(__file__))[0]
+
+# Number of app (or template) frames recorded for every statement
+MAX_FRAMES = 3
+
+STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+NUMBER_LITERAL = re.compile(r'\b\d+(?:\.\d+)?\b')
+PLACEHOLDER_LIST = re.compile(r'\(\s*(?:\?|%s|:\w+)(?:\s*,\s*(?:\?|%s|:\w+))*\s*\)')
+WHITESPACE = re.compile(r'\s+')
+
+
+def normalize_sql(statement):
+    """Return a statement with its literals and IN lists collapsed to ?"""
+    statement = STRING_LITERAL.sub('?', statement)
+    statement = NUMBER_LITERAL.sub('?', statement)
+    statement = PLACEHOLDER_LIST.sub('(?)', statement)
+    return WHITESPACE.sub(' ', statement).strip()
+
+
+def call_site(frame):
+    """Return the innermost app and template lines on a frame's stack
+
+    Template lines are the lines of the .html file, not of the Python Jinja
+    compiled it to.
+    """
+    sites = []
+    while frame is not None and len(sites) < MAX_FRAMES:
+        template = frame.f_globals.get('__jinja_template__')
+        filename = frame.f_code.co_filename
+        if template is not None:
+            sites.append('{name}:{line}'.format(
+                name=template.name,
+                line=template.get_corresponding_lineno(frame.f_lineno),
+            ))
+        elif filename.startswith(APP_DIR) and os.path.splitext(filename)[0] != PROFILER_PATH:
+            sites.append('{path}:{line} in {func}'.format(
+                path=os.path.relpath(filename, ROOT_DIR),
+                line=frame.f_lineno,
+                func=frame.f_code.co_name,
+            ))
+        frame = frame.f_back
+    return tuple(sites)
+
+
+class QueryBudgetExceeded(AssertionError):
+    """Raised when a profiled block runs more queries than it is allowed"""
+    pass
+
+
+class QueryGroup(object):
+    """Every run of one normalized statement within a profile"""
+
+    __slots__ = ('sql', 'count', 'seconds', 'slowest', 'sites')
+
+    def __init__(self, sql):
+        """Initialize a QueryGroup"""
+        self.sql = sql
+        self.count = 0
+        self.seconds = 0.0
+        self.slowest = 0.0
+        # {call site: number of runs from there}
+        self.sites = collections.Counter()
+
+    def to_dict(self):
+        """Return the group as a dict for a JSON report"""
+        return {
+            'sql': self.sql,
+            'count': self.count,
+            'ms': round(self.seconds * 1000, 2),
+            'slowest_ms': round(self.slowest * 1000, 2),
+            'sites': [
+                {'stack': list(site), 'count': count}
+                for site, count in self.sites.most_common()
+            ],
+        }
+
+
+class QueryProfile(QueryWatcher):
+    """Context manager that records the SQL statements run by this thread
+
+    Arguments:
+    repeat_threshold - a statement run at least this many times is reported
+        as repeated (a likely N+1)
+    slow_ms - a statement taking at least this long is reported as slow
+
+    Usage:
+    with QueryProfile() as profile:
+        client.get('/reports/all/')
+    profile.check(max_queries=10)
+    """
+
+    def __init__(self, repeat_threshold=5, slow_ms=100):
+        """Initialize a QueryProfile"""
+        self.repeat_threshold = repeat_threshold
+        self.slow_ms = slow_ms
+        self.count = 0
+        self.seconds = 0.0
+        # {normalized sql: QueryGroup}, in the order first run
+        self.groups = collections.OrderedDict()
+
+    def on_query(self, statement, seconds, frame):
+        """Record a statement with the app code that ran it"""
+        self.add(normalize_sql(statement), seconds, call_site(frame))
+
+    def add(self, sql, seconds, site):
+        """Record one run of a normalized statement"""
+        group = self.groups.get(sql)
+        if group is None:
+            group = self.groups[sql] = QueryGroup(sql)
+        group.count += 1
+        group.seconds += seconds
+        group.slowest = max(group.slowest, seconds)
+        group.sites[site] += 1
+        self.count += 1
+        self.seconds += seconds
+
+    def repeated(self):
+        """Return the groups run at least repeat_threshold times, worst first"""
+        return sorted(
+            (group for group in self.groups.values() if group.count >= self.repeat_threshold),
+            key=lambda group: group.count,
+            reverse=True,
+        )
+
+    def slow(self):
+        """Return the groups with a run of at least slow_ms, slowest first"""
+        return sorted(
+            (group for group in self.groups.values() if group.slowest * 1000 >= self.slow_ms),
+            key=lambda group: group.slowest,
+            reverse=True,
+        )
+
+    def report(self):
+        """Return the profile as a dict for a JSON report"""
+        return {
+            'queries': self.count,
+            'ms': round(self.seconds * 1000, 2),
+            'repeated': [group.to_dict() for group in self.repeated()],
+            'slow': [group.to_dict() for group in self.slow()],
+            'groups': [group.to_dict() for group in self.groups.values()],
+        }
+
+    def check(self, max_queries=None, max_repeats=None):
+        """Raise QueryBudgetExceeded if the profile is over either budget
+
+        Arguments:
+        max_queries - the most statements that may have run in total
+        max_repeats - the most times any one normalized statement may have run
+        """
+        problems = []
+        if max_queries is not None and self.count > max_queries:
+            problems.append('{} queries ran (budget {})'.format(self.count, max_queries))
+        if max_repeats is not None:
+            for group in self.groups.values():
+                if group.count > max_repeats:
+                    problems.append('{count} runs (budget {budget}) of {sql} from {site}'.format(
+                        count=group.count,
+                        budget=max_repeats,
+                        sql=group.sql,
+                        site=', '.join(group.sites.most_common(1)[0][0]) or 'outside the app',
+                    ))
+        if problems:
+            raise QueryBudgetExceeded('; '.join(problems))
+
+
+class RequestProfiler(object):
+    """Profiles the queries of every request of an app
+
+    Configured from the app's config:
+    QUERY_PROFILER_REPEATS - see QueryProfile's repeat_threshold (default 5)
+    QUERY_PROFILER_SLOW_MS - see QueryProfile's slow_ms (default 100)
+    QUERY_BUDGET - the most queries any request may run (default: no limit)
+    QUERY_BUDGETS - {endpoint: most queries} overriding QUERY_BUDGET
+    QUERY_BUDGET_STRICT - raise QueryBudgetExceeded for a request over its
+        budget instead of logging a warning, so it fails a test
+    """
+
+    def __init__(self):
+        """Initialize a RequestProfiler"""
+        self._local = threading.local()
+        self.config = {}
+
+    def instrument(self, app):
+        """Profile every request the app handles"""
+        self.config = app.config
+        app.before_request(self._start_request)
+        app.after_request(self._finish_request)
+        app.teardown_request(self._teardown_request)
+
+    def _start_request(self):
+        """Start profiling the current request"""
+        profile = QueryProfile(
+            repeat_threshold=self.config.get('QUERY_PROFILER_REPEATS', 5),
+            slow_ms=self.config.get('QUERY_PROFILER_SLOW_MS', 100),
+        )
+        self._local.profile = profile.__enter__()
+
+    def _teardown_request(self, exc=None):  # pylint: disable=unused-argument
+        """Stop profiling the current request, however it ended"""
+        profile = getattr(self._local, 'profile', None)
+        if profile is not None:
+            self._local.profile = None
+            profile.__exit__()
+
+    def budget_for(self, endpoint):
+        """Return the query budget of an endpoint (or None)"""
+        return self.config.get('QUERY_BUDGETS', {}).get(endpoint, self.config.get('QUERY_BUDGET'))
+
+    def _finish_request(self, response):
+        """Report on the queries of the current request"""
+        profile = getattr(self._local, 'profile', None)
+        if profile is None:
+            return response
+        self._teardown_request()
+
+        response.headers['X-Query-Count'] = str(profile.count)
+        for group in profile.repeated():
+            LOG.warning('%s ran %d times in %s from %s', group.sql, group.count,
+                        request.path, ', '.join(group.sites.most_common(1)[0][0]))
+
+        try:
+            profile.check(max_queries=self.budget_for(request.endpoint))
+        except QueryBudgetExceeded as e:
+            if self.config.get('QUERY_BUDGET_STRICT'):
+                raise
+            LOG.warning('%s: %s', request.path, e)
+
+        if request.args.get('_queries') == 'json':
+            return jsonify(profile.report())
+
+        if response.mimetype == 'text/html' and not response.direct_passthrough:
+            body = response.get_data(as_text=True)
+            end = body.rfind('</body>')
+            if end != -1:
+                footer = render_template(
+                    'partials/_query_profile.html',
+                    profile=profile,
+                    budget=self.budget_for(request.endpoint),
+                )
+                response.set_data(body[:end] + footer + body[end:])
+        return response
+
+
+QUERY_PROFILER = RequestProfiler()
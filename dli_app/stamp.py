@@ -0,0 +1,71 @@
+"""Cross-process change stamps
+
+Author: Logan Gore
+This file is responsible for letting the in-process caches of one process
+(a serve.py worker, excel_worker.py, a command-line tool) tell the others
+that the data behind them changed. A StampFile holds a random token that is
+replaced on every change; a process that finds a token it hasn't seen knows
+to drop what it cached.
+"""
+
+import binascii
+import os
+import tempfile
+
+
+class StampFile(object):
+    """A file whose contents change every time some process bumps it
+
+    Arguments:
+    path - where the stamp lives; with None, bump() does nothing and
+        changed() is always False
+
+    Unlike an mtime, a new token is never equal to the old one, so two bumps
+    in quick succession can't be mistaken for none. Not thread-safe; callers
+    hold their own lock.
+    """
+
+    def __init__(self, path):
+        """Initialize a StampFile"""
+        self.path = path
+        self._token = self._read()
+
+    def _read(self):
+        """Return the current token (or None)"""
+        if self.path is None:
+            return None
+        try:
+            with open(self.path, 'rb') as stamp:
+                return stamp.read()
+        except (IOError, OSError):
+            return None
+
+    def changed(self):
+        """Return whether another process has bumped the stamp since we looked"""
+        token = self._read()
+        if token == self._token:
+            return False
+        self._token = token
+        return True
+
+    def bump(self):
+        """Write a new token, telling other processes that something changed"""
+        if self.path is None:
+            return
+        token = binascii.hexlify(os.urandom(16))
+        try:
+            handle, tmp_path = tempfile.mkstemp(
+                dir=os.path.dirname(os.path.abspath(self.path)),
+                suffix='.stamp.tmp',
+            )
+        except (IOError, OSError):
+            return
+        try:
+            with os.fdopen(handle, 'wb') as stamp:
+                stamp.write(token)
+            # Renamed into place so a reader never sees a partial token
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError):
+            os.remove(tmp_path)
+            return
+        self._token = token
@@ -0,0 +1,48 @@
+"""A pool of worker processes that generate Excel sheets in the background
+
+Author: Logan Gore
+This file is responsible for running the ExcelJobs that the download page
+enqueues. Each worker process polls the excel_job table, claims the oldest
+queued job and writes its sheet into the Excel cache. Run it alongside the
+site (like site_daemons.py); without it, downloads that miss the cache stay
+queued.
+"""
+
+import argparse
+import multiprocessing
+
+from dli_app import db
+
+from dli_app.mod_reports.jobs import work
+
+
+PARSER = argparse.ArgumentParser(description='DLI App Excel Worker Pool')
+PARSER.add_argument(
+    '-w', '--workers', type=int, default=multiprocessing.cpu_count(),
+    help='Number of worker processes to run'
+)
+PARSER.add_argument(
+    '-i', '--poll-interval', type=float, default=1.0,
+    help='Seconds to wait between checks for new jobs when the queue is empty'
+)
+
+
+def start_worker(poll_interval):
+    """Run one worker process"""
+    # Never share the parent's pooled connections across processes
+    db.engine.dispose()
+    work(poll_interval)
+
+
+if __name__ == '__main__':
+    ARGS = PARSER.parse_args()
+    db.engine.dispose()
+
+    workers = [
+        multiprocessing.Process(target=start_worker, args=(ARGS.poll_interval,))
+        for _ in range(ARGS.workers)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
@@ -0,0 +1,316 @@
+"""A helper utility to fill the DLI App with a synthetic dataset
+
+Author: Logan Gore
+This file is responsible for turning a database created with
+create_db.py --populate into one the size of a few years of real use, so the
+benchmarks in benchmark.py have something to measure. It adds users, reports,
+charts, tags and wiki pages, and a value for every Field on every working day
+of the range: each Field gets its own level, trend, weekly pattern and noise
+for its type, so charts and rollups look like real data. Everything is drawn
+from one seeded random generator, so the same arguments always produce the
+same dataset.
+
+Values are written through the same path the site uses, so the rollups are
+kept up to date and re-running the script over an existing range is safe.
+"""
+
+import argparse
+import datetime
+import math
+import random
+import sys
+import time
+
+from dli_app import db
+
+from dli_app.mod_auth.models import Department
+from dli_app.mod_auth.models import Location
+from dli_app.mod_auth.models import User
+
+from dli_app.mod_reports.excel import EXCEL_CACHE
+from dli_app.mod_reports.ingest import store_data_points
+from dli_app.mod_reports.models import Chart
+from dli_app.mod_reports.models import ChartType
+from dli_app.mod_reports.models import Field
+from dli_app.mod_reports.models import FieldData
+from dli_app.mod_reports.models import FieldType
+from dli_app.mod_reports.models import Report
+from dli_app.mod_reports.models import Tag
+
+from dli_app.mod_wiki.models import WikiPage
+
+
+PARSER = argparse.ArgumentParser(description='DLI App Synthetic Data Tool')
+PARSER.add_argument(
+    '-y', '--years', type=float, default=3,
+    help='Number of years of daily data to generate'
+)
+PARSER.add_argument(
+    '-e', '--end', default=None,
+    help='The last ds to generate data for (default: today)'
+)
+PARSER.add_argument(
+    '-u', '--users', type=int, default=50,
+    help='Number of users to add'
+)
+PARSER.add_argument(
+    '-r', '--reports', type=int, default=40,
+    help='Number of reports to add'
+)
+PARSER.add_argument(
+    '-c', '--charts', type=int, default=80,
+    help='Number of charts to add'
+)
+PARSER.add_argument(
+    '-w', '--wiki-pages', type=int, default=300,
+    help='Number of wiki pages to add'
+)
+PARSER.add_argument(
+    '-s', '--seed', type=int, default=840,
+    help='Seed of the random generator; the same seed gives the same data'
+)
+PARSER.add_argument(
+    '-b', '--batch-size', type=int, default=10000,
+    help='Number of values to write per transaction'
+)
+PARSER.add_argument(
+    '-v', '--verbose', action='store_true',
+    help='Show extra output about which stage the script is executing'
+)
+
+TAG_NAMES = [
+    'daily', 'weekly', 'monthly', 'sales', 'production', 'shipping',
+    'quality', 'service', 'omaha', 'new albany', 'press', 'art', 'lates',
+]
+
+STATUSES = ['Running', 'Running', 'Running', 'Down', 'Maintenance', 'Waiting on plates']
+
+WORDS = (
+    'order proof press plate art customer ship invoice rush quote stamp '
+    'embroidery screen print digital vendor return credit policy approval '
+    'deadline schedule overtime safety holiday training inventory pallet '
+    'carrier freight sample color ink vinyl label box carton review'
+).split()
+
+
+def vprint(s='', endl='\n'):
+    """Print a string if verbose mode is enabled"""
+    if ARGS.verbose:
+        sys.stderr.write('{s}{endl}'.format(s=s, endl=endl))
+
+
+def sentence(rng, words):
+    """Return a random sentence of the given number of words"""
+    text = ' '.join(rng.choice(WORDS) for _ in range(words))
+    return text[0].upper() + text[1:] + '.'
+
+
+class FieldModel(object):
+    """The made-up behavior of one Field over time
+
+    A value is the Field's level, grown by its yearly trend, scaled by the
+    weekday pattern and by a yearly season, plus noise.
+    """
+
+    def __init__(self, rng, field):
+        """Initialize a FieldModel"""
+        self.rng = rng
+        self.field = field
+        self.type_name = field.type_name
+        name = field.name.lower()
+        if self.type_name == FieldType.CURRENCY:
+            self.level = rng.uniform(2000, 60000)
+        elif self.type_name == FieldType.DOUBLE:
+            self.level = rng.uniform(80, 98) if 'percent' in name else rng.uniform(1, 50)
+        elif self.type_name == FieldType.TIME:
+            # Minutes past the hour something happened
+            self.level = rng.uniform(20, 70)
+        else:
+            self.level = rng.choice([5, 20, 60, 150, 400, 1200])
+        self.trend = rng.uniform(-0.05, 0.15)
+        self.weekdays = [rng.uniform(0.8, 1.2) for _ in range(5)] + [rng.uniform(0.3, 0.6), 0]
+        self.season = rng.uniform(0, 0.25)
+        self.noise = rng.uniform(0.03, 0.15)
+
+    def value(self, date, years_in):
+        """Return the submitted value of the Field on a date (or None)"""
+        if self.type_name == FieldType.STRING:
+            return self.rng.choice(STATUSES) if self.rng.random() < 0.3 else None
+
+        scale = self.weekdays[date.weekday()]
+        if not scale:
+            return None
+        value = self.level * (1 + self.trend * years_in)
+        value *= scale * (1 + self.season * math.sin(2 * math.pi * date.timetuple().tm_yday / 365.0))
+        value *= max(0, self.rng.gauss(1, self.noise))
+
+        if self.type_name == FieldType.CURRENCY:
+            return '{:.2f}'.format(value)
+        elif self.type_name == FieldType.DOUBLE:
+            if self.level > 50:
+                # A percentage
+                value = min(value, 100.0)
+            return '{:.2f}'.format(value)
+        elif self.type_name == FieldType.TIME:
+            minutes = int(value)
+            return '{}:{:02d}'.format(minutes // 60 + 8, minutes % 60)
+        return str(int(round(value)))
+
+
+def generate_users(rng):
+    """Add ARGS.users users spread over every location and department"""
+    locations = Location.query.order_by(Location.id).all()
+    departments = Department.query.order_by(Department.id).all()
+
+    first = User.query.count()
+    users = []
+    for num in range(first, first + ARGS.users):
+        user = User(
+            name='Synthetic User {}'.format(num),
+            email='user{}@synthetic.dlireports.com'.format(num),
+            password='benchmark',
+            location=rng.choice(locations),
+            department=rng.choice(departments),
+        )
+        user.is_admin = rng.random() < 0.1
+        users.append(user)
+    db.session.add_all(users)
+    db.session.commit()
+    return User.query.order_by(User.id).all()
+
+
+def generate_tags():
+    """Add the synthetic tags that don't exist yet"""
+    existing = set(name for (name,) in db.session.query(Tag.name))
+    db.session.add_all([Tag(name) for name in TAG_NAMES if name not in existing])
+    db.session.commit()
+    return Tag.query.order_by(Tag.id).all()
+
+
+def generate_reports(rng, users, fields, tags):
+    """Add ARGS.reports reports of 10 to 80 fields each"""
+    first = Report.query.count()
+    reports = []
+    for num in range(first, first + ARGS.reports):
+        report = Report(
+            user=rng.choice(users),
+            name='Synthetic Report {}'.format(num),
+            fields=rng.sample(fields, min(len(fields), rng.randint(10, 80))),
+            tags=rng.sample(tags, rng.randint(1, 3)),
+        )
+        reports.append(report)
+    db.session.add_all(reports)
+    db.session.commit()
+
+    for user in users:
+        for report in rng.sample(reports, min(len(reports), rng.randint(0, 5))):
+            user.favorite(report)
+    db.session.commit()
+
+
+def generate_charts(rng, users, fields, tags):
+    """Add ARGS.charts charts of 1 to 6 numeric fields each"""
+    numeric = [field for field in fields if field.type_name != FieldType.STRING]
+    ctypes = ChartType.query.order_by(ChartType.id).all()
+    first = Chart.query.count()
+    charts = []
+    for num in range(first, first + ARGS.charts):
+        chart = Chart(
+            name='Synthetic Chart {}'.format(num),
+            with_table=rng.random() < 0.5,
+            user=rng.choice(users),
+            ctype=rng.choice(ctypes),
+            fields=rng.sample(numeric, min(len(numeric), rng.randint(1, 6))),
+            tags=rng.sample(tags, rng.randint(1, 3)),
+        )
+        charts.append(chart)
+    db.session.add_all(charts)
+    db.session.commit()
+
+    for user in users:
+        for chart in rng.sample(charts, min(len(charts), rng.randint(0, 5))):
+            user.favorite_chart(chart)
+    db.session.commit()
+
+
+def generate_wiki_pages(rng):
+    """Add ARGS.wiki_pages wiki pages of a few sections each"""
+    first = WikiPage.query.count()
+    for num in range(first, first + ARGS.wiki_pages):
+        sections = []
+        for _ in range(rng.randint(2, 6)):
+            sections.append('## {}\n\n{}\n'.format(
+                sentence(rng, rng.randint(2, 4))[:-1],
+                ' '.join(sentence(rng, rng.randint(6, 16)) for _ in range(rng.randint(2, 8))),
+            ))
+        db.session.add(WikiPage(
+            'synthetic-{}'.format(num),
+            '# Synthetic page {}\n\n{}'.format(num, '\n'.join(sections)),
+        ))
+        if num % 100 == 0:
+            db.session.commit()
+    db.session.commit()
+
+
+def generate_field_data(rng, fields):
+    """Write a value for every field on every day of the range"""
+    end = datetime.datetime.strptime(ARGS.end, '%Y-%m-%d').date() if ARGS.end \
+        else datetime.date.today()
+    start = end - datetime.timedelta(days=int(ARGS.years * 365) - 1)
+    models = [FieldModel(rng, field) for field in fields]
+
+    written = 0
+    rows = []
+    began = time.time()
+    date = start
+    while date <= end:
+        years_in = (date - start).days / 365.0
+        for model in models:
+            value = model.value(date, years_in)
+            if value is not None:
+                rows.append(FieldData.make_row(date, model.field, value))
+        if len(rows) >= ARGS.batch_size or date == end:
+            written += len(store_data_points(rows))
+            vprint('\tGenerated data through {} ({} values)'.format(date, written))
+            rows = []
+        date += datetime.timedelta(days=1)
+    EXCEL_CACHE.flush_invalidations()
+
+    elapsed = time.time() - began
+    print('Wrote {written} values for {fields} fields from {start} to {end} '
+          'in {secs:.1f}s'.format(
+              written=written,
+              fields=len(fields),
+              start=start,
+              end=end,
+              secs=elapsed,
+          ))
+
+
+def generate():
+    """Add the whole synthetic dataset"""
+    if Field.query.first() is None:
+        sys.exit('Populate the database first (create_db.py --populate)')
+
+    rng = random.Random(ARGS.seed)
+    fields = Field.query.order_by(Field.id).all()
+
+    vprint('Adding users...')
+    users = generate_users(rng)
+    vprint('Adding tags...')
+    tags = generate_tags()
+    vprint('Adding reports...')
+    generate_reports(rng, users, fields, tags)
+    vprint('Adding charts...')
+    generate_charts(rng, users, fields, tags)
+    vprint('Adding wiki pages...')
+    generate_wiki_pages(rng)
+    vprint('Adding field data...')
+    generate_field_data(rng, fields)
+
+
+if __name__ == '__main__':
+    ARGS = PARSER.parse_args()
+    vprint('GenerateData script loaded.')
+    generate()
+    vprint('GenerateData script exiting successfully.')
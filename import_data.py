@@ -0,0 +1,175 @@
+"""A helper utility to import historical report data into the DLI App
+
+Author: Logan Gore
+This file is responsible for backfilling FieldData from CSV or XLSX files
+without going through the submit form one department-day at a time. Rows are
+streamed from each file, validated against the Fields and FieldTypes in the
+database, and written in large batches through the same upsert path the site
+uses, so re-importing a file is safe. Two layouts are understood, picked by
+the header row:
+
+    field,ds,value          - one value per row
+    ds,<field>,<field>,...  - one day per row, one column per field
+
+Fields are given by id or by identifier ('Department: Field name'). XLSX
+files need openpyxl installed.
+"""
+
+import argparse
+import csv
+import os
+import sys
+import time
+
+from dli_app.mod_reports.excel import EXCEL_CACHE
+from dli_app.mod_reports.ingest import FieldIndex
+from dli_app.mod_reports.ingest import changed_rows
+from dli_app.mod_reports.ingest import prepare_row
+from dli_app.mod_reports.ingest import store_data_points
+
+
+PARSER = argparse.ArgumentParser(description='DLI App Data Import Tool')
+PARSER.add_argument(
+    'files', nargs='+',
+    help='CSV or XLSX files to import'
+)
+PARSER.add_argument(
+    '-b', '--batch-size', type=int, default=5000,
+    help='Number of values to write per transaction'
+)
+PARSER.add_argument(
+    '-n', '--dry-run', action='store_true',
+    help='Validate the files and count what would change without writing'
+)
+PARSER.add_argument(
+    '-v', '--verbose', action='store_true',
+    help='Show extra output about which stage the script is executing'
+)
+
+
+def vprint(s='', endl='\n'):
+    """Print a string if verbose mode is enabled"""
+    if ARGS.verbose:
+        sys.stderr.write('{s}{endl}'.format(s=s, endl=endl))
+
+
+def read_csv(filepath):
+    """Yield the rows of a CSV file as lists of cells"""
+    with open(filepath) as infile:
+        for row in csv.reader(infile):
+            yield row
+
+
+def read_xlsx(filepath):
+    """Yield the rows of the first sheet of an XLSX file as lists of cells"""
+    try:
+        import openpyxl
+    except ImportError:
+        sys.exit('openpyxl is required to import XLSX files (pip install openpyxl)')
+
+    # read_only streams the sheet instead of loading it all into memory
+    workbook = openpyxl.load_workbook(filepath, read_only=True, data_only=True)
+    try:
+        for row in workbook.worksheets[0].iter_rows(values_only=True):
+            yield list(row)
+    finally:
+        workbook.close()
+
+
+READERS = {
+    '.csv': read_csv,
+    '.xlsx': read_xlsx,
+}
+
+
+def read_records(filepath):
+    """Yield (line number, field, ds, value) for every value in a file"""
+    ext = os.path.splitext(filepath)[1].lower()
+    if ext not in READERS:
+        sys.exit('Unsupported file type {!r} (expected .csv or .xlsx)'.format(filepath))
+
+    rows = READERS[ext](filepath)
+    header = [
+        cell.strip() if hasattr(cell, 'strip') else cell
+        for cell in next(rows, [])
+    ]
+    if not header:
+        return
+
+    lowered = [cell.lower() if hasattr(cell, 'lower') else cell for cell in header]
+    if set(['field', 'ds', 'value']).issubset(lowered):
+        field_col = lowered.index('field')
+        ds_col = lowered.index('ds')
+        value_col = lowered.index('value')
+        width = max(field_col, ds_col, value_col) + 1
+        for line, row in enumerate(rows, 2):
+            # Short rows are missing their trailing (empty) cells
+            row = list(row) + [None] * (width - len(row))
+            yield line, row[field_col], row[ds_col], row[value_col]
+    elif lowered[0] == 'ds':
+        for line, row in enumerate(rows, 2):
+            for col in range(1, min(len(header), len(row))):
+                yield line, header[col], row[0], row[col]
+    else:
+        sys.exit('{}: the header must contain field, ds and value columns '
+                 'or start with a ds column'.format(filepath))
+
+
+def import_files():
+    """Import every file and return the number of invalid records"""
+    index = FieldIndex()
+    vprint('Loaded {} fields.'.format(len(index.by_id)))
+
+    stats = {'read': 0, 'empty': 0, 'invalid': 0, 'changed': 0}
+    batch = []
+
+    def flush():
+        """Write (or just diff, in a dry run) the current batch"""
+        if ARGS.dry_run:
+            stats['changed'] += len(changed_rows(batch))
+        else:
+            stats['changed'] += len(store_data_points(batch))
+        vprint('\t{read} values read, {changed} changed so far'.format(**stats))
+        del batch[:]
+
+    start = time.time()
+    for filepath in ARGS.files:
+        vprint('Importing {}...'.format(filepath))
+        for line, ref, ds, value in read_records(filepath):
+            stats['read'] += 1
+            row, error = prepare_row(index, ref, ds, value)
+            if error is not None:
+                stats['invalid'] += 1
+                sys.stderr.write('{file}:{line}: {error}\n'.format(
+                    file=filepath,
+                    line=line,
+                    error=error,
+                ))
+            elif row is None:
+                stats['empty'] += 1
+            else:
+                batch.append(row)
+                if len(batch) >= ARGS.batch_size:
+                    flush()
+    if batch:
+        flush()
+    if not ARGS.dry_run:
+        EXCEL_CACHE.flush_invalidations()
+    elapsed = time.time() - start
+
+    print('{verb} {changed} of {read} values ({empty} empty, {invalid} invalid) '
+          'in {secs:.2f}s ({rate:.0f} rows/s)'.format(
+              verb='Would change' if ARGS.dry_run else 'Changed',
+              secs=elapsed,
+              rate=stats['read'] / elapsed if elapsed else 0,
+              **stats
+          ))
+    return stats['invalid']
+
+
+if __name__ == '__main__':
+    ARGS = PARSER.parse_args()
+    vprint('ImportData script loaded.')
+    if import_files():
+        sys.exit(1)
+    vprint('ImportData script exiting successfully.')
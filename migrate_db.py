@@ -0,0 +1,317 @@
+"""A helper utility to migrate an existing database for the DLI App
+
+Author: Logan Gore
+This file is responsible for bringing a database created by an older version
+of create_db.py up to date with the current models without losing any data.
+Every migration checks the live schema first, so running this script against
+an already up-to-date database is a no-op.
+"""
+
+import argparse
+import glob
+import os
+import sys
+
+from sqlalchemy import inspect
+from sqlalchemy import text
+
+from dli_app import db
+
+from dli_app.mod_reports.excel import EXCEL_FILE_DIR
+from dli_app.mod_reports.excel import ExcelCacheEntry
+from dli_app.mod_reports.jobs import ExcelJob
+from dli_app.mod_reports.models import DS_FORMAT
+from dli_app.mod_reports.models import Field
+from dli_app.mod_reports.models import FieldData
+from dli_app.mod_reports.models import FieldDataVersion
+from dli_app.mod_reports.models import Report
+from dli_app.mod_reports.models import to_date
+from dli_app.mod_reports.rollups import FieldDataRollup
+from dli_app.mod_reports.search import MAX_GRAM
+from dli_app.mod_reports.search import SearchEntry
+from dli_app.mod_reports.search import SearchGram
+from dli_app.mod_reports.search import rebuild_index
+
+from dli_app.mod_wiki.models import WikiPage
+from dli_app.mod_wiki.search import MAX_TERM
+from dli_app.mod_wiki.search import WikiTerm
+from dli_app.mod_wiki.search import reindex
+
+
+PARSER = argparse.ArgumentParser(description='DLI App DB Migration Tool')
+PARSER.add_argument(
+    '-b', '--batch-size', type=int, default=5000,
+    help='Number of rows to copy per batch when rebuilding a table'
+)
+PARSER.add_argument(
+    '-v', '--verbose', action='store_true',
+    help='Show extra output about which stage the script is executing'
+)
+ARGS = PARSER.parse_args()
+
+
+def vprint(s='', endl='\n'):
+    """Print a string if verbose mode is enabled"""
+    if ARGS.verbose:
+        sys.stderr.write('{s}{endl}'.format(s=s, endl=endl))
+
+
+def drop_index(table_name, index_name):
+    """Drop an index in a way the current DB dialect understands"""
+    if db.engine.dialect.name == 'mysql':
+        db.engine.execute(text('DROP INDEX {index} ON {table}'.format(
+            index=index_name,
+            table=table_name,
+        )))
+    else:
+        db.engine.execute(text('DROP INDEX {index}'.format(index=index_name)))
+
+
+def migrate_field_data_ds():
+    """Move FieldData.ds to a DATE column with a unique (field_id, ds) index
+
+    Rows whose ds can't be parsed are removed (the site could never look them
+    up anyway), ds strings missing their zero padding are padded, and
+    duplicate values for the same field and ds are collapsed to the most
+    recently submitted one, which is the value the site was already showing.
+    MySQL converts the column in place; other databases get the table rebuilt
+    from the current model with the rows copied in batches.
+    """
+    inspector = inspect(db.engine)
+    if 'field_data' not in inspector.get_table_names():
+        vprint('No field_data table found; nothing to migrate.')
+        return
+
+    ds_column = [col for col in inspector.get_columns('field_data') if col['name'] == 'ds'][0]
+    if 'DATE' in str(ds_column['type']).upper():
+        vprint('field_data.ds is already a DATE column.')
+        return
+
+    vprint('Removing values with an unparseable ds and padding the rest...')
+    bad_ds = []
+    unpadded_ds = {}
+    for row in db.engine.execute(text('SELECT DISTINCT ds FROM field_data')):
+        try:
+            padded = to_date(row['ds']).strftime(DS_FORMAT)
+        except (TypeError, ValueError):
+            bad_ds.append(row['ds'])
+            continue
+        if padded != row['ds']:
+            unpadded_ds[row['ds']] = padded
+    for ds in bad_ds:
+        vprint('\tRemoving values for ds {!r}'.format(ds))
+        db.engine.execute(text('DELETE FROM field_data WHERE ds = :ds'), ds=ds)
+    # So values for '2016-1-5' and '2016-01-05' count as duplicates below
+    for ds, padded in sorted(unpadded_ds.items()):
+        vprint('\tRenaming ds {!r} to {!r}'.format(ds, padded))
+        db.engine.execute(text('UPDATE field_data SET ds = :padded WHERE ds = :ds'), padded=padded, ds=ds)
+
+    vprint('Removing duplicate values for the same field and ds...')
+    db.engine.execute(text("""
+        DELETE FROM field_data WHERE id NOT IN (
+            SELECT id FROM (
+                SELECT MAX(id) AS id FROM field_data GROUP BY field_id, ds
+            ) AS newest
+        )
+    """))
+
+    if db.engine.dialect.name == 'mysql':
+        vprint('Converting field_data.ds in place...')
+        db.engine.execute(text('ALTER TABLE field_data MODIFY ds DATE'))
+        db.engine.execute(text(
+            'CREATE UNIQUE INDEX uq_field_data_field_id_ds ON field_data (field_id, ds)'
+        ))
+    else:
+        rebuild_field_data()
+    vprint('field_data migrated.')
+
+
+def rebuild_field_data():
+    """Recreate field_data from the current model and copy every row over"""
+    vprint('Renaming field_data to field_data_old...')
+    # Index names are global in some databases, so free them up first
+    for index in inspect(db.engine).get_indexes('field_data'):
+        drop_index('field_data', index['name'])
+    db.engine.execute(text('ALTER TABLE field_data RENAME TO field_data_old'))
+
+    vprint('Creating the new field_data table...')
+    FieldData.__table__.create(db.engine)
+
+    vprint('Copying rows...')
+    copied = 0
+    last_id = 0
+    while True:
+        # Page by primary key so no cursor stays open while we write
+        batch = db.engine.execute(
+            text(
+                'SELECT id, field_id, ds, ivalue, dvalue, svalue FROM field_data_old '
+                'WHERE id > :last_id ORDER BY id LIMIT :limit'
+            ),
+            last_id=last_id,
+            limit=ARGS.batch_size,
+        ).fetchall()
+        if not batch:
+            break
+
+        db.engine.execute(
+            FieldData.__table__.insert(),
+            [
+                {
+                    'id': row['id'],
+                    'field_id': row['field_id'],
+                    'ds': to_date(row['ds']),
+                    'ivalue': row['ivalue'],
+                    'dvalue': row['dvalue'],
+                    'svalue': row['svalue'],
+                }
+                for row in batch
+            ],
+        )
+        copied += len(batch)
+        last_id = batch[-1]['id']
+        vprint('\t{} rows copied'.format(copied))
+
+    db.engine.execute(text('DROP TABLE field_data_old'))
+
+
+def backfill_field_data_rollups():
+    """Build the weekly and monthly rollups of all existing FieldData"""
+    if FieldDataRollup.query.first() is not None or FieldData.query.first() is None:
+        vprint('field_data_rollup does not need a backfill.')
+        return
+
+    field_ids = [field_id for (field_id,) in db.session.query(Field.id).order_by(Field.id)]
+    for idx in range(0, len(field_ids), ARGS.batch_size):
+        batch = field_ids[idx:idx + ARGS.batch_size]
+        FieldDataRollup.rebuild(batch)
+        db.session.commit()
+        vprint('\tRollups built for {} of {} fields'.format(
+            min(idx + ARGS.batch_size, len(field_ids)),
+            len(field_ids),
+        ))
+
+
+def remove_orphaned_field_rows():
+    """Delete the rollups and data versions of fields that no longer exist
+
+    Deleting a field used to leave them behind.
+    """
+    for model in (FieldDataRollup, FieldDataVersion):
+        orphaned = model.query.filter(~model.field_id.in_(db.session.query(Field.id)))
+        vprint('\tRemoving {count} orphaned {table} rows'.format(
+            count=orphaned.delete(synchronize_session=False),
+            table=model.__tablename__,
+        ))
+    db.session.commit()
+
+
+def remove_unindexed_excel_files():
+    """Delete Excel sheets that aren't tracked by the Excel cache index
+
+    Sheets written before the cache had an index (named after the report
+    rather than its id) would otherwise sit in excel-files/ forever.
+    """
+    indexed = set(filename for (filename,) in db.session.query(ExcelCacheEntry.filename))
+    for filepath in glob.glob(os.path.join(EXCEL_FILE_DIR, '*.xlsx')):
+        if os.path.basename(filepath) not in indexed:
+            vprint('\tRemoving {}'.format(os.path.basename(filepath)))
+            os.remove(filepath)
+
+
+def add_wiki_page_columns():
+    """Add the columns WikiPage has gained to an existing wiki_page table"""
+    columns = [col['name'] for col in inspect(db.engine).get_columns('wiki_page')]
+    for name, col_type in [
+            ('html', 'TEXT'),
+            ('toc', 'TEXT'),
+            ('rendered_hash', 'VARCHAR(40)'),
+            ('num_terms', 'INTEGER'),
+    ]:
+        if name not in columns:
+            vprint('\tAdding wiki_page.{}'.format(name))
+            db.engine.execute(text('ALTER TABLE wiki_page ADD COLUMN {name} {type}'.format(
+                name=name,
+                type=col_type,
+            )))
+
+
+def render_wiki_pages():
+    """Render every wiki page that hasn't been rendered yet"""
+    rendered = 0
+    for page in WikiPage.query:
+        rendered += page.render()
+    db.session.commit()
+    vprint('\t{} wiki pages rendered'.format(rendered))
+
+
+def index_wiki_pages():
+    """Build the wiki search index for pages written before it existed"""
+    if WikiTerm.query.first() is not None or WikiPage.query.first() is None:
+        vprint('wiki_term does not need a backfill.')
+        return
+    for page in WikiPage.query:
+        reindex(page)
+    db.session.commit()
+
+
+def binary_wiki_terms():
+    """Compare wiki terms byte for byte
+
+    Words differing only in their accents broke the unique constraint on
+    MySQL.
+    """
+    if db.engine.dialect.name == 'mysql':
+        vprint('\tMaking wiki_term.term binary')
+        db.engine.execute(text('ALTER TABLE wiki_term MODIFY term VARCHAR({}) BINARY'.format(MAX_TERM)))
+
+
+def build_search_index():
+    """Index every report, chart, tag, field, department and user for search"""
+    if SearchEntry.query.first() is not None or Report.query.first() is None:
+        vprint('search_entry does not need a backfill.')
+        return
+    rebuild_index()
+    db.session.commit()
+
+
+def binary_search_grams():
+    """Compare search grams byte for byte and drop trailing whitespace
+
+    Grams differing only in their accents or trailing spaces broke the
+    unique constraint on MySQL; the index is rebuilt if it holds any grams
+    that are no longer written.
+    """
+    if db.engine.dialect.name == 'mysql':
+        vprint('\tMaking search_gram.gram binary')
+        db.engine.execute(text('ALTER TABLE search_gram MODIFY gram VARCHAR({}) BINARY'.format(MAX_GRAM)))
+    if SearchGram.query.filter(SearchGram.gram.like('% ')).first() is not None:
+        vprint('\tRebuilding the search index')
+        rebuild_index()
+        db.session.commit()
+
+
+MIGRATIONS = [
+    migrate_field_data_ds,
+    backfill_field_data_rollups,
+    remove_orphaned_field_rows,
+    remove_unindexed_excel_files,
+    add_wiki_page_columns,
+    render_wiki_pages,
+    index_wiki_pages,
+    binary_wiki_terms,
+    build_search_index,
+    binary_search_grams,
+]
+
+
+if __name__ == '__main__':
+    vprint('MigrateDB script loaded.')
+
+    # Create any brand new tables first; migrations only alter existing ones
+    db.create_all()
+
+    for migration in MIGRATIONS:
+        vprint('Running {}...'.format(migration.__name__))
+        migration()
+
+    vprint('MigrateDB script exiting successfully.')
@@ -0,0 +1,283 @@
+"""A production server for the DLI App
+
+Author: Logan Gore
+This file is responsible for serving the site from several processes, where
+run.py serves it from one process with the development server. A master
+process imports the app (and compiles every template) once, opens the
+listening socket and forks the workers, so the workers start instantly and
+share the preloaded code copy-on-write. Each worker handles one request at a
+time on the shared socket and exits after --max-requests requests (plus some
+jitter so they don't all restart together); the master replaces any worker
+that exits. GET /health/ reports which worker answered.
+
+Signals to the master:
+    TERM, INT - stop; every worker finishes the request it is handling
+    HUP - graceful restart: the master re-executes itself on the same socket,
+        loading any new code, starts new workers and then stops the old
+        ones, so no connection is refused
+"""
+
+import argparse
+import errno
+import logging
+import multiprocessing
+import os
+import random
+import signal
+import socket
+import sys
+import time
+import traceback
+
+from werkzeug.serving import BaseWSGIServer
+
+from dli_app import app
+from dli_app import db
+
+from dli_app.mod_reports.excel import EXCEL_CACHE
+
+from dli_app.mod_wiki.models import WIKI_VIEWS
+
+
+PARSER = argparse.ArgumentParser(description='DLI App Production Server')
+PARSER.add_argument(
+    '-b', '--bind', default=None,
+    help='The host:port to listen on (default: SERVER_HOST:SERVER_PORT from the config)'
+)
+PARSER.add_argument(
+    '-w', '--workers', type=int, default=multiprocessing.cpu_count(),
+    help='Number of worker processes to run'
+)
+PARSER.add_argument(
+    '-m', '--max-requests', type=int, default=1000,
+    help='Restart a worker after it serves this many requests (0: never)'
+)
+PARSER.add_argument(
+    '-j', '--max-requests-jitter', type=int, default=100,
+    help='Add up to this many requests to each worker\'s --max-requests'
+)
+PARSER.add_argument(
+    '-g', '--graceful-timeout', type=float, default=30,
+    help='Seconds workers are given to finish their requests before being killed'
+)
+PARSER.add_argument(
+    '-v', '--verbose', action='store_true',
+    help='Show extra output about workers starting and stopping'
+)
+
+# Set by a master re-executing itself, for the new master to pick up
+LISTEN_FD_ENV = 'DLI_SERVE_LISTEN_FD'
+OLD_WORKERS_ENV = 'DLI_SERVE_OLD_WORKERS'
+
+
+def vprint(s='', endl='\n'):
+    """Print a string if verbose mode is enabled"""
+    if ARGS.verbose:
+        sys.stderr.write('{s}{endl}'.format(s=s, endl=endl))
+
+
+class WorkerServer(BaseWSGIServer):
+    """A single threaded WSGI server that counts the requests it serves"""
+
+    served = 0
+
+    def process_request(self, request, client_address):
+        """Serve a request"""
+        self.served += 1
+        BaseWSGIServer.process_request(self, request, client_address)
+
+
+def parse_bind(bind):
+    """Return the (host, port) of a host:port string"""
+    host, _, port = bind.rpartition(':')
+    return host or '0.0.0.0', int(port)
+
+
+def listen(host, port):
+    """Return the listening socket, reusing the old master's if restarting"""
+    fd = os.environ.pop(LISTEN_FD_ENV, None)
+    if fd is not None:
+        sock = socket.fromfd(int(fd), socket.AF_INET, socket.SOCK_STREAM)
+        # fromfd made a copy of the descriptor
+        os.close(int(fd))
+    else:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((host, port))
+        sock.listen(128)
+    # A worker woken for a connection another worker accepted first must not
+    # block in accept(); this also applies to the workers' copies
+    sock.setblocking(False)
+    return sock
+
+
+def preload():
+    """Do the work every worker would otherwise repeat, before forking"""
+    for name in app.jinja_env.list_templates(extensions=['html']):
+        app.jinja_env.get_template(name)
+    # Never share pooled connections across processes
+    db.engine.dispose()
+
+
+def run_worker(sock, host, port, max_requests):
+    """Serve requests until told to stop or max_requests have been served"""
+    stopping = []
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda *_: stopping.append(True))
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    random.seed()
+
+    server = WorkerServer(host, port, app, fd=sock.fileno())
+    # Wake up every second to notice a stop signal
+    server.timeout = 1
+    while not stopping and not (max_requests and server.served >= max_requests):
+        server.handle_request()
+    vprint('Worker {pid} exiting after {served} requests'.format(
+        pid=os.getpid(),
+        served=server.served,
+    ))
+
+
+def finish_worker():
+    """Write out what the worker has buffered
+
+    Workers leave with os._exit, which skips the atexit functions that would
+    otherwise do this.
+    """
+    for flush in (WIKI_VIEWS.flush, EXCEL_CACHE.flush_invalidations):
+        try:
+            flush()
+        except Exception:  # pylint: disable=broad-except
+            traceback.print_exc()
+    db.session.remove()
+    db.engine.dispose()
+
+
+def spawn_worker(sock, host, port):
+    """Fork a worker and return its pid"""
+    max_requests = ARGS.max_requests
+    if max_requests:
+        max_requests += random.randint(0, ARGS.max_requests_jitter)
+
+    pid = os.fork()
+    if pid == 0:
+        status = 0
+        try:
+            run_worker(sock, host, port, max_requests)
+        except Exception:  # pylint: disable=broad-except
+            traceback.print_exc()
+            status = 1
+        finally:
+            finish_worker()
+        os._exit(status)  # pylint: disable=protected-access
+
+    vprint('Started worker {}'.format(pid))
+    return pid
+
+
+def reap():
+    """Return the pids of every child that has exited"""
+    exited = []
+    while True:
+        try:
+            pid, _ = os.waitpid(-1, os.WNOHANG)
+        except OSError as e:
+            if e.errno == errno.ECHILD:
+                break
+            raise
+        if pid == 0:
+            break
+        exited.append(pid)
+    return exited
+
+
+def kill_all(pids, signum):
+    """Send a signal to every process that still exists"""
+    for pid in pids:
+        try:
+            os.kill(pid, signum)
+        except OSError as e:
+            if e.errno != errno.ESRCH:
+                raise
+
+
+def stop(workers):
+    """Stop every worker, killing those that outlast the graceful timeout"""
+    kill_all(workers, signal.SIGTERM)
+    deadline = time.time() + ARGS.graceful_timeout
+    while workers and time.time() < deadline:
+        workers.difference_update(reap())
+        time.sleep(0.1)
+    if workers:
+        print('Killing {} workers that didn\'t stop in time'.format(len(workers)))
+        kill_all(workers, signal.SIGKILL)
+        while workers:
+            workers.difference_update(reap())
+            time.sleep(0.1)
+
+
+def restart(sock, workers):
+    """Re-execute the master on the same socket, leaving the workers running"""
+    print('Restarting...')
+    sys.stdout.flush()
+    if hasattr(sock, 'set_inheritable'):
+        sock.set_inheritable(True)
+    os.environ[LISTEN_FD_ENV] = str(sock.fileno())
+    os.environ[OLD_WORKERS_ENV] = ','.join(str(pid) for pid in workers)
+    os.execv(sys.executable, [sys.executable] + sys.argv)
+
+
+def serve():
+    """Run the master process"""
+    host, port = parse_bind(ARGS.bind or '{host}:{port}'.format(
+        host=app.config['SERVER_HOST'],
+        port=app.config['SERVER_PORT'],
+    ))
+    sock = listen(host, port)
+    preload()
+    # Requests are logged by the app's REQUEST_LOG instead
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+
+    received = []
+    for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP, signal.SIGCHLD):
+        signal.signal(signum, lambda signum, _: received.append(signum))
+
+    workers = set(spawn_worker(sock, host, port) for _ in range(ARGS.workers))
+    print('Serving on http://{host}:{port} with {workers} workers (master {pid})'.format(
+        host=host,
+        port=port,
+        workers=len(workers),
+        pid=os.getpid(),
+    ))
+    sys.stdout.flush()
+
+    # Workers of the master this one replaced, now that ours are serving
+    retiring = set(int(pid) for pid in os.environ.pop(OLD_WORKERS_ENV, '').split(',') if pid)
+    kill_all(retiring, signal.SIGTERM)
+
+    while True:
+        for pid in reap():
+            if pid in retiring:
+                retiring.remove(pid)
+            elif pid in workers:
+                workers.remove(pid)
+                vprint('Worker {} exited'.format(pid))
+                workers.add(spawn_worker(sock, host, port))
+
+        while received:
+            signum = received.pop(0)
+            if signum in (signal.SIGTERM, signal.SIGINT):
+                print('Stopping...')
+                stop(workers | retiring)
+                return
+            elif signum == signal.SIGHUP:
+                restart(sock, workers | retiring)
+        time.sleep(0.5)
+
+
+if __name__ == '__main__':
+    ARGS = PARSER.parse_args()
+    vprint('Serve script loaded.')
+    serve()
+    vprint('Serve script exiting successfully.')
@@ -8,6 +8,10 @@ Send an email to the developers of the new bug reports and feature requests dail
 
 2. Invalid expired PasswordResets
 Delete PasswordResets that have reached their expiration date
+
+3. Queued mail delivery
+Send the messages queued in the outbox every few seconds, and forget the ones
+sent more than a week ago daily.
 """
 
 import datetime
@@ -21,6 +25,7 @@ from dli_app import app
 from dli_app import db
 
 from dli_app.mod_admin.models import ErrorReport
+from dli_app.mod_admin.models import OutboxMessage
 from dli_app.mod_auth.models import PasswordReset
 
 
@@ -59,7 +64,24 @@ def delete_expired_pw_resets():
     db.session.commit()
 
 
+def deliver_queued_mail():
+    """Send the messages queued in the outbox"""
+    with app.app_context():
+        # Keep going while full batches come back; there may be more queued
+        while OutboxMessage.deliver_pending(batch_size=100) == 100:
+            pass
+    # End the transaction so the next run sees newly queued messages
+    db.session.remove()
+
+
+def delete_old_sent_mail():
+    """Forget the messages sent more than a week ago"""
+    OutboxMessage.delete_sent(datetime.datetime.now() - datetime.timedelta(days=7))
+
+
 # Schedule the jobs and run forever
+schedule.every(5).seconds.do(deliver_queued_mail)
+schedule.every().day.at("23:59").do(delete_old_sent_mail)
 schedule.every().day.at("23:59").do(delete_expired_pw_resets)
 # Ignore the weekend for error reports
 schedule.every().monday.at("21:59").do(email_error_reports)
@@ -72,4 +94,4 @@ schedule.every().friday.at("21:59").do(email_error_reports)
 # Run all scheduled jobs forever
 while True:
     schedule.run_pending()
-    time.sleep(60)
+    time.sleep(1)